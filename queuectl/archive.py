@@ -0,0 +1,68 @@
+# queuectl/archive.py
+import gzip
+import json
+from .output import decompress
+
+class SQLiteArchive:
+    """
+    Archive into another SQLite file, ATTACHed to the live connection so that
+    copying a batch and deleting it from the queue commit atomically.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def open(self, conn):
+        conn.execute('ATTACH DATABASE ? AS archive', (self.path,))
+        for table in ('jobs', 'job_output'):
+            conn.execute(f'CREATE TABLE IF NOT EXISTS archive.{table} AS SELECT * FROM main.{table} WHERE 0')
+            # the live schema may have grown since the archive was created
+            have = {r[1] for r in conn.execute(f'PRAGMA archive.table_info({table})')}
+            for r in conn.execute(f'PRAGMA main.table_info({table})'):
+                if r[1] not in have:
+                    conn.execute(f'ALTER TABLE archive.{table} ADD COLUMN {r[1]} {r[2]}')
+
+    def store(self, cur, rowids, marks):
+        cols = ','.join(r[1] for r in cur.execute('PRAGMA main.table_info(jobs)').fetchall())
+        cur.execute(f'INSERT INTO archive.jobs({cols}) SELECT {cols} FROM main.jobs WHERE rowid IN ({marks})', rowids)
+        ocols = ','.join(r[1] for r in cur.execute('PRAGMA main.table_info(job_output)').fetchall())
+        cur.execute(f'''INSERT INTO archive.job_output({ocols}) SELECT {ocols} FROM main.job_output
+                        WHERE job_id IN (SELECT id FROM main.jobs WHERE rowid IN ({marks}))''', rowids)
+
+    def close(self, conn):
+        conn.execute('DETACH DATABASE archive')
+
+class JsonlArchive:
+    """
+    Append archived jobs, output included as text, to a JSONL segment (gzip
+    compressed when the path ends in .gz). Each batch is flushed before its
+    delete commits, so a crash can duplicate rows in the archive but never lose them.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.fh = None
+
+    def open(self, conn):
+        if self.path.endswith('.gz'):
+            self.fh = gzip.open(self.path, 'at', encoding='utf-8')
+        else:
+            self.fh = open(self.path, 'a', encoding='utf-8')
+
+    def store(self, cur, rowids, marks):
+        jobs = [dict(r) for r in cur.execute(f'SELECT * FROM jobs WHERE rowid IN ({marks})', rowids).fetchall()]
+        for job in jobs:
+            out = {'stdout': bytearray(), 'stderr': bytearray()}
+            for r in cur.execute('SELECT stream, data FROM job_output WHERE job_id = ? ORDER BY attempt, seq', (job['id'],)).fetchall():
+                out[r['stream']] += decompress(r['data'])
+            job['stdout'] = out['stdout'].decode(errors='replace') or job.get('stdout')
+            job['stderr'] = out['stderr'].decode(errors='replace') or job.get('stderr')
+            self.fh.write(json.dumps(job) + '\n')
+        self.fh.flush()
+
+    def close(self, conn):
+        self.fh.close()
+
+def open_archive(path):
+    """`*.jsonl.gz` / `*.jsonl` paths get a JSONL segment; anything else is a SQLite file."""
+    if path.endswith('.jsonl.gz') or path.endswith('.jsonl'):
+        return JsonlArchive(path)
+    return SQLiteArchive(path)
@@ -0,0 +1,324 @@
+# queuectl/async_worker.py
+import os
+import json
+import time
+import signal
+import socket
+import asyncio
+import functools
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import current_process
+from .db import DEFAULT_CONFIG
+from .broker import open_db, BrokerLost
+from .metrics import Metrics
+from .notify import Waiter
+from .output import JobOutput
+from .pool import PREFIX as PYTHON_PREFIX
+from .resources import Confinement, this_node
+from .runner import kill_group, job_argv, exit_code as wait_exit_code
+from .worker import job_result, maybe_run_gc, python_pool, lease_owner, next_due, LeaseReaper, QueueSelector, FALLBACK_POLL
+
+class DBWriter:
+    """
+    Serializes every DB call of an async worker onto one dedicated thread, so the
+    event loop never blocks on SQLite. Results queued with `submit` are written
+    back in batches by a single writer task.
+    """
+    def __init__(self, db):
+        self.db = db
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='queuectl-db')
+        self.results = asyncio.Queue()
+        self.task = None
+        self.metrics = None
+
+    async def call(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, fn, *args)
+
+    def call_soon(self, fn, *args):
+        """Queue a DB call on the writer thread without waiting for it (order is preserved)."""
+        self.executor.submit(fn, *args)
+
+    def submit(self, result):
+        self.results.put_nowait(result)
+
+    def start(self):
+        self.task = asyncio.ensure_future(self._write_results())
+
+    async def _write_results(self):
+        while True:
+            batch = [await self.results.get()]
+            while not self.results.empty():
+                batch.append(self.results.get_nowait())
+            try:
+                started = time.perf_counter()
+                lost = await self.call(self.db.update_jobs_after_run, batch)
+                if self.metrics is not None:
+                    self.metrics.record_writeback(lost, time.perf_counter() - started)
+                if lost:
+                    print(f"[db-writer] discarded results of {len(lost)} job(s) whose lease expired: {', '.join(lost[:10])}")
+            except Exception as e:
+                print(f"[db-writer] failed to write back {len(batch)} result(s): {e}")
+            finally:
+                for _ in batch:
+                    self.results.task_done()
+
+    async def close(self):
+        await self.results.join()
+        if self.metrics is not None:
+            await self.call(self.metrics.flush, self.db)
+        self.task.cancel()
+        self.executor.shutdown(wait=True)
+
+async def _pump(reader, stream, output):
+    while True:
+        data = await reader.read(65536)
+        if not data:
+            return
+        output.write(stream, data)
+
+async def _reader(pipe):
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+    return reader
+
+async def _reap(proc):
+    """
+    Wait for a Popen child with os.wait4 (asyncio's child watchers drop the rusage):
+    on its pidfd where the kernel has them, else by polling. Sets proc.returncode
+    and returns the rusage.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        fd = os.pidfd_open(proc.pid)
+    except (AttributeError, OSError):
+        fd = None
+    if fd is not None:
+        exited = asyncio.Event()
+        loop.add_reader(fd, exited.set)
+        try:
+            await exited.wait()
+        finally:
+            loop.remove_reader(fd)
+            os.close(fd)
+    pause = 0.001
+    while True:
+        pid, status, ru = os.wait4(proc.pid, os.WNOHANG)
+        if pid:
+            proc.returncode = wait_exit_code(status)
+            return ru
+        await asyncio.sleep(pause)
+        pause = min(pause * 2, 0.05)
+
+def _kill_spawned(spawn):
+    # a job cancelled while its process was being started: kill it once it exists
+    if not spawn.cancelled() and spawn.exception() is None:
+        proc = spawn.result()
+        kill_group(proc.pid)
+        proc.wait()
+        proc.stdout.close()
+        proc.stderr.close()
+
+async def _ticker(output):
+    while True:
+        await asyncio.sleep(output.flush_interval)
+        output.tick()
+
+async def run_job_async(worker_id, job, global_timeout, backoff_base, output_max_bytes, flush=None, pool=None,
+                        cgroup_root=None):
+    """
+    Async counterpart of worker.run_job: processes run in their own process group,
+    confined to the job's cpu/mem_mb; `python:` jobs run in `pool` on a helper thread.
+    """
+    job_id = job['id']
+    command = job['command']
+    job_timeout = job.get('timeout') or global_timeout
+    print(f"[worker {worker_id}] picked job {job_id} (attempts={job['attempts']}) -> {command} (timeout={job_timeout})")
+    output = JobOutput(job_id, job['attempts'] + 1, output_max_bytes, flush=flush)
+    start = time.time()
+    timed_out = False
+    success = False
+    exit_code = None
+    proc = None
+    spawn = None
+    usage = {}
+    confine = None
+    try:
+        if job.get('kind') == 'python' or command.startswith(PYTHON_PREFIX):
+            loop = asyncio.get_running_loop()
+            exit_code, timed_out = await loop.run_in_executor(None, pool.run, command, json.loads(job.get('args') or '[]'),
+                                                              job_timeout, output, usage)
+            success = (exit_code == 0 and not timed_out)
+            if timed_out:
+                exit_code = -1
+                print(f"[worker {worker_id}] job {job_id} timed out after {job_timeout}s")
+            elif success:
+                print(f"[worker {worker_id}] job {job_id} completed (exit {exit_code}) in {time.time()-start:.2f}s")
+            else:
+                print(f"[worker {worker_id}] job {job_id} failed (exit {exit_code})")
+            return job_result(worker_id, job, success, exit_code, output.close(), time.time() - start, timed_out, backoff_base, usage)
+        confine = Confinement(job.get('cpu'), job.get('mem_mb'), job_timeout, cgroup_root)
+        argv = job_argv(job)
+        # fork/exec (and confining the child) blocks, so it runs off the event loop
+        spawn = asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(confine.popen, command if argv is None else argv, shell=argv is None,
+                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True))
+        proc = await asyncio.shield(spawn)
+        pumps = asyncio.gather(_pump(await _reader(proc.stdout), 'stdout', output),
+                               _pump(await _reader(proc.stderr), 'stderr', output), _reap(proc))
+        ticker = asyncio.ensure_future(_ticker(output))
+        try:
+            _, _, ru = await asyncio.wait_for(pumps, timeout=job_timeout)
+        finally:
+            ticker.cancel()
+        usage.update(confine.finish(ru))
+        exit_code = proc.returncode
+        success = (exit_code == 0)
+        if success:
+            print(f"[worker {worker_id}] job {job_id} completed (exit {exit_code}) in {time.time()-start:.2f}s")
+        else:
+            print(f"[worker {worker_id}] job {job_id} failed (exit {exit_code})")
+    except asyncio.TimeoutError:
+        timed_out = True
+        exit_code = -1
+        kill_group(proc.pid)
+        usage.update(confine.finish(await _reap(proc)))
+        print(f"[worker {worker_id}] job {job_id} timed out after {job_timeout}s")
+    except asyncio.CancelledError:
+        if proc is not None and proc.returncode is None:
+            kill_group(proc.pid)
+        elif spawn is not None:
+            spawn.add_done_callback(_kill_spawned)
+        raise
+    except Exception as e:
+        exit_code = -1
+        output.write('stderr', str(e).encode())
+        print(f"[worker {worker_id}] job {job_id} raised exception: {e}")
+    finally:
+        if confine is not None:
+            confine.finish(None)
+    duration = time.time() - start
+    return job_result(worker_id, job, success, exit_code, output.close(), duration, timed_out, backoff_base, usage)
+
+async def _async_worker(worker_id, concurrency, queues):
+    db = open_db()
+    loop = asyncio.get_running_loop()
+    writer = DBWriter(db)
+    writer.start()
+    stop = asyncio.Event()
+    woke = asyncio.Event()
+    waiter = Waiter(db.path)
+
+    def handle_sigterm():
+        print(f"[worker {worker_id}] received shutdown signal; will exit after running jobs")
+        stop.set()
+
+    loop.add_signal_handler(signal.SIGINT, handle_sigterm)
+    loop.add_signal_handler(signal.SIGTERM, handle_sigterm)
+    if waiter.sock is not None:
+        loop.add_reader(waiter.fileno(), lambda: (waiter.drain(), woke.set()))
+
+    backoff_base = await writer.call(db.get_config, 'backoff_base') or DEFAULT_CONFIG['backoff_base']
+    global_timeout = await writer.call(db.get_config, 'job_timeout') or DEFAULT_CONFIG['job_timeout']
+    poll_interval = float(await writer.call(db.get_config, 'idle_poll_interval') or DEFAULT_CONFIG['idle_poll_interval'])
+    output_max_bytes = await writer.call(db.get_config, 'output_max_bytes') or DEFAULT_CONFIG['output_max_bytes']
+    lease_ttl = float(await writer.call(db.get_config, 'lease_ttl') or DEFAULT_CONFIG['lease_ttl'])
+    cgroup_root = await writer.call(db.get_config, 'cgroup_root')
+    if waiter.sock is None:
+        poll_interval = min(poll_interval, FALLBACK_POLL)
+
+    selector = QueueSelector(queues or [])
+    names = [q for q, _ in queues] if queues else None
+    owner = lease_owner()
+    node = this_node()
+    reaper = LeaseReaper(db, worker_id, lease_ttl)
+    metrics = db.metrics = writer.metrics = Metrics(owner)
+    pool = await writer.call(python_pool, db, concurrency)
+    await writer.call(db.register_worker, owner, socket.gethostname(), os.getpid(), 'async')
+    running = set()
+
+    async def heartbeat():
+        # keep the workers row fresh; while jobs run, one UPDATE extends every lease we hold
+        while True:
+            await asyncio.sleep(max(0.5, lease_ttl / 3))
+            try:
+                await writer.call(db.touch_worker, owner)
+                if running:
+                    await writer.call(db.heartbeat, owner, lease_ttl)
+            except Exception as e:
+                print(f"[heartbeat {owner}] failed: {e}")
+
+    async def run_one(job):
+        flush = lambda rows: writer.call_soon(db.append_output, rows)
+        result = await run_job_async(worker_id, job, global_timeout, backoff_base, output_max_bytes, flush=flush, pool=pool,
+                                       cgroup_root=cgroup_root)
+        metrics.record_result(result)
+        writer.submit(result)
+
+    stop_wait = asyncio.ensure_future(stop.wait())
+    beat = asyncio.ensure_future(heartbeat())
+    try:
+        while not stop.is_set():
+            await writer.call(reaper.maybe_reap)
+            await writer.call(metrics.maybe_flush, db)
+            free = concurrency - len(running)
+            if free <= 0:
+                await asyncio.wait(running | {stop_wait}, return_when=asyncio.FIRST_COMPLETED)
+                running = {t for t in running if not t.done()}
+                continue
+            woke.clear()
+            seen_version = await writer.call(db.data_version)
+            claimed_at = time.time()
+            started = time.perf_counter()
+            try:
+                batch = await writer.call(lambda: db.fetch_and_claim_jobs(free, selector.order(), owner, lease_ttl, node=node))
+            except BrokerLost as e:
+                # anything it did claim comes back when the lease expires
+                print(f"[worker {worker_id}] {e}")
+                continue
+            metrics.record_claim(batch, time.perf_counter() - started)
+            for job in batch:
+                running.add(asyncio.ensure_future(run_one(job)))
+            if batch:
+                continue
+            # idle: wait for a wakeup, a free slot, the next due retry or a foreign commit
+            if not running:
+                await writer.call(maybe_run_gc, db)
+            next_at = await writer.call(next_due, db, names, claimed_at)
+            next_at = reaper.next_at if next_at is None else min(next_at, reaper.next_at)
+            while not stop.is_set() and not woke.is_set():
+                now = time.time()
+                if next_at is not None and next_at <= now:
+                    break
+                timeout = poll_interval if next_at is None else min(poll_interval, next_at - now)
+                woke_wait = asyncio.ensure_future(woke.wait())
+                done, _ = await asyncio.wait(running | {stop_wait, woke_wait}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                woke_wait.cancel()
+                if done - {woke_wait, stop_wait}:
+                    break
+                if not done and await writer.call(db.data_version) != seen_version:
+                    break
+            running = {t for t in running if not t.done()}
+        if running:
+            await asyncio.wait(running)
+        beat.cancel()
+        await writer.call(db.remove_worker, owner)
+        await writer.close()
+    finally:
+        beat.cancel()
+        stop_wait.cancel()
+        if waiter.sock is not None:
+            loop.remove_reader(waiter.fileno())
+        waiter.close()
+        pool.close()
+
+def async_worker_loop(worker_id: int, concurrency: int = 10, queues=None):
+    """
+    Entry point for `worker start --mode async`: one process drives up to
+    `concurrency` jobs at once on an asyncio event loop. `queues` is as for worker_loop.
+    """
+    print(f"[worker {worker_id}] started in async mode (pid={current_process().pid}, concurrency={concurrency})")
+    asyncio.run(_async_worker(worker_id, max(1, concurrency), queues))
+    print(f"[worker {worker_id}] exiting")
@@ -0,0 +1,257 @@
+# queuectl/bench.py
+"""
+Reproducible benchmarks for the queue hot paths. Every scenario runs against a
+fresh database in a scratch directory, preloaded with `backlog` pending rows, and
+reports one JSON-serialisable dict, so runs can be diffed across commits.
+"""
+import os
+import sys
+import time
+import shutil
+import sqlite3
+import platform
+import tempfile
+import subprocess
+import multiprocessing as mp
+from .db import DB, DEFAULT_QUEUE, SCHEMA_VERSION
+from .shards import ShardedDB
+
+SCENARIOS = ('enqueue', 'claim', 'e2e', 'retry', 'spawn')
+DEFAULT_BACKLOGS = (10_000,)
+DEFAULT_WORKERS = (1, 4, 16, 64)
+# backlog rows sit below the jobs a scenario times, so they are never claimed;
+# real workers (e2e) only serve the default queue and never see the backlog queue
+BACKLOG_PRIORITY = -1
+BACKLOG_QUEUE = 'bench-backlog'
+
+def parse_count(value):
+    """Parse "10000", "10k" or "1M"."""
+    value = str(value).strip().lower()
+    scale = {'k': 1_000, 'm': 1_000_000}.get(value[-1:], 1)
+    if scale != 1:
+        value = value[:-1]
+    return int(float(value) * scale)
+
+def percentiles(samples, points=(50, 90, 99)):
+    """Nearest-rank percentiles of `samples` (seconds) in microseconds, plus max and mean."""
+    if not samples:
+        return {}
+    s = sorted(samples)
+    out = {f'p{p}_us': round(s[min(len(s) - 1, max(0, -(-p * len(s) // 100) - 1))] * 1e6, 1) for p in points}
+    out['max_us'] = round(s[-1] * 1e6, 1)
+    out['mean_us'] = round(sum(s) / len(s) * 1e6, 1)
+    return out
+
+def _preload(db, backlog, queue=None, chunk_size=10_000):
+    db.enqueue_many(({'id': f'backlog-{i}', 'command': 'true', 'priority': BACKLOG_PRIORITY, 'queue': queue}
+                     for i in range(backlog)), chunk_size=chunk_size)
+
+def _open(path):
+    db = DB(path)
+    return ShardedDB(path) if (db.get_config('shards') or 1) > 1 else db
+
+class Workspace:
+    """
+    A scratch directory holding one fresh queuectl.db (split into `shards` shard
+    files when above 1); workers started inside it use it.
+    """
+    def __init__(self, base=None, shards=1):
+        self.dir = tempfile.mkdtemp(prefix='queuectl-bench-', dir=base)
+        self.path = os.path.join(self.dir, 'queuectl.db')
+        self.db = DB(self.path)
+        if shards > 1:
+            self.db.set_config('shards', shards)
+            self.db = ShardedDB(self.path)
+
+    def close(self):
+        self.db.close()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+def bench_enqueue(ws, backlog, singles=1000):
+    """Bulk insert rate while building the backlog, then single-job enqueue rate on top of it."""
+    start = time.perf_counter()
+    _preload(ws.db, backlog)
+    bulk = time.perf_counter() - start
+    lat = []
+    for i in range(singles):
+        t = time.perf_counter()
+        ws.db.enqueue({'id': f'single-{i}', 'command': 'true'})
+        lat.append(time.perf_counter() - t)
+    return {'bulk_jobs_per_sec': round(backlog / bulk, 1) if bulk else None,
+            'single_jobs_per_sec': round(singles / sum(lat), 1) if lat else None,
+            'single_latency': percentiles(lat)}
+
+def _claimer(path, claims, barrier, results):
+    db = _open(path)
+    lat = []
+    ids = []
+    barrier.wait()
+    for _ in range(claims):
+        t = time.perf_counter()
+        job = db.fetch_and_claim_job(worker_id=f'bench:{os.getpid()}')
+        lat.append(time.perf_counter() - t)
+        if job is None:
+            break
+        ids.append(job['id'])
+    results.put((lat, ids))
+
+def bench_claim(ws, backlog, workers, claims=200):
+    """Claim latency with `workers` processes claiming from the same backlog at once."""
+    _preload(ws.db, backlog)
+    ctx = mp.get_context('fork')
+    # the parent is a party too: the clock starts once every claimer has started up
+    # and opened its database, so process startup is not counted as claim time
+    barrier = ctx.Barrier(workers + 1)
+    results = ctx.Queue()
+    per_worker = max(1, min(claims, backlog // workers))
+    procs = [ctx.Process(target=_claimer, args=(ws.path, per_worker, barrier, results)) for _ in range(workers)]
+    for p in procs:
+        p.start()
+    barrier.wait()
+    start = time.perf_counter()
+    lat, ids = [], []
+    for _ in procs:
+        l, i = results.get()
+        lat += l
+        ids += i
+    elapsed = time.perf_counter() - start
+    for p in procs:
+        p.join()
+    return {'workers': workers, 'claims': len(ids), 'claims_per_sec': round(len(ids) / elapsed, 1),
+            'latency': percentiles(lat)}
+
+def _quiet_worker(cwd, prefetch):
+    from .worker import worker_loop
+    os.chdir(cwd)
+    sys.stdout = open(os.devnull, 'w')
+    worker_loop(0, prefetch, queues=[(DEFAULT_QUEUE, 1)])
+
+def _wait_for(db, state, count, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if db.get_status_counts().get(state, 0) >= count:
+            return True
+        time.sleep(0.01)
+    return False
+
+def bench_e2e(ws, backlog, workers, jobs=500, prefetch=1, timeout=300):
+    """Wall time for `workers` real worker processes to run `jobs` no-op commands."""
+    _preload(ws.db, backlog, queue=BACKLOG_QUEUE)
+    ctx = mp.get_context('fork')
+    procs = [ctx.Process(target=_quiet_worker, args=(ws.dir, prefetch)) for _ in range(workers)]
+    for p in procs:
+        p.start()
+    # let the workers connect and go idle so start-up is not timed
+    time.sleep(0.5)
+    start = time.perf_counter()
+    ws.db.enqueue_many({'id': f'e2e-{i}', 'command': 'true'} for i in range(jobs))
+    done = _wait_for(ws.db, 'completed', jobs, timeout)
+    elapsed = time.perf_counter() - start
+    for p in procs:
+        p.terminate()
+    for p in procs:
+        p.join()
+    return {'workers': workers, 'prefetch': prefetch, 'jobs': jobs, 'finished': done,
+            'jobs_per_sec': round(jobs / elapsed, 1)}
+
+def bench_retry(ws, backlog, jobs=1000):
+    """
+    Cost of scheduling a retry, measured in-process: every job is claimed, failed
+    (backoff 0), reclaimed and completed; compared with claim-and-complete alone.
+    """
+    _preload(ws.db, backlog)
+    db = ws.db
+    ws.db.enqueue_many({'id': f'ok-{i}', 'command': 'true', 'priority': 1} for i in range(jobs))
+    ws.db.enqueue_many({'id': f'retry-{i}', 'command': 'true', 'max_retries': 3} for i in range(jobs))
+
+    def run(attempts, fail_first):
+        start = time.perf_counter()
+        for _ in range(jobs):
+            job = db.fetch_and_claim_job()
+            if fail_first:
+                db.update_job_after_run(job['id'], False, 1, job['max_retries'], error_msg='exit=1', next_available_delay=0)
+                job = db.fetch_and_claim_job()
+            db.update_job_after_run(job['id'], True, attempts, job['max_retries'])
+        return time.perf_counter() - start
+
+    base = run(1, False)
+    retried = run(2, True)
+    return {'jobs': jobs, 'success_us_per_job': round(base / jobs * 1e6, 1),
+            'retry_us_per_job': round(retried / jobs * 1e6, 1),
+            'retry_overhead_us': round((retried - base) / jobs * 1e6, 1)}
+
+def bench_spawn(ws, backlog, jobs=500):
+    """
+    Per-job execution cost of a trivial job on each path, in-process: `sh -c true`,
+    direct exec of `true`, and a no-op function in the warm python pool.
+    """
+    from .output import JobOutput
+    from .pool import PythonPool
+    from .runner import run_process
+    pool = PythonPool(1, max_jobs=jobs + 1)
+    paths = {'shell': lambda out: run_process('true', 10, out, shell=True),
+             'exec': lambda out: run_process(['true'], 10, out),
+             'python': lambda out: pool.run('python:queuectl.pool:noop', [], 10, out)}
+    out = {'jobs': jobs}
+    try:
+        # start the pool process (and forkserver) before timing
+        paths['python'](JobOutput('warmup', 1, 1024))
+        for name, run in paths.items():
+            start = time.perf_counter()
+            for i in range(jobs):
+                run(JobOutput(f'{name}-{i}', 1, 1024))
+            out[f'{name}_jobs_per_sec'] = round(jobs / (time.perf_counter() - start), 1)
+    finally:
+        pool.close()
+    out['exec_speedup'] = round(out['exec_jobs_per_sec'] / out['shell_jobs_per_sec'], 2)
+    out['python_speedup'] = round(out['python_jobs_per_sec'] / out['shell_jobs_per_sec'], 2)
+    return out
+
+def _git_commit():
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5)
+        return out.stdout.strip() or None
+    except Exception:
+        return None
+
+def run_benchmarks(scenarios=SCENARIOS, backlogs=DEFAULT_BACKLOGS, workers=DEFAULT_WORKERS, jobs=500,
+                   claims=200, prefetch=1, base_dir=None, on_result=None, shards=(1,)):
+    """
+    Run every requested scenario for every shard count, backlog size (and worker
+    count, where it applies) and return {'meta': ..., 'results': [...]}.
+    `on_result(result)` is called as each measurement finishes.
+    """
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        raise ValueError(f"unknown scenario(s): {', '.join(sorted(unknown))}")
+    meta = {'commit': _git_commit(), 'schema_version': SCHEMA_VERSION, 'sqlite': sqlite3.sqlite_version,
+            'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count(),
+            'pragmas': os.environ.get('QUEUECTL_PRAGMAS'), 'started_at': time.time()}
+    results = []
+
+    def measure(scenario, backlog, fn, *args):
+        ws = Workspace(base_dir, n)
+        try:
+            result = {'scenario': scenario, 'shards': n, 'backlog': backlog}
+            result.update(fn(ws, backlog, *args))
+        finally:
+            ws.close()
+        results.append(result)
+        if on_result:
+            on_result(result)
+
+    for n, backlog in ((n, b) for n in shards for b in backlogs):
+        if 'enqueue' in scenarios:
+            measure('enqueue', backlog, bench_enqueue)
+        if 'claim' in scenarios:
+            for w in workers:
+                measure('claim', backlog, bench_claim, w, claims)
+        if 'e2e' in scenarios:
+            for w in workers:
+                measure('e2e', backlog, bench_e2e, w, jobs, prefetch)
+        if 'retry' in scenarios:
+            measure('retry', backlog, bench_retry, jobs)
+        if 'spawn' in scenarios:
+            measure('spawn', backlog, bench_spawn, jobs)
+    return {'meta': meta, 'results': results}
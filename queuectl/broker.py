@@ -0,0 +1,459 @@
+# queuectl/broker.py
+"""
+`queuectl serve`: a broker daemon that owns the database's write path. Clients send
+newline-delimited JSON requests over a Unix socket (or TCP, for workers on other
+nodes); the broker queues the writes of every client and commits them together,
+one transaction every few milliseconds, so N concurrent enqueues or claims cost one
+fsync and never fight over SQLite's write lock. Each request runs in its own
+SAVEPOINT, so one failing request does not affect the rest of its group.
+
+Clients use open_db(): a BrokerDB sends writes to the broker while one is listening
+and otherwise falls back to direct SQLite, re-checking about once a second.
+
+Anyone who can send `enqueue` can make the workers run a shell command, so TCP
+connections must first authenticate with the shared QUEUECTL_BROKER_TOKEN when the
+broker has one; the Unix socket is protected by its directory's permissions.
+"""
+import os
+import hmac
+import json
+import time
+import queue
+import base64
+import select
+import socket
+import asyncio
+import sqlite3
+import ipaddress
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from .db import DB
+from .notify import runtime_dir
+from .shards import ShardedDB, shard_path
+
+# Writes are group-committed on the broker's single writer connection.
+WRITE_OPS = ('enqueue', 'enqueue_many', 'fetch_and_claim_jobs', 'update_jobs_after_run', 'append_output', 'heartbeat',
+             'release_jobs', 'reap_expired_leases', 'expire_leases', 'dlq_retry', 'set_config', 'add_metrics',
+             'register_worker', 'touch_worker', 'set_worker_state', 'remove_worker', 'prune_workers', 'try_claim_periodic',
+             'add_schedule', 'remove_schedule', 'advance_schedules', 'set_key_limit', 'remove_key_limit')
+# Reads are only forwarded for remote (TCP) clients; local ones read the file directly.
+READ_OPS = ('get_config', 'data_version', 'next_available_at', 'get_job', 'get_status_counts', 'get_queue_stats',
+            'list_workers', 'get_output', 'read_output', 'output_attempt', 'metric_totals', 'get_metrics',
+            'list_schedules', 'job_graph', 'next_token_at', 'list_key_limits', 'node_usage', 'count_completed_since')
+
+_ERRORS = {'ValueError': ValueError, 'KeyError': KeyError, 'IntegrityError': sqlite3.IntegrityError,
+           'OperationalError': sqlite3.OperationalError, 'PermissionError': PermissionError}
+
+TOKEN_ENV = 'QUEUECTL_BROKER_TOKEN'
+# how long a TCP client has to present its token
+AUTH_TIMEOUT = 10.0
+
+def socket_path(db_path):
+    return os.path.join(runtime_dir(db_path), 'broker.sock')
+
+def parse_address(spec):
+    """'tcp://host:port' -> ('tcp', (host, port)); 'unix:/path' or '/path' -> ('unix', path)."""
+    if spec.startswith('tcp://'):
+        host, _, port = spec[len('tcp://'):].rpartition(':')
+        return 'tcp', (host or '127.0.0.1', int(port))
+    return 'unix', spec[len('unix:'):] if spec.startswith('unix:') else spec
+
+def _encode(obj):
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        return {'$b': base64.b64encode(bytes(obj)).decode()}
+    if isinstance(obj, (list, tuple)):
+        return [_encode(x) for x in obj]
+    if isinstance(obj, dict):
+        return {k: _encode(v) for k, v in obj.items()}
+    return obj
+
+def _decode(obj):
+    if isinstance(obj, list):
+        return [_decode(x) for x in obj]
+    if isinstance(obj, dict):
+        if len(obj) == 1 and '$b' in obj:
+            return base64.b64decode(obj['$b'])
+        return {k: _decode(v) for k, v in obj.items()}
+    return obj
+
+def dumps(msg):
+    return (json.dumps(_encode(msg), separators=(',', ':')) + '\n').encode()
+
+def loads(line):
+    return _decode(json.loads(line))
+
+class _Request:
+    __slots__ = ('op', 'args', 'future', 'loop', 'result', 'error')
+
+    def __init__(self, op, args, future, loop):
+        self.op, self.args, self.future, self.loop = op, args, future, loop
+        self.result = self.error = None
+
+def _resolve(req):
+    if not req.future.done():
+        req.future.set_result(req)
+
+class Broker:
+    """
+    Owns one DB. Connection handlers (asyncio) hand requests to a writer thread,
+    which drains whatever arrived within `window` seconds (at most `max_batch`)
+    and runs it as one transaction.
+    """
+    def __init__(self, db_path=None, window=0.002, max_batch=512, token=None):
+        self.db = DB(db_path)
+        # TCP clients must send {"op": "auth", "token": ...} first when this is set
+        self.token = token
+        self.window = window
+        self.max_batch = max_batch
+        self.pending = queue.Queue()
+        self.readers = ThreadPoolExecutor(max_workers=4, thread_name_prefix='queuectl-broker-read')
+        self.commits = 0
+        self.requests = 0
+        self.clients = {}
+
+    def _call(self, op, args):
+        if op == 'enqueue_many':
+            rejected = []
+            coalesced = []
+            inserted, _ = self.db.enqueue_many(args['jobs'], chunk_size=len(args['jobs']) or 1,
+                                               on_reject=lambda job, err: rejected.append([job, err]),
+                                               on_coalesce=lambda job, held: coalesced.append([job, held]))
+            return [inserted, rejected, coalesced]
+        return getattr(self.db, op)(*args.get('args', ()), **args.get('kwargs', {}))
+
+    def _commit_loop(self):
+        while True:
+            batch = [self.pending.get()]
+            if batch[0] is None:
+                return
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                try:
+                    req = self.pending.get(timeout=remaining) if remaining > 0 else self.pending.get_nowait()
+                except queue.Empty:
+                    break
+                if req is None:
+                    self.pending.put(None)
+                    break
+                batch.append(req)
+            try:
+                with self.db._tx():
+                    for req in batch:
+                        try:
+                            with self.db._tx():
+                                req.result = self._call(req.op, req.args)
+                        except Exception as e:
+                            req.error = e
+            except Exception as e:
+                for req in batch:
+                    req.error = req.error or e
+            self.commits += 1
+            self.requests += len(batch)
+            for req in batch:
+                try:
+                    req.loop.call_soon_threadsafe(_resolve, req)
+                except RuntimeError:
+                    # the event loop already shut down; nobody is waiting for the reply
+                    pass
+
+    async def _handle(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        self.clients[writer] = asyncio.current_task()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    return
+                try:
+                    msg = loads(line)
+                    op = msg['op']
+                    args = msg.get('args') or {}
+                    if op == 'ping':
+                        reply = {'ok': True, 'result': {'commits': self.commits, 'requests': self.requests}}
+                    elif op in WRITE_OPS:
+                        req = _Request(op, args, loop.create_future(), loop)
+                        self.pending.put(req)
+                        await req.future
+                        if req.error is not None:
+                            raise req.error
+                        reply = {'ok': True, 'result': req.result}
+                    elif op in READ_OPS:
+                        result = await loop.run_in_executor(self.readers, lambda: self._call(op, args))
+                        reply = {'ok': True, 'result': result}
+                    else:
+                        raise ValueError(f'unknown op {op!r}')
+                except Exception as e:
+                    reply = {'ok': False, 'type': type(e).__name__, 'error': str(e)}
+                writer.write(dumps(reply))
+                await writer.drain()
+        except (ConnectionResetError, BrokenPipeError):
+            pass
+        finally:
+            self.clients.pop(writer, None)
+            writer.close()
+
+    async def _handle_tcp(self, reader, writer):
+        if self.token is not None:
+            try:
+                msg = loads(await asyncio.wait_for(reader.readline(), AUTH_TIMEOUT))
+                given = str(msg.get('token') or '') if msg.get('op') == 'auth' else ''
+            except Exception:
+                given = ''
+            if not hmac.compare_digest(given.encode(), self.token.encode()):
+                try:
+                    writer.write(dumps({'ok': False, 'type': 'PermissionError', 'error': 'bad or missing broker token'}))
+                    await writer.drain()
+                except (ConnectionResetError, BrokenPipeError):
+                    pass
+                writer.close()
+                return
+            writer.write(dumps({'ok': True, 'result': None}))
+            await writer.drain()
+        await self._handle(reader, writer)
+
+    async def serve(self, unix_path=None, tcp=None, stop=None):
+        """Serve until `stop` (an asyncio.Event) is set."""
+        committer = threading.Thread(target=self._commit_loop, name='queuectl-broker-commit', daemon=True)
+        committer.start()
+        servers = []
+        if unix_path:
+            os.makedirs(os.path.dirname(unix_path), exist_ok=True)
+            if os.path.exists(unix_path):
+                os.unlink(unix_path)
+            servers.append(await asyncio.start_unix_server(self._handle, path=unix_path))
+        if tcp:
+            servers.append(await asyncio.start_server(self._handle_tcp, host=tcp[0], port=tcp[1]))
+        try:
+            await (stop or asyncio.Event()).wait()
+        finally:
+            for s in servers:
+                s.close()
+            # clients keep their connection open and wait_closed() waits for them (3.12+);
+            # closing the transport ends their readline(); only a handler stuck on a
+            # write that will never commit has to be cancelled
+            handlers = list(self.clients.values())
+            for w in list(self.clients):
+                w.close()
+            if handlers:
+                _, stuck = await asyncio.wait(handlers, timeout=1.0)
+                for task in stuck:
+                    task.cancel()
+                await asyncio.gather(*handlers, return_exceptions=True)
+            for s in servers:
+                await s.wait_closed()
+            if unix_path and os.path.exists(unix_path):
+                os.unlink(unix_path)
+            self.pending.put(None)
+            committer.join()
+            self.readers.shutdown(wait=True)
+
+def is_loopback(host):
+    """Whether a TCP bind address only accepts connections from this machine."""
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+def broker_alive(address):
+    kind, addr = address
+    s = socket.socket(socket.AF_UNIX if kind == 'unix' else socket.AF_INET, socket.SOCK_STREAM)
+    s.settimeout(1)
+    try:
+        s.connect(addr)
+        return True
+    except OSError:
+        return False
+    finally:
+        s.close()
+
+class BrokerLost(ConnectionError):
+    """The broker went away after a request was sent, so whether it was applied is unknown."""
+
+class BrokerDB(DB):
+    """
+    A DB whose writes go through the broker at `address` while it is reachable,
+    falling back to direct SQLite otherwise. Remote clients (`remote=True`, no local
+    database file) send reads to the broker as well and have no fallback.
+    """
+    RETRY_AFTER = 1.0
+    # a broker that does not answer within this long is treated as gone
+    TIMEOUT = 30.0
+
+    def __init__(self, address, path=None, remote=False):
+        self.address = address
+        self.remote = remote
+        self._broker = threading.local()
+        self._down_until = 0
+        if remote:
+            self.path = f'{address[0]}://{address[1]}'
+            self._local = threading.local()
+            self.metrics = None
+        else:
+            super().__init__(path)
+
+    def _conn(self):
+        if self.remote:
+            raise sqlite3.OperationalError('not available through a remote broker')
+        return super()._conn()
+
+    def _sock(self):
+        b = self._broker
+        if getattr(b, 'file', None) is not None and b.pid == os.getpid():
+            # an idle connection only turns readable when the broker closed it
+            if not select.select([b.sock], [], [], 0)[0]:
+                return b.file
+            self._drop()
+        kind, addr = self.address
+        if kind == 'unix' and not os.path.exists(addr):
+            raise FileNotFoundError(addr)
+        s = socket.socket(socket.AF_UNIX if kind == 'unix' else socket.AF_INET, socket.SOCK_STREAM)
+        s.settimeout(self.TIMEOUT)
+        try:
+            s.connect(addr)
+        except OSError:
+            s.close()
+            raise
+        f = s.makefile('rwb')
+        token = os.environ.get(TOKEN_ENV)
+        if kind == 'tcp' and token:
+            f.write(dumps({'op': 'auth', 'token': token}))
+            f.flush()
+            reply = loads(f.readline() or b'{"ok": false, "error": "broker closed the connection"}')
+            if not reply['ok']:
+                f.close()
+                s.close()
+                raise PermissionError(f"broker refused the connection: {reply['error']}")
+        b.sock, b.file, b.pid = s, f, os.getpid()
+        return b.file
+
+    def _drop(self):
+        b = self._broker
+        if getattr(b, 'file', None) is not None and b.pid == os.getpid():
+            try:
+                b.file.close()
+                b.sock.close()
+            except OSError:
+                pass
+        b.file = None
+
+    def _request(self, op, args):
+        # failing to connect is safe to fall back from; once the request is sent the
+        # broker may have committed it, so losing the reply raises BrokerLost instead
+        f = self._sock()
+        try:
+            f.write(dumps({'op': op, 'args': args}))
+            f.flush()
+            line = f.readline()
+        except OSError as e:
+            self._drop()
+            raise BrokerLost(f'lost the broker during {op}; it may or may not have been applied: {e}') from e
+        if not line:
+            self._drop()
+            raise BrokerLost(f'broker closed the connection during {op}; it may or may not have been applied')
+        reply = loads(line)
+        if not reply['ok']:
+            raise _ERRORS.get(reply['type'], RuntimeError)(reply['error'])
+        return reply['result']
+
+    def _forward(self, op, fallback, args=(), kwargs=None):
+        if not self.remote and time.monotonic() < self._down_until:
+            return fallback(*args, **(kwargs or {}))
+        try:
+            return self._request(op, {'args': list(args), 'kwargs': kwargs or {}})
+        except OSError as e:
+            # a write the broker may already have committed must not run a second time here
+            if self.remote or (isinstance(e, BrokerLost) and op not in READ_OPS):
+                raise
+            self._drop()
+            self._down_until = time.monotonic() + self.RETRY_AFTER
+            return fallback(*args, **(kwargs or {}))
+
+    def ping(self):
+        """Broker counters, or None when no broker is reachable."""
+        try:
+            return self._request('ping', {})
+        except OSError:
+            self._drop()
+            return None
+
+    def enqueue_many(self, jobs, chunk_size=1000, on_chunk=None, on_reject=None, on_coalesce=None):
+        if not self.remote and (time.monotonic() < self._down_until or not os.path.exists(self.address[1])):
+            return super().enqueue_many(jobs, chunk_size, on_chunk, on_reject, on_coalesce)
+        chunk_size = max(1, int(chunk_size))
+        inserted = rejected = 0
+        it = iter(jobs)
+        while True:
+            chunk = []
+            for job in it:
+                chunk.append(job)
+                if len(chunk) >= chunk_size:
+                    break
+            if not chunk:
+                return inserted, rejected
+            start = time.time()
+            try:
+                done, bad, merged = self._request('enqueue_many', {'jobs': chunk})
+            except BrokerLost:
+                raise
+            except OSError:
+                self._drop()
+                if self.remote:
+                    raise
+                self._down_until = time.monotonic() + self.RETRY_AFTER
+                done, more = super().enqueue_many(chunk, chunk_size, None, on_reject, on_coalesce)
+                bad = [None] * more
+            else:
+                for job, err in bad:
+                    if on_reject:
+                        on_reject(job, err)
+                for job, held in merged:
+                    if on_coalesce:
+                        on_coalesce(job, held)
+            inserted += done
+            rejected += len(bad)
+            if on_chunk:
+                on_chunk(done, time.time() - start)
+
+def _forwarder(op, remote_only=False):
+    def method(self, *args, **kwargs):
+        fallback = getattr(DB, op).__get__(self)
+        if remote_only and not self.remote:
+            return fallback(*args, **kwargs)
+        return self._forward(op, fallback, args, kwargs)
+    method.__name__ = op
+    method.__doc__ = getattr(DB, op).__doc__
+    return method
+
+for _op in WRITE_OPS:
+    if _op != 'enqueue_many':
+        setattr(BrokerDB, _op, _forwarder(_op))
+for _op in READ_OPS:
+    setattr(BrokerDB, _op, _forwarder(_op, remote_only=True))
+
+def open_db(path=None):
+    """
+    The DB for CLI commands and workers. QUEUECTL_BROKER=off uses SQLite directly,
+    QUEUECTL_BROKER=tcp://host:port (or a socket path) talks to that broker only;
+    by default the local broker is used whenever `queuectl serve` is running.
+    A database configured with `shards` > 1 is opened as a ShardedDB instead:
+    each shard has its own write lock, so there is nothing for a broker to merge.
+    """
+    spec = os.environ.get('QUEUECTL_BROKER', '')
+    if spec == 'off':
+        db = DB(path)
+    elif spec:
+        address = parse_address(spec)
+        db = BrokerDB(address, path, remote=address[0] == 'tcp')
+        if db.remote:
+            return db
+    else:
+        db_path = path or os.path.join(os.getcwd(), 'queuectl.db')
+        db = BrokerDB(('unix', socket_path(db_path)), db_path)
+    shards = int(db.get_config('shards') or 1)
+    # shard files left from a larger setting keep being served until drained
+    if shards > 1 or os.path.exists(shard_path(db.path, 1)):
+        return ShardedDB(db.path, shards)
+    return db
@@ -1,75 +1,576 @@
 import argparse
+import csv
 import json
 import os
-from .db import DB
+import sqlite3
+import sys
+import time
+import uuid
+from datetime import datetime, timezone
+from .db import DEFAULT_CONFIG, parse_duration, parse_rate, parse_time
+from .broker import Broker, open_db, parse_address, socket_path, broker_alive, is_loopback, TOKEN_ENV
+from .shards import ShardedDB
+from .archive import open_archive
 from .manager import WorkerManager
+from .resources import this_node
+from .worker import parse_queues
 
-PID_FILE = os.path.join(os.getcwd(), 'queuectl_workers.pid')
+def _iter_jsonl(fh, on_bad):
+    """Yield one job per non-blank line of `fh`; unparseable lines go to `on_bad(lineno, line)`."""
+    for lineno, line in enumerate(fh, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            on_bad(lineno, line)
+
+def _job_defaults(args):
+    """Fields applied to every enqueued job that does not set them itself."""
+    defaults = {}
+    if args.queue is not None:
+        defaults['queue'] = args.queue
+    if args.priority is not None:
+        defaults['priority'] = args.priority
+    if args.run_at is not None:
+        defaults['run_at'] = args.run_at
+    if args.delay is not None:
+        defaults['delay'] = args.delay
+    if args.dedup_ttl is not None:
+        defaults['dedup_ttl'] = args.dedup_ttl
+    if args.concurrency_key is not None:
+        defaults['concurrency_key'] = args.concurrency_key
+    if args.cpu is not None:
+        defaults['cpu'] = args.cpu
+    if args.mem_mb is not None:
+        defaults['mem_mb'] = args.mem_mb
+    if args.depends_on is not None:
+        defaults['depends_on'] = [d.strip() for d in args.depends_on.split(',') if d.strip()]
+    return defaults
+
+TIMING = ('run_at', 'delay')
+
+def _apply_defaults(job, defaults):
+    if isinstance(job, dict):
+        timed = any(k in job for k in TIMING)
+        for k, v in defaults.items():
+            if not (timed and k in TIMING):
+                job.setdefault(k, v)
+    return job
+
+def _enqueue_stream(db, fh, chunk_size, defaults=None):
+    chunks = [0]
+    bad = [0]
+    coalesced = [0]
+
+    def on_bad(lineno, line):
+        bad[0] += 1
+        print(f'rejected line {lineno}: invalid JSON', file=sys.stderr)
+
+    def on_reject(job, err):
+        ident = job.get('id') if isinstance(job, dict) else None
+        print(f'rejected job {ident or repr(job)}: {err}', file=sys.stderr)
+
+    def on_coalesce(job, held):
+        coalesced[0] += 1
+
+    def on_chunk(n, elapsed):
+        chunks[0] += 1
+        rate = n / elapsed if elapsed > 0 else float('inf')
+        print(f'chunk {chunks[0]}: {n} jobs in {elapsed:.3f}s ({rate:.0f} jobs/s)')
+
+    start = time.time()
+    jobs = (_apply_defaults(job, defaults or {}) for job in _iter_jsonl(fh, on_bad))
+    inserted, rejected = db.enqueue_many(jobs, chunk_size=chunk_size, on_chunk=on_chunk, on_reject=on_reject,
+                                         on_coalesce=on_coalesce)
+    elapsed = time.time() - start
+    note = f'; coalesced {coalesced[0]} duplicate(s)' if coalesced[0] else ''
+    print(f'enqueued {inserted} job(s) in {elapsed:.2f}s; rejected {rejected + bad[0]}{note}')
 
 def cmd_enqueue(args):
-    db = DB()
+    db = open_db()
+    defaults = _job_defaults(args)
+    if args.file or args.stdin:
+        if args.stdin:
+            _enqueue_stream(db, sys.stdin, args.chunk_size, defaults)
+        else:
+            try:
+                fh = open(args.file)
+            except OSError as e:
+                print('error:', e)
+                return
+            with fh:
+                _enqueue_stream(db, fh, args.chunk_size, defaults)
+        return
+    if not args.job_json:
+        print('Provide a job JSON, --file or --stdin')
+        return
     try:
         job = json.loads(args.job_json)
     except Exception:
         print('Invalid JSON for job')
         return
-    job_id = db.enqueue(job)
+    job = _apply_defaults(job, defaults)
+    if isinstance(job, dict) and job.get('dedup_key') is not None and not job.get('id'):
+        # name the job here, so a returned id that differs means it was coalesced
+        job['id'] = str(uuid.uuid4())
+    try:
+        job_id = db.enqueue(job)
+    except ValueError as e:
+        print('error:', e)
+        return
+    except sqlite3.IntegrityError:
+        print(f'error: job {job.get("id")} already exists')
+        return
+    if isinstance(job, dict) and job.get('id') and job_id != job['id']:
+        print(f'coalesced into {job_id} (dedup_key {job["dedup_key"]!r})')
+        return
     print(f'enqueued {job_id}')
 
 def cmd_worker_start(args):
+    try:
+        queues = parse_queues(args.queues)
+    except ValueError as e:
+        print('error:', e)
+        return
+    lo = args.min if args.min is not None else args.count
+    hi = args.max if args.max is not None else max(lo, args.count)
+    if lo > hi:
+        print('error: --min must not exceed --max')
+        return
+    if args.node:
+        # inherited by the worker processes, which reserve job resources under this name
+        os.environ['QUEUECTL_NODE'] = args.node
     mgr = WorkerManager()
-    mgr.start(args.count)
-    print('Workers started in current process. To stop from another terminal: ./bin/queuectl worker stop')
+    print('Supervising workers in this process. To stop from another terminal: ./bin/queuectl worker stop')
+    mgr.supervise(lo, hi, prefetch=args.prefetch, mode=args.mode, concurrency=args.concurrency, queues=queues or None)
 
 def cmd_worker_stop(args):
     mgr = WorkerManager()
-    mgr.stop()
-    print('Stop signal sent to workers (they will exit after current job)')
+    sent = mgr.stop()
+    if not sent:
+        print('No running workers found on this host')
+        return
+    print(f'Stop signal sent to {sent} process(es) (workers exit after their current job)')
 
-def cmd_status(args):
-    db = DB()
+STATES = ('pending', 'blocked', 'processing', 'completed', 'failed', 'dead')
+
+def _print_status(db):
     counts = db.get_status_counts()
     print('Job counts by state:')
-    for s in ('pending','processing','completed','failed','dead'):
+    for s in STATES:
         print(f'  {s}: {counts.get(s,0)}')
-    if os.path.exists(PID_FILE):
-        try:
-            pids = json.loads(open(PID_FILE).read())
-            live = []
-            for pid in pids:
-                try:
-                    os.kill(pid, 0)
-                    live.append(pid)
-                except Exception:
-                    pass
-            print(f'Active worker pids: {live}')
-        except Exception:
-            print('Active worker pids: (error reading pid file)')
-    else:
-        print('Active worker pids: none')
+    by_queue = db.get_queue_stats()
+    if len(by_queue) > 1:
+        print('By queue:')
+        for q, qc in by_queue.items():
+            print(f'  {q}: ' + ', '.join(f'{s}={qc[s]}' for s in STATES if qc.get(s)))
+    usage = db.node_usage()
+    if usage:
+        here, cores, total_mb = this_node()
+        node_cpu, node_mem_mb = db.get_config('node_cpu'), db.get_config('node_mem_mb')
+        print('Reserved by running jobs:')
+        for node, (cpu_milli, mem_mb) in usage.items():
+            if node_cpu or node == here:
+                print(f'  {node}: {cpu_milli / 1000:g}/{float(node_cpu or cores):g} cores, {mem_mb}/{node_mem_mb or total_mb} MB')
+            else:
+                print(f'  {node}: {cpu_milli / 1000:g} cores, {mem_mb} MB')
+    if hasattr(db, 'shards'):
+        print(f'Shards: {len(db.shards)} (routed by {db.shard_by})')
+    broker = db.ping() if hasattr(db, 'ping') else None
+    if broker:
+        print(f'Broker: running ({broker["requests"]} requests in {broker["commits"]} commits)')
+    lease_ttl = float(db.get_config('lease_ttl') or DEFAULT_CONFIG['lease_ttl'])
+    workers = [w for w in db.list_workers() if w['last_seen'] >= time.time() - lease_ttl]
+    print(f'Active workers: {sum(1 for w in workers if w["mode"] != "supervisor")}')
+    for w in workers:
+        note = f' (supervisor {w["supervisor"]})' if w['supervisor'] else ''
+        print(f'  {w["id"]} {w["mode"]} {w["state"]}{note}')
+
+def cmd_status(args):
+    db = open_db()
+    if args.verify:
+        diffs = db.verify_status_counts(repair=True)
+        for q, st, stored, actual in diffs:
+            print(f'repaired {q}/{st}: counter={stored} actual={actual}')
+        print('counters ok' if not diffs else f'repaired {len(diffs)} counter(s)')
+        return
+    if args.watch is None:
+        _print_status(db)
+        return
+    seen = None
+    try:
+        while True:
+            # only redraw when another connection has committed something
+            version = db.data_version()
+            if version != seen:
+                seen = version
+                print('\033[H\033[2J', end='')
+                print(time.strftime('%Y-%m-%d %H:%M:%S'))
+                _print_status(db)
+            time.sleep(args.watch)
+    except KeyboardInterrupt:
+        pass
+
+def _stream_jobs(db, args, state):
+    """Write matching jobs to stdout as JSONL or CSV, one batch at a time."""
+    try:
+        fields = [f.strip() for f in args.fields.split(',') if f.strip()] if args.fields else None
+        jobs = db.iter_jobs(state=state, queue=args.queue, error=args.error, fields=fields, limit=args.limit, after=args.after,
+                            since=parse_time(args.since) if args.since else None,
+                            until=parse_time(args.until) if args.until else None)
+        writer = None
+        cursor = None
+        count = 0
+        for cursor, row in jobs:
+            if args.format == 'csv':
+                if writer is None:
+                    writer = csv.DictWriter(sys.stdout, fieldnames=list(row))
+                    writer.writeheader()
+                writer.writerow(row)
+            else:
+                sys.stdout.write(json.dumps(row) + '\n')
+            count += 1
+    except ValueError as e:
+        print('error:', e)
+        return
+    if args.limit is not None and count == args.limit and cursor:
+        print(f'next page: --after {cursor}', file=sys.stderr)
 
 def cmd_list(args):
-    db = DB()
-    rows = db.list_jobs(state=args.state)
-    for r in rows:
-        print(json.dumps(r))
+    _stream_jobs(open_db(), args, args.state)
 
 def cmd_dlq_list(args):
-    db = DB()
-    rows = db.list_jobs(state='dead')
-    for r in rows:
-        print(json.dumps(r))
+    _stream_jobs(open_db(), args, 'dead')
+
+def _add_listing_args(p):
+    p.add_argument('--queue', default=None)
+    p.add_argument('--since', default=None,
+                   help='enqueued (for dead jobs: died) at or after: epoch, ISO time, or a duration ago (e.g. 2h)')
+    p.add_argument('--until', default=None, help='enqueued (for dead jobs: died) before: epoch, ISO time, or a duration ago')
+    p.add_argument('--error', default=None, help='substring of last_error')
+    p.add_argument('--fields', default=None, help='comma-separated columns to read, e.g. id,state,attempts')
+    p.add_argument('--limit', type=int, default=None)
+    p.add_argument('--after', default=None, help='resume after this cursor (printed on stderr when --limit is hit)')
+    p.add_argument('--format', choices=('jsonl', 'csv'), default='jsonl')
+
+def _dlq_filters(args):
+    """Filter kwargs for the bulk dlq commands, or None (after saying why) if none were given."""
+    filters = dict(queue=args.queue, error=args.error, limit=args.limit,
+                   since=parse_time(args.since) if args.since else None,
+                   until=parse_time(args.until) if args.until else None)
+    if not args.all and all(v is None for v in filters.values()):
+        print('error: give filters (--error, --queue, --since, --until, --limit) or --all')
+        return None
+    return filters
+
+def _add_dlq_filter_args(p):
+    p.add_argument('--all', action='store_true', help='every dead job (unless narrowed by the filters)')
+    p.add_argument('--queue', default=None)
+    p.add_argument('--error', default=None, help="substring of last_error, e.g. 'exit=137'")
+    p.add_argument('--since', default=None, help='died at or after: epoch, ISO time, or a duration ago (e.g. 2h)')
+    p.add_argument('--until', default=None, help='died before: epoch, ISO time, or a duration ago')
+    p.add_argument('--limit', type=int, default=None, help='at most this many jobs, oldest first')
+    p.add_argument('--batch-size', type=int, default=1000, help='jobs per transaction')
 
 def cmd_dlq_retry(args):
-    db = DB()
-    ok, msg = db.dlq_retry(args.job_id)
-    if ok:
-        print('job moved back to pending')
+    db = open_db()
+    if args.job_id:
+        ok, msg = db.dlq_retry(args.job_id)
+        if ok:
+            job = db.get_job(args.job_id)
+            print(f"job moved back to {job['state'] if job else 'pending'}")
+        else:
+            print('error:', msg)
+        return
+    try:
+        filters = _dlq_filters(args)
+        if filters is None:
+            return
+        stagger = parse_duration(args.stagger) if args.stagger else 0
+    except ValueError as e:
+        print('error:', e)
+        return
+    n = db.dlq_retry_many(stagger=stagger, batch_size=args.batch_size, **filters)
+    print(f'requeued {n} job(s)' + (f' over {args.stagger}' if stagger and n else ''))
+
+def cmd_dlq_purge(args):
+    db = open_db()
+    try:
+        filters = _dlq_filters(args)
+    except ValueError as e:
+        print('error:', e)
+        return
+    if filters is None:
+        return
+    print(f'purged {db.dlq_purge(batch_size=args.batch_size, **filters)} job(s)')
+
+def cmd_dlq_summary(args):
+    groups = open_db().dlq_summary(limit=args.limit)
+    if not groups:
+        print('DLQ is empty')
+        return
+    print(f"{'count':>8}  {'last error':<24}  command")
+    for g in groups:
+        print(f"{g['count']:>8}  {str(g['last_error']):<24}  {g['command']}")
+
+def cmd_logs(args):
+    db = open_db()
+    job = db.get_job(args.job_id)
+    if job is None:
+        print(f'error: no job {args.job_id}')
+        return
+    running = job['state'] == 'processing'
+    attempt = job['attempts'] + 1 if running else db.output_attempt(args.job_id)
+    if attempt is None:
+        return
+    seq = 0
+    while True:
+        chunks = db.read_output(args.job_id, after_seq=seq, attempt=attempt)
+        for seq, stream, data in chunks:
+            if args.stream in (None, stream):
+                out = sys.stderr if stream == 'stderr' else sys.stdout
+                out.buffer.write(data)
+                out.flush()
+        if chunks:
+            continue
+        if not (args.follow and running):
+            return
+        job = db.get_job(args.job_id)
+        if job is None or job['state'] != 'processing' or job['attempts'] + 1 != attempt:
+            # the attempt is over; one more pass picks up the tail written with its result
+            running = False
+            continue
+        time.sleep(0.5)
+
+def _graph_label(job_id, state, pending_deps):
+    if state is None:
+        return f'{job_id} [gone]'
+    if state == 'blocked':
+        return f'{job_id} [blocked on {pending_deps}]'
+    return f'{job_id} [{state}]'
+
+def _print_tree(edges, root, near, far, prefix, seen):
+    for e in edges.get(root, ()):
+        node = e[far]
+        again = node in seen
+        print(f"{prefix}{_graph_label(node, e['state'], e['pending_deps'])}" + (' ...' if again and edges.get(node) else ''))
+        if not again:
+            seen.add(node)
+            _print_tree(edges, node, near, far, prefix + '  ', seen)
+
+def cmd_graph(args):
+    db = open_db()
+    job = db.get_job(args.job_id)
+    if job is None:
+        print(f'error: no job {args.job_id}')
+        return
+    graph = db.job_graph(args.job_id, depth=args.depth)
+    print(_graph_label(job['id'], job['state'], job.get('pending_deps')))
+    for name, near, far, title in (('up', 'child', 'parent', 'waits on:'), ('down', 'parent', 'child', 'needed by:')):
+        edges = {}
+        for e in graph[name]:
+            edges.setdefault(e[near], []).append(e)
+        if edges:
+            print(f'  {title}')
+            _print_tree(edges, job['id'], near, far, '    ', {job['id']})
+
+def cmd_gc(args):
+    db = open_db()
+    if args.states or args.max_age or args.keep is not None:
+        rule = {}
+        if args.max_age:
+            rule['max_age'] = args.max_age
+        if args.keep is not None:
+            rule['keep'] = args.keep
+        if not rule:
+            print('error: give --max-age and/or --keep with --states')
+            return
+        states = [s for s in (args.states or 'completed,dead').split(',') if s]
+        policy = {s: rule for s in states}
+    else:
+        policy = db.get_config('gc_policy') or {}
+    if not policy:
+        print('error: no retention policy (set gc_policy or pass --max-age/--keep)')
+        return
+    try:
+        for rule in policy.values():
+            if rule.get('max_age') is not None:
+                parse_duration(rule['max_age'])
+    except ValueError as e:
+        print('error:', e)
+        return
+    archive = open_archive(args.archive) if args.archive else None
+    start = time.time()
+    try:
+        removed = db.run_retention(policy, archive=archive, batch_size=args.batch_size)
+    except ValueError as e:
+        print('error:', e)
+        return
+    verb = f'archived to {args.archive} and removed' if archive else 'removed'
+    for state, n in removed.items():
+        print(f'{verb} {n} {state} job(s)')
+    free, (busy, wal_frames, ckpt_frames) = db.compact(vacuum_pages=args.vacuum_pages, checkpoint=args.checkpoint)
+    print(f'wal checkpoint: {ckpt_frames}/{wal_frames} frames' + (' (busy)' if busy else '') + f'; free pages left: {free}')
+    if args.full_vacuum:
+        db.vacuum()
+        print('vacuumed')
+    print(f'done in {time.time() - start:.2f}s')
+
+def cmd_bench(args):
+    from .bench import run_benchmarks, parse_count
+    scenarios = [x.strip() for x in args.scenarios.split(',') if x.strip()]
+    backlogs = [parse_count(x) for x in args.backlog.split(',') if x.strip()]
+    workers = [int(x) for x in args.workers.split(',') if x.strip()]
+    shards = [int(x) for x in args.shards.split(',') if x.strip()]
+    report = run_benchmarks(scenarios, backlogs, workers, jobs=args.jobs, claims=args.claims, prefetch=args.prefetch,
+                            base_dir=args.dir, on_result=lambda r: print(json.dumps(r), file=sys.stderr), shards=shards)
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text + '\n')
+        print(f"wrote {len(report['results'])} result(s) to {args.out}", file=sys.stderr)
+    else:
+        print(text)
+
+def cmd_metrics(args):
+    from .metrics import to_json, to_prometheus, RATE_WINDOW
+    db = open_db()
+    if args.reset:
+        db.reset_metrics()
+        print('metrics reset')
+        return
+    rows = db.get_metrics(args.worker)
+    if args.format == 'json':
+        # cluster throughput comes from the jobs table, so it is only known for all workers
+        completed = None if args.worker else db.count_completed_since(time.time() - RATE_WINDOW)
+        print(to_json(rows, completed))
+    else:
+        sys.stdout.write(to_prometheus(rows))
+
+def cmd_serve(args):
+    import asyncio
+    import signal
+    db_path = os.path.join(os.getcwd(), 'queuectl.db')
+    path = socket_path(db_path)
+    if broker_alive(('unix', path)):
+        print(f'error: a broker is already serving {db_path}')
+        return
+    if isinstance(open_db(db_path), ShardedDB):
+        print('error: the database is sharded (shards > 1); workers already write to each shard directly')
+        return
+    tcp = parse_address(f'tcp://{args.tcp}')[1] if args.tcp else None
+    token = os.environ.get(TOKEN_ENV) or None
+    if tcp and token is None and not is_loopback(tcp[0]) and not args.insecure:
+        print(f'error: refusing to serve TCP on {args.tcp} without {TOKEN_ENV}: anyone who can connect could make '
+              'the workers run any command. Set a token (and the same one on the workers) or pass --insecure')
+        return
+    broker = Broker(db_path, window=args.window_ms / 1000.0, max_batch=args.max_batch, token=token)
+
+    async def main():
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGINT, stop.set)
+        loop.add_signal_handler(signal.SIGTERM, stop.set)
+        print(f'broker serving {db_path} on {path}' + (f' and tcp {args.tcp}' if tcp else '')
+              + (' (token required)' if tcp and token else ''))
+        await broker.serve(path, tcp, stop)
+
+    asyncio.run(main())
+    print(f'broker stopped after {broker.requests} request(s) in {broker.commits} commit(s)')
+
+def _ts(value):
+    return datetime.fromtimestamp(value, timezone.utc).isoformat(timespec='seconds') if value else '-'
+
+def cmd_limit_set(args):
+    try:
+        rate = None if args.rate is None else parse_rate(args.rate)
+        open_db().set_key_limit(args.key, args.max_in_flight, rate, args.burst)
+    except ValueError as e:
+        print('error:', e)
+        return
+    print(f'limit on {args.key} set')
+
+def cmd_limit_list(args):
+    rows = open_db().list_key_limits()
+    if not rows:
+        print('No limits')
+        return
+    for r in rows:
+        parts = [f"in_flight={r['in_flight']}" + (f"/{r['max_in_flight']}" if r['max_in_flight'] is not None else '')]
+        if r['rate']:
+            parts.append(f"rate={r['rate']:g}/s burst={r['burst']:g} tokens={r['tokens']:.1f}")
+        print(f"{r['key']}  " + '  '.join(parts))
+
+def cmd_limit_remove(args):
+    if open_db().remove_key_limit(args.key):
+        print(f'limit on {args.key} removed')
+    else:
+        print(f'error: no limit on {args.key}')
+
+def cmd_schedule_add(args):
+    from .scheduler import Cron
+    db = open_db()
+    try:
+        job = json.loads(args.job_json)
+    except ValueError:
+        print('Invalid JSON for job')
+        return
+    if not isinstance(job, dict):
+        print('error: job must be a JSON object')
+        return
+    name = args.name or job.get('id') or f'sched-{uuid.uuid4().hex[:8]}'
+    job.pop('id', None)
+    try:
+        next_run = Cron(args.cron).next(time.time())
+        db.add_schedule(name, args.cron, job, next_run)
+    except ValueError as e:
+        print('error:', e)
+        return
+    print(f'schedule {name} added; next run {_ts(next_run)}')
+
+def cmd_schedule_list(args):
+    rows = open_db().list_schedules()
+    if not rows:
+        print('No schedules')
+        return
+    for s in rows:
+        print(f"{s['name']}  {s['cron']!r}  next={_ts(s['next_run'])}  last={_ts(s['last_run'])}  {json.dumps(s['job'])}")
+
+def cmd_schedule_remove(args):
+    if open_db().remove_schedule(args.name):
+        print(f'schedule {args.name} removed')
     else:
-        print('error:', msg)
+        print(f'error: no schedule {args.name}')
+
+def cmd_scheduler_run(args):
+    import signal
+    import threading
+    from .scheduler import Scheduler
+    scheduler = Scheduler(open_db(), max_batch=args.max_batch)
+    if args.once:
+        fired = scheduler.tick()
+        for name, job_id, skipped in fired:
+            print(f'{name} -> {job_id}' + (f' (skipped {skipped} missed tick(s))' if skipped else ''))
+        print(f'fired {len(fired)} schedule(s)')
+        return
+    stop = threading.Event()
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    print('[scheduler] running; Ctrl-C to stop')
+    scheduler.run(stop)
+    print('[scheduler] stopped')
+
+def cmd_reap(args):
+    db = open_db()
+    reaped = db.reap_expired_leases()
+    print(f"recovered {len(reaped)} job(s) with expired leases")
+    for job_id in reaped:
+        print(f"  {job_id}")
 
 def cmd_config_set(args):
-    db = DB()
+    db = open_db()
     key = args.key
     val = args.value
     try:
@@ -80,7 +581,7 @@ def cmd_config_set(args):
     print('config set')
 
 def cmd_config_get(args):
-    db = DB()
+    db = open_db()
     val = db.get_config(args.key)
     print(json.dumps(val, indent=2))
 
@@ -89,31 +590,154 @@ def main():
     sub = parser.add_subparsers(dest='cmd')
 
     e = sub.add_parser('enqueue')
-    e.add_argument('job_json')
+    e.add_argument('job_json', nargs='?')
+    e.add_argument('--file', default=None, help='enqueue every line of a JSONL file')
+    e.add_argument('--stdin', action='store_true', help='enqueue JSONL read from stdin')
+    e.add_argument('--chunk-size', type=int, default=1000)
+    e.add_argument('--queue', default=None, help='queue for jobs that do not name one')
+    e.add_argument('--priority', type=int, default=None, help='priority for jobs that do not set one (higher runs first)')
+    when = e.add_mutually_exclusive_group()
+    when.add_argument('--run-at', default=None, help='do not run before this time (epoch or ISO-8601, UTC unless given)')
+    when.add_argument('--delay', default=None, help='do not run before this long from now, e.g. 90s, 15m, 2h')
+    e.add_argument('--concurrency-key', default=None, help='key whose limits (see `limit set`) the jobs count against')
+    e.add_argument('--cpu', type=float, default=None, help='cores the jobs need; claimed only while the node has them free')
+    e.add_argument('--mem-mb', type=int, default=None, help='MB of memory the jobs need (and are limited to)')
+    e.add_argument('--depends-on', default=None, metavar='ID[,ID...]', help='run only after these jobs complete')
+    e.add_argument('--dedup-ttl', default=None, help='longest a job holds its dedup_key, e.g. 10m (default: until it finishes)')
     e.set_defaults(func=cmd_enqueue)
 
     w = sub.add_parser('worker')
     wsub = w.add_subparsers(dest='op')
     wstart = wsub.add_parser('start')
-    wstart.add_argument('--count', type=int, default=1)
+    wstart.add_argument('--count', type=int, default=1, help='fixed number of workers (default 1)')
+    wstart.add_argument('--min', type=int, default=None, help='autoscale: never fewer workers than this')
+    wstart.add_argument('--max', type=int, default=None, help='autoscale: never more workers than this')
+    wstart.add_argument('--prefetch', type=int, default=1, help='jobs each worker claims per trip to the DB')
+    wstart.add_argument('--mode', choices=('sync', 'async'), default='sync', help='async runs many jobs per process on asyncio')
+    wstart.add_argument('--concurrency', type=int, default=10, help='jobs in flight per async worker')
+    wstart.add_argument('--queues', default=None, help='queues to serve with optional weights, e.g. "high:3,default"')
+    wstart.add_argument('--node', default=None, help='node name job cpu/mem_mb is reserved under (default: $QUEUECTL_NODE or the hostname)')
     wstart.set_defaults(func=cmd_worker_start)
     wstop = wsub.add_parser('stop')
     wstop.set_defaults(func=cmd_worker_stop)
 
     s = sub.add_parser('status')
+    s.add_argument('--watch', type=float, nargs='?', const=2.0, default=None, metavar='SECONDS', help='refresh every SECONDS (default 2)')
+    s.add_argument('--verify', action='store_true', help='reconcile the counters against a full count')
     s.set_defaults(func=cmd_status)
 
     l = sub.add_parser('list')
     l.add_argument('--state', default=None)
+    _add_listing_args(l)
     l.set_defaults(func=cmd_list)
 
     d = sub.add_parser('dlq')
     dsub = d.add_subparsers(dest='op')
     dlist = dsub.add_parser('list')
+    _add_listing_args(dlist)
     dlist.set_defaults(func=cmd_dlq_list)
-    dretry = dsub.add_parser('retry')
-    dretry.add_argument('job_id')
+    dretry = dsub.add_parser('retry', help='requeue one dead job, or every one matching the filters')
+    dretry.add_argument('job_id', nargs='?')
+    _add_dlq_filter_args(dretry)
+    dretry.add_argument('--stagger', default=None, help='spread the requeued jobs over this long, e.g. 10m')
     dretry.set_defaults(func=cmd_dlq_retry)
+    dpurge = dsub.add_parser('purge', help='delete dead jobs matching the filters')
+    _add_dlq_filter_args(dpurge)
+    dpurge.set_defaults(func=cmd_dlq_purge)
+    dsum = dsub.add_parser('summary', help='dead jobs grouped by error and command prefix')
+    dsum.add_argument('--limit', type=int, default=20, help='largest groups to show')
+    dsum.set_defaults(func=cmd_dlq_summary)
+
+    lg = sub.add_parser('logs')
+    lg.add_argument('job_id')
+    lg.add_argument('--follow', '-f', action='store_true', help='keep reading until the running attempt finishes')
+    lg.add_argument('--stream', choices=('stdout', 'stderr'), default=None)
+    lg.set_defaults(func=cmd_logs)
+
+    gr = sub.add_parser('graph', help='show what a job waits on and what waits on it')
+    gr.add_argument('job_id')
+    gr.add_argument('--depth', type=int, default=5, help='hops to follow each way (default 5)')
+    gr.set_defaults(func=cmd_graph)
+
+    for name in ('gc', 'archive'):
+        g = sub.add_parser(name, help='apply retention (archive requires --archive)')
+        g.add_argument('--states', default=None, help='comma-separated finished states (default completed,dead)')
+        g.add_argument('--max-age', default=None, help='remove jobs finished longer ago than this, e.g. 7d, 12h')
+        g.add_argument('--keep', type=int, default=None, help='keep only the newest N jobs per state')
+        g.add_argument('--archive', default=None, required=(name == 'archive'),
+                       help='copy removed jobs to this SQLite file, or a .jsonl/.jsonl.gz segment')
+        g.add_argument('--batch-size', type=int, default=500)
+        g.add_argument('--vacuum-pages', type=int, default=1000, help='free pages to return to the OS (incremental vacuum)')
+        g.add_argument('--checkpoint', default='PASSIVE', choices=('PASSIVE', 'FULL', 'RESTART', 'TRUNCATE'))
+        g.add_argument('--full-vacuum', action='store_true', help='also run a full VACUUM (exclusive lock)')
+        g.set_defaults(func=cmd_gc)
+
+    b = sub.add_parser('bench', help='measure enqueue, claim and end-to-end throughput; prints JSON')
+    b.add_argument('--scenarios', default='enqueue,claim,e2e,retry,spawn')
+    b.add_argument('--backlog', default='10k', help='comma-separated backlog sizes, e.g. 10k,100k,1M')
+    b.add_argument('--workers', default='1,4,16,64', help='comma-separated worker counts for claim and e2e')
+    b.add_argument('--jobs', type=int, default=500, help='jobs run per e2e/retry/spawn measurement')
+    b.add_argument('--claims', type=int, default=200, help='claims per worker in the claim scenario')
+    b.add_argument('--prefetch', type=int, default=1, help='worker prefetch in the e2e scenario')
+    b.add_argument('--shards', default='1', help='comma-separated shard counts, e.g. 1,4')
+    b.add_argument('--dir', default=None, help='where to create scratch databases (default: system temp dir)')
+    b.add_argument('--out', default=None, help='write the JSON report here instead of stdout')
+    b.set_defaults(func=cmd_bench)
+
+    m = sub.add_parser('metrics', help='worker latency histograms and counters')
+    m.add_argument('--format', choices=('prometheus', 'json'), default='prometheus')
+    m.add_argument('--worker', default=None, help='only this worker (hostname:pid)')
+    m.add_argument('--reset', action='store_true', help='clear all recorded metrics')
+    m.set_defaults(func=cmd_metrics)
+
+    sv = sub.add_parser('serve', help='run a broker that group-commits enqueues, claims and results',
+                        description='Run a broker that group-commits enqueues, claims and results. Over --tcp, anyone who '
+                                    'can connect can enqueue shell commands for the workers to run: set QUEUECTL_BROKER_TOKEN '
+                                    '(on the broker and every client) so connections must present it first.')
+    sv.add_argument('--tcp', default=None, metavar='HOST:PORT',
+                    help='also listen on TCP for workers on other nodes (non-loopback needs QUEUECTL_BROKER_TOKEN or --insecure)')
+    sv.add_argument('--insecure', action='store_true',
+                    help='allow --tcp on a non-loopback address without a token (any peer can run commands on the workers)')
+    sv.add_argument('--window-ms', type=float, default=2.0, help='how long to gather requests into one commit')
+    sv.add_argument('--max-batch', type=int, default=512, help='most requests per commit')
+    sv.set_defaults(func=cmd_serve)
+
+    sc = sub.add_parser('schedule', help='recurring jobs (cron times are UTC); run them with `scheduler run`')
+    scsub = sc.add_subparsers(dest='op')
+    scadd = scsub.add_parser('add')
+    scadd.add_argument('cron', help='"*/5 * * * *", @hourly/@daily/@weekly/@monthly/@yearly, or "@every 30s"')
+    scadd.add_argument('job_json', help='job template, e.g. \'{"command":"backup.sh","queue":"ops"}\'')
+    scadd.add_argument('--name', default=None, help='schedule name (default: the template\'s id, or generated)')
+    scadd.set_defaults(func=cmd_schedule_add)
+    sclist = scsub.add_parser('list')
+    sclist.set_defaults(func=cmd_schedule_list)
+    scrm = scsub.add_parser('remove')
+    scrm.add_argument('name')
+    scrm.set_defaults(func=cmd_schedule_remove)
+
+    lm = sub.add_parser('limit', help='per concurrency_key limits, enforced when jobs are claimed')
+    lmsub = lm.add_subparsers(dest='op')
+    lmset = lmsub.add_parser('set')
+    lmset.add_argument('key')
+    lmset.add_argument('--max-in-flight', type=int, default=None, help='most jobs of the key processing at once')
+    lmset.add_argument('--rate', default=None, help='most claims per time unit, e.g. 5/s, 100/m (token bucket)')
+    lmset.add_argument('--burst', type=float, default=None, help='tokens the bucket holds (default: one second of --rate, at least 1)')
+    lmset.set_defaults(func=cmd_limit_set)
+    lmlist = lmsub.add_parser('list')
+    lmlist.set_defaults(func=cmd_limit_list)
+    lmrm = lmsub.add_parser('remove')
+    lmrm.add_argument('key')
+    lmrm.set_defaults(func=cmd_limit_remove)
+
+    sr = sub.add_parser('scheduler', help='materialize due schedules into jobs')
+    srsub = sr.add_subparsers(dest='op')
+    srrun = srsub.add_parser('run')
+    srrun.add_argument('--once', action='store_true', help='fire whatever is due now and exit (e.g. from cron)')
+    srrun.add_argument('--max-batch', type=int, default=500, help='schedules materialized per transaction')
+    srrun.set_defaults(func=cmd_scheduler_run)
+
+    r = sub.add_parser('reap', help='requeue processing jobs whose worker lease expired')
+    r.set_defaults(func=cmd_reap)
 
     c = sub.add_parser('config')
     csub = c.add_subparsers(dest='op')
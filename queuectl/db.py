@@ -1,191 +1,1690 @@
 # queuectl/db.py
 import sqlite3
 import os
+import re
 import json
+import shlex
 import time
 import uuid
+import threading
+from contextlib import contextmanager
+from itertools import islice
 from datetime import datetime, timezone
+from .notify import notify
+from .output import decompress, text_rows
+from .resources import node_name, this_node
 
 # DEFAULT_CONFIG stays module-level
-DEFAULT_CONFIG = {'max_retries': 3, 'backoff_base': 2, 'job_timeout': 10}
+DEFAULT_CONFIG = {'max_retries': 3, 'backoff_base': 2, 'job_timeout': 10, 'idle_poll_interval': 5,
+                  'output_max_bytes': 1048576,
+                  'lease_ttl': 60, 'autoscale_target_wait': 1.0, 'shards': 1, 'shard_by': 'id',
+                  'python_pool_max_jobs': 1000, 'python_pool_max_rss_mb': 512, 'python_preload': [], 'gc_interval': 0, 'gc_policy': {'completed': {'max_age': '7d'}, 'dead': {'max_age': '30d'}},
+                  'node_cpu': None, 'node_mem_mb': None, 'cgroup_root': None}
+
+# Per-connection tuning. Override with DB(pragmas={...}) or the QUEUECTL_PRAGMAS
+# environment variable, e.g. QUEUECTL_PRAGMAS="synchronous=NORMAL,mmap_size=0".
+DEFAULT_PRAGMAS = {
+    'synchronous': 'FULL',
+    'cache_size': -16000,       # KiB when negative
+    'mmap_size': 268435456,
+    'busy_timeout': 30000,      # ms
+}
+TUNABLE_PRAGMAS = set(DEFAULT_PRAGMAS) | {'temp_store', 'wal_autocheckpoint'}
+
+DEFAULT_QUEUE = 'default'
+
+# UPDATE ... RETURNING lets a claim be a single statement (SQLite >= 3.35)
+HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# connections inherited across fork; kept referenced so the child never closes the parent's handle
+_forked_conns = []
 
 def now_iso():
     return datetime.now(timezone.utc).isoformat()
 
+_DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+def parse_duration(value):
+    """Seconds from a number or a string like "90", "45s", "30m", "12h", "7d", "2w"."""
+    if isinstance(value, (int, float)):
+        return float(value)
+    m = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([smhdw]?)\s*', str(value))
+    if not m:
+        raise ValueError(f'invalid duration: {value!r}')
+    return float(m.group(1)) * _DURATION_UNITS[m.group(2) or 's']
+
+def parse_rate(value):
+    """Per-second rate from a number or a string like "5", "5/s", "30/m", "1000/h"."""
+    if isinstance(value, (int, float)):
+        return float(value)
+    m = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*(?:/\s*([smhd]))?\s*', str(value))
+    if not m:
+        raise ValueError(f'invalid rate: {value!r}')
+    return float(m.group(1)) / _DURATION_UNITS[m.group(2) or 's']
+
+def parse_timestamp(value):
+    """Epoch seconds from an epoch number or an ISO-8601 timestamp (UTC unless it says otherwise)."""
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        pass
+    try:
+        dt = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    except ValueError:
+        raise ValueError(f'invalid time: {value!r}')
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
+
+def parse_time(value):
+    """
+    Epoch seconds from an epoch number, an ISO-8601 timestamp, or a duration
+    ("90m", "2d") meaning that long ago.
+    """
+    try:
+        return parse_timestamp(value)
+    except ValueError:
+        pass
+    try:
+        return time.time() - parse_duration(value)
+    except ValueError:
+        raise ValueError(f'invalid time: {value!r}')
+
+def parse_pragmas(spec):
+    """Parse "name=value,name=value" into a dict of tunable PRAGMAs."""
+    out = {}
+    for part in (spec or '').split(','):
+        if not part.strip():
+            continue
+        name, _, value = part.partition('=')
+        out[name.strip()] = value.strip()
+    return out
+
+def _migrate_v1(cur):
+    """Base schema; also adopts databases created before schema versioning."""
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS jobs (
+        id TEXT PRIMARY KEY,
+        command TEXT NOT NULL,
+        state TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        max_retries INTEGER NOT NULL DEFAULT 3,
+        created_at TEXT,
+        updated_at TEXT,
+        available_at REAL DEFAULT 0,
+        last_error TEXT,
+        stdout TEXT,
+        stderr TEXT,
+        duration REAL,
+        timed_out INTEGER DEFAULT 0,
+        timeout INTEGER DEFAULT 0
+    )''')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_state_available ON jobs(state, available_at)')
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS config (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    )''')
+
+    # Migrate older DB by adding missing columns if necessary
+    add_cols = {
+        'stdout': 'TEXT',
+        'stderr': 'TEXT',
+        'duration': 'REAL',
+        'timed_out': 'INTEGER DEFAULT 0',
+        'timeout': 'INTEGER DEFAULT 0'
+    }
+    cur.execute("PRAGMA table_info(jobs)")
+    existing = {r['name'] for r in cur.fetchall()}
+    for col, typ in add_cols.items():
+        if col not in existing:
+            cur.execute(f'ALTER TABLE jobs ADD COLUMN {col} {typ}')
+
+    for k, v in DEFAULT_CONFIG.items():
+        cur.execute('INSERT OR IGNORE INTO config(key,value) VALUES(?,?)', (k, json.dumps(v)))
+
+def _migrate_v2(cur):
+    """Move captured output out of the jobs rows into compressed job_output chunks."""
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS job_output (
+        job_id TEXT NOT NULL,
+        attempt INTEGER NOT NULL,
+        seq INTEGER NOT NULL,
+        stream TEXT NOT NULL,
+        data BLOB NOT NULL,
+        PRIMARY KEY (job_id, attempt, seq)
+    )''')
+    reader = cur.connection.execute('SELECT id, attempts, stdout, stderr FROM jobs WHERE stdout IS NOT NULL OR stderr IS NOT NULL')
+    for r in reader:
+        cur.executemany('INSERT OR IGNORE INTO job_output(job_id,attempt,seq,stream,data) VALUES(?,?,?,?,?)',
+                        text_rows(r['id'], r['attempts'], r['stdout'], r['stderr']))
+    cur.execute('UPDATE jobs SET stdout = NULL, stderr = NULL WHERE stdout IS NOT NULL OR stderr IS NOT NULL')
+
+def _migrate_v3(cur):
+    """
+    Priorities and named queues. `seq` is the enqueue time in epoch microseconds; the
+    partial indexes hold only pending rows, ordered exactly as the claim wants them.
+    """
+    cur.execute('ALTER TABLE jobs ADD COLUMN priority INTEGER NOT NULL DEFAULT 0')
+    cur.execute(f"ALTER TABLE jobs ADD COLUMN queue TEXT NOT NULL DEFAULT '{DEFAULT_QUEUE}'")
+    cur.execute('ALTER TABLE jobs ADD COLUMN seq INTEGER')
+    cur.execute('UPDATE jobs SET seq = COALESCE(CAST((julianday(created_at) - 2440587.5) * 86400000000 AS INTEGER), rowid)')
+    # state is repeated inside the partial indexes so SQLite treats them as covering
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_claim ON jobs(state, priority DESC, seq, available_at) WHERE state = 'pending'")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_claim_queue ON jobs(queue, state, priority DESC, seq, available_at) WHERE state = 'pending'")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_pending_queue_available ON jobs(queue, state, available_at) WHERE state = 'pending'")
+
+_STATS_INC = '''INSERT INTO queue_stats(queue, state, count) VALUES (NEW.queue, NEW.state, 1)
+                 ON CONFLICT(queue, state) DO UPDATE SET count = count + 1;'''
+_STATS_DEC = 'UPDATE queue_stats SET count = count - 1 WHERE queue = OLD.queue AND state = OLD.state;'
+
+def _migrate_v4(cur):
+    """
+    Per-(queue, state) job counters kept exact by triggers, so every write path (and
+    any future one) maintains them and `status` never has to count the jobs table.
+    """
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS queue_stats (
+        queue TEXT NOT NULL,
+        state TEXT NOT NULL,
+        count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (queue, state)
+    ) WITHOUT ROWID''')
+    cur.execute(f'CREATE TRIGGER IF NOT EXISTS trg_jobs_stats_insert AFTER INSERT ON jobs BEGIN {_STATS_INC} END')
+    cur.execute(f'CREATE TRIGGER IF NOT EXISTS trg_jobs_stats_delete AFTER DELETE ON jobs BEGIN {_STATS_DEC} END')
+    cur.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_jobs_stats_update AFTER UPDATE OF state, queue ON jobs
+                    WHEN OLD.state IS NOT NEW.state OR OLD.queue IS NOT NEW.queue
+                    BEGIN {_STATS_DEC} {_STATS_INC} END''')
+    cur.execute('DELETE FROM queue_stats')
+    cur.execute('INSERT INTO queue_stats(queue, state, count) SELECT queue, state, COUNT(*) FROM jobs GROUP BY queue, state')
+
+def _migrate_v5(cur):
+    """Lets retention find finished jobs by age without scanning."""
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_state_updated ON jobs(state, updated_at)')
+
+def _migrate_v6(cur):
+    """Keyset pagination for listing: (seq, id) in enqueue order, optionally within one state."""
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_seq ON jobs(seq, id)')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_state_seq ON jobs(state, seq, id)')
+
+def _migrate_v7(cur):
+    """
+    Claims become leases held by a worker. Rows already processing get a fresh lease
+    so that, if their worker is gone, the reaper recovers them after one TTL.
+    """
+    cur.execute('ALTER TABLE jobs ADD COLUMN worker_id TEXT')
+    cur.execute('ALTER TABLE jobs ADD COLUMN lease_expires_at REAL')
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_lease ON jobs(state, lease_expires_at) WHERE state = 'processing'")
+    cur.execute("UPDATE jobs SET lease_expires_at = ? WHERE state = 'processing'", (time.time() + DEFAULT_CONFIG['lease_ttl'],))
+
+def _migrate_v8(cur):
+    """
+    Worker metrics: each worker aggregates counters and histogram buckets in memory
+    and periodically adds the deltas here, one row per (worker, metric, key).
+    """
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS metrics (
+        worker TEXT NOT NULL,
+        name TEXT NOT NULL,
+        key TEXT NOT NULL DEFAULT '',
+        value REAL NOT NULL DEFAULT 0,
+        updated_at REAL,
+        PRIMARY KEY (worker, name, key)
+    ) WITHOUT ROWID''')
+
+def _migrate_v9(cur):
+    """Live worker and supervisor processes, replacing queuectl_workers.pid."""
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS workers (
+        id TEXT PRIMARY KEY,
+        hostname TEXT NOT NULL,
+        pid INTEGER NOT NULL,
+        mode TEXT NOT NULL,
+        state TEXT NOT NULL DEFAULT 'running',
+        supervisor TEXT,
+        started_at REAL NOT NULL,
+        last_seen REAL NOT NULL
+    )''')
+
+def _migrate_v10(cur):
+    """How a job runs: 'shell' (sh -c, or direct exec when no shell is needed), 'exec' (argv in args) or 'python'."""
+    cur.execute("ALTER TABLE jobs ADD COLUMN kind TEXT NOT NULL DEFAULT 'shell'")
+    cur.execute('ALTER TABLE jobs ADD COLUMN args TEXT')
+
+def _migrate_v11(cur):
+    """
+    Recurring jobs: a job template fired on a cron expression. next_run is the next
+    fire time still to be materialized; the scheduler advances it after enqueueing.
+    """
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS schedules (
+        name TEXT PRIMARY KEY,
+        cron TEXT NOT NULL,
+        job TEXT NOT NULL,
+        next_run REAL NOT NULL,
+        last_run REAL,
+        created_at TEXT
+    )''')
+
+def _migrate_v12(cur):
+    """
+    Duplicate coalescing. dedup_key is unique among the jobs holding one, and a job
+    lets go of its key (the trigger sets it NULL) once it completes or dies, so a
+    key is held exactly while its job is pending or processing. dedup_expires caps
+    how long a key may be held.
+    """
+    cur.execute('ALTER TABLE jobs ADD COLUMN dedup_key TEXT')
+    cur.execute('ALTER TABLE jobs ADD COLUMN dedup_expires REAL')
+    cur.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_dedup ON jobs(dedup_key) WHERE dedup_key IS NOT NULL')
+    cur.execute('''CREATE TRIGGER IF NOT EXISTS trg_jobs_dedup_release AFTER UPDATE OF state ON jobs
+                   WHEN NEW.dedup_key IS NOT NULL AND NEW.state IN ('completed', 'dead')
+                   BEGIN UPDATE jobs SET dedup_key = NULL WHERE rowid = NEW.rowid; END''')
+
+def _migrate_v13(cur):
+    """
+    Job dependencies. job_deps holds the edges (parent must complete before child);
+    a child waits in state 'blocked' with pending_deps counting its unfinished
+    parents, and becomes pending when that reaches 0, so claims never look at the
+    graph. dep_failures lists dead jobs whose blocked descendants still have to be
+    marked dead, with a cursor into their children (see cascade_failures).
+    """
+    cur.execute('ALTER TABLE jobs ADD COLUMN pending_deps INTEGER NOT NULL DEFAULT 0')
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS job_deps (
+        parent TEXT NOT NULL,
+        child TEXT NOT NULL,
+        PRIMARY KEY (parent, child)
+    ) WITHOUT ROWID''')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_deps_child ON job_deps(child)')
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS dep_failures (
+        job_id TEXT PRIMARY KEY,
+        after TEXT NOT NULL DEFAULT ''
+    ) WITHOUT ROWID''')
+    cur.execute('''CREATE TRIGGER IF NOT EXISTS trg_jobs_dep_failed AFTER UPDATE OF state ON jobs
+                   WHEN NEW.state = 'dead' AND OLD.state IS NOT 'dead'
+                   BEGIN INSERT OR REPLACE INTO dep_failures(job_id) SELECT NEW.id
+                         WHERE EXISTS (SELECT 1 FROM job_deps WHERE parent = NEW.id); END''')
+    # a deleted job stops waiting; edges out of it go with its children (a pending cascade still needs them)
+    cur.execute('''CREATE TRIGGER IF NOT EXISTS trg_jobs_deps_delete AFTER DELETE ON jobs
+                   BEGIN DELETE FROM job_deps WHERE child = OLD.id; END''')
+
+def _migrate_v14(cur):
+    """
+    Per-key limits. A job's concurrency_key may have a row in key_limits (most jobs
+    in flight at once, and/or a token bucket of `rate` per second up to `burst`);
+    key_state holds the live counts: in_flight kept exact by triggers on every
+    move into or out of processing, and the bucket as of its last claim. The claim
+    indexes gain the key, so jobs of a saturated key are skipped inside the index.
+    """
+    cur.execute('ALTER TABLE jobs ADD COLUMN concurrency_key TEXT')
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS key_limits (
+        key TEXT PRIMARY KEY,
+        max_in_flight INTEGER,
+        rate REAL,
+        burst REAL
+    ) WITHOUT ROWID''')
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS key_state (
+        key TEXT PRIMARY KEY,
+        in_flight INTEGER NOT NULL DEFAULT 0,
+        tokens REAL,
+        refilled_at REAL
+    ) WITHOUT ROWID''')
+    cur.execute('''CREATE TRIGGER IF NOT EXISTS trg_jobs_key_claim AFTER UPDATE OF state ON jobs
+                   WHEN NEW.concurrency_key IS NOT NULL AND NEW.state = 'processing' AND OLD.state IS NOT 'processing'
+                   BEGIN INSERT INTO key_state(key, in_flight) VALUES (NEW.concurrency_key, 1)
+                         ON CONFLICT(key) DO UPDATE SET in_flight = in_flight + 1; END''')
+    cur.execute('''CREATE TRIGGER IF NOT EXISTS trg_jobs_key_release AFTER UPDATE OF state ON jobs
+                   WHEN OLD.concurrency_key IS NOT NULL AND OLD.state = 'processing' AND NEW.state IS NOT 'processing'
+                   BEGIN UPDATE key_state SET in_flight = in_flight - 1 WHERE key = OLD.concurrency_key; END''')
+    cur.execute('''CREATE TRIGGER IF NOT EXISTS trg_jobs_key_delete AFTER DELETE ON jobs
+                   WHEN OLD.concurrency_key IS NOT NULL AND OLD.state = 'processing'
+                   BEGIN UPDATE key_state SET in_flight = in_flight - 1 WHERE key = OLD.concurrency_key; END''')
+    cur.execute('DROP INDEX IF EXISTS idx_claim')
+    cur.execute('DROP INDEX IF EXISTS idx_claim_queue')
+    cur.execute("CREATE INDEX idx_claim ON jobs(state, priority DESC, seq, available_at, concurrency_key) WHERE state = 'pending'")
+    cur.execute("CREATE INDEX idx_claim_queue ON jobs(queue, state, priority DESC, seq, available_at, concurrency_key) WHERE state = 'pending'")
+
+def _migrate_v15(cur):
+    """Lets `dlq summary` group dead jobs by error and command prefix straight off an index."""
+    cur.execute(f"CREATE INDEX IF NOT EXISTS idx_dead_summary ON jobs(last_error, {_DLQ_PREFIX}, updated_at) WHERE state = 'dead'")
+
+_USAGE = ("UPDATE node_usage SET cpu_milli = cpu_milli {op} CAST(ROUND(IFNULL({row}.cpu, 0) * 1000) AS INTEGER), "
+          "mem_mb = mem_mb {op} IFNULL({row}.mem_mb, 0);")
+
+def _migrate_v16(cur):
+    """
+    Resource requests. A job may ask for `cpu` cores and `mem_mb`; node_usage (one
+    row) holds what the processing jobs have reserved, kept exact by triggers like
+    key_state, so a claim checks the node budget without summing jobs. The claim
+    indexes gain both columns, and idx_pending_sized tells a claim whether any
+    pending job asks for resources at all. peak_rss_kb and cpu_time record what
+    the last run of a job used.
+    """
+    for column in ('cpu REAL', 'mem_mb INTEGER', 'peak_rss_kb INTEGER', 'cpu_time REAL'):
+        cur.execute(f'ALTER TABLE jobs ADD COLUMN {column}')
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS node_usage (
+        id INTEGER PRIMARY KEY CHECK (id = 0),
+        cpu_milli INTEGER NOT NULL DEFAULT 0,
+        mem_mb INTEGER NOT NULL DEFAULT 0
+    )''')
+    cur.execute('INSERT OR IGNORE INTO node_usage(id) VALUES (0)')
+    sized = '({row}.cpu IS NOT NULL OR {row}.mem_mb IS NOT NULL)'
+    cur.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_jobs_usage_claim AFTER UPDATE OF state ON jobs
+                    WHEN {sized.format(row='NEW')} AND NEW.state = 'processing' AND OLD.state IS NOT 'processing'
+                    BEGIN {_USAGE.format(op='+', row='NEW')} END''')
+    cur.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_jobs_usage_release AFTER UPDATE OF state ON jobs
+                    WHEN {sized.format(row='OLD')} AND OLD.state = 'processing' AND NEW.state IS NOT 'processing'
+                    BEGIN {_USAGE.format(op='-', row='OLD')} END''')
+    cur.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_jobs_usage_delete AFTER DELETE ON jobs
+                    WHEN {sized.format(row='OLD')} AND OLD.state = 'processing'
+                    BEGIN {_USAGE.format(op='-', row='OLD')} END''')
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_pending_sized ON jobs(seq) WHERE state = 'pending' AND (cpu IS NOT NULL OR mem_mb IS NOT NULL)")
+    cur.execute('DROP INDEX IF EXISTS idx_claim')
+    cur.execute('DROP INDEX IF EXISTS idx_claim_queue')
+    cur.execute("CREATE INDEX idx_claim ON jobs(state, priority DESC, seq, available_at, concurrency_key, cpu, mem_mb) WHERE state = 'pending'")
+    cur.execute("CREATE INDEX idx_claim_queue ON jobs(queue, state, priority DESC, seq, available_at, concurrency_key, cpu, mem_mb) WHERE state = 'pending'")
+
+_SIZED = '({row}.cpu IS NOT NULL OR {row}.mem_mb IS NOT NULL)'
+_NODE_CPU = 'CAST(ROUND(IFNULL({row}.cpu, 0) * 1000) AS INTEGER)'
+_NODE_RELEASE = (f"UPDATE node_usage SET cpu_milli = cpu_milli - {_NODE_CPU.format(row='OLD')}, "
+                 "mem_mb = mem_mb - IFNULL(OLD.mem_mb, 0) WHERE node = IFNULL(OLD.node, '');")
+
+def _migrate_v17(cur):
+    """
+    node_usage gets one row per node. A claim stamps each job with the node it was
+    claimed for, and the triggers charge that node's row, so workers on several
+    hosts each fill their own machine's budget. Jobs processing across the upgrade
+    are charged to the node running the migration.
+    """
+    cur.execute('ALTER TABLE jobs ADD COLUMN node TEXT')
+    for name in ('claim', 'release', 'delete'):
+        cur.execute(f'DROP TRIGGER IF EXISTS trg_jobs_usage_{name}')
+    cur.execute('DROP TABLE IF EXISTS node_usage')
+    cur.execute('''
+    CREATE TABLE node_usage (
+        node TEXT PRIMARY KEY NOT NULL,
+        cpu_milli INTEGER NOT NULL DEFAULT 0,
+        mem_mb INTEGER NOT NULL DEFAULT 0
+    )''')
+    cur.execute(f"UPDATE jobs SET node = ? WHERE state = 'processing' AND {_SIZED.format(row='jobs')}", (node_name(),))
+    cur.execute(f'''INSERT INTO node_usage(node, cpu_milli, mem_mb)
+                    SELECT node, SUM({_NODE_CPU.format(row='jobs')}), SUM(IFNULL(mem_mb, 0)) FROM jobs
+                    WHERE state = 'processing' AND {_SIZED.format(row='jobs')} GROUP BY node''')
+    cur.execute(f'''CREATE TRIGGER trg_jobs_usage_claim AFTER UPDATE OF state ON jobs
+                    WHEN {_SIZED.format(row='NEW')} AND NEW.state = 'processing' AND OLD.state IS NOT 'processing'
+                    BEGIN INSERT INTO node_usage(node, cpu_milli, mem_mb)
+                          VALUES (IFNULL(NEW.node, ''), {_NODE_CPU.format(row='NEW')}, IFNULL(NEW.mem_mb, 0))
+                          ON CONFLICT(node) DO UPDATE SET cpu_milli = cpu_milli + excluded.cpu_milli,
+                                                          mem_mb = mem_mb + excluded.mem_mb; END''')
+    cur.execute(f'''CREATE TRIGGER trg_jobs_usage_release AFTER UPDATE OF state ON jobs
+                    WHEN {_SIZED.format(row='OLD')} AND OLD.state = 'processing' AND NEW.state IS NOT 'processing'
+                    BEGIN {_NODE_RELEASE} END''')
+    cur.execute(f'''CREATE TRIGGER trg_jobs_usage_delete AFTER DELETE ON jobs
+                    WHEN {_SIZED.format(row='OLD')} AND OLD.state = 'processing'
+                    BEGIN {_NODE_RELEASE} END''')
+
+# Append-only: MIGRATIONS[i] upgrades a database from user_version i to i+1.
+MIGRATIONS = [_migrate_v1, _migrate_v2, _migrate_v3, _migrate_v4, _migrate_v5, _migrate_v6, _migrate_v7, _migrate_v8,
+              _migrate_v9, _migrate_v10, _migrate_v11, _migrate_v12, _migrate_v13, _migrate_v14, _migrate_v15,
+              _migrate_v16, _migrate_v17]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+# Everything but the legacy stdout/stderr columns; hot queries never read output bytes.
+JOB_COLUMNS = ('id', 'command', 'state', 'attempts', 'max_retries', 'created_at', 'updated_at', 'available_at',
+               'last_error', 'duration', 'timed_out', 'timeout', 'priority', 'queue', 'seq', 'worker_id',
+               'lease_expires_at', 'kind', 'args', 'dedup_key', 'dedup_expires', 'pending_deps', 'concurrency_key',
+               'cpu', 'mem_mb', 'peak_rss_kb', 'cpu_time', 'node')
+_JOB_COLS = ','.join(JOB_COLUMNS)
+
+JOB_KINDS = ('shell', 'exec', 'python')
+
+def _job_kind(job):
+    """
+    (kind, command, args JSON) for a job dict. An "args" list makes an exec job
+    (command becomes its shell-quoted form, for display); a "python:module:function"
+    command makes a python job, whose optional "args" are passed to the function.
+    """
+    kind = job.get('kind')
+    command = job.get('command')
+    args = job.get('args')
+    if command is not None and not isinstance(command, str):
+        raise ValueError('command must be a string')
+    if kind is None:
+        if command and command.startswith('python:'):
+            kind = 'python'
+        elif args is not None:
+            kind = 'exec'
+        else:
+            kind = 'shell'
+    if kind not in JOB_KINDS:
+        raise ValueError(f'kind must be one of {", ".join(JOB_KINDS)}')
+    if args is not None and not isinstance(args, list):
+        raise ValueError('args must be a list')
+    if kind == 'exec':
+        if args is None:
+            args = shlex.split(command)
+        if not args or not all(isinstance(a, str) for a in args):
+            raise ValueError('exec jobs need a non-empty "args" list of strings')
+        command = command or shlex.join(args)
+    elif kind == 'python':
+        if not command or not command.startswith('python:') or command.count(':') < 2:
+            raise ValueError('python jobs need a "python:module:function" command')
+    elif args is not None:
+        raise ValueError('shell jobs take no "args"; use an argv "args" list without "command"')
+    return kind, command, None if args is None else json.dumps(args)
+
+# must match idx_dead_summary's expression for the index to be used
+_DLQ_PREFIX = 'substr(command, 1, 32)'
+
+def _iso(ts):
+    return datetime.fromtimestamp(ts, timezone.utc).isoformat()
+
+def _job_filter(state=None, queue=None, since=None, until=None, error=None):
+    """(conditions, params) selecting jobs as iter_jobs documents its filters."""
+    where = []
+    params = []
+    if state:
+        where.append('state = ?')
+        params.append(state)
+    if queue:
+        where.append('queue = ?')
+        params.append(queue)
+    # dead jobs are asked about by when they died (their last update), others by enqueue time
+    if since is not None:
+        where.append('updated_at >= ?' if state == 'dead' else 'seq >= ?')
+        params.append(_iso(since) if state == 'dead' else int(since * 1e6))
+    if until is not None:
+        where.append('updated_at < ?' if state == 'dead' else 'seq < ?')
+        params.append(_iso(until) if state == 'dead' else int(until * 1e6))
+    if error:
+        where.append("last_error LIKE ? ESCAPE '\\'")
+        params.append('%' + error.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%')
+    return where, params
+
 class DB:
-    def __init__(self, path: str = None):
+    def __init__(self, path: str = None, pragmas: dict = None):
         """
         If `path` is None, create a DB file named 'queuectl.db' in the current working directory.
         This avoids binding the DB path at import time so tests that change cwd work correctly.
+
+        Each thread of each process gets one long-lived connection, opened lazily;
+        a DB object inherited across fork opens a fresh connection in the child.
         """
         if path:
             self.path = path
         else:
             self.path = os.path.join(os.getcwd(), 'queuectl.db')
+        self.pragmas = dict(DEFAULT_PRAGMAS)
+        self.pragmas.update(parse_pragmas(os.environ.get('QUEUECTL_PRAGMAS')))
+        self.pragmas.update(pragmas or {})
+        for name, value in self.pragmas.items():
+            if name not in TUNABLE_PRAGMAS or not re.fullmatch(r'-?[A-Za-z0-9_]+', str(value)):
+                raise ValueError(f'unsupported pragma {name}={value}')
+        self._local = threading.local()
+        # whose workers commits wake up; a shard wakes the workers of its main database
+        self.wake_path = self.path
+        # optional metrics.Metrics; counts claims that gave up on a busy/locked database
+        self.metrics = None
         self._ensure_db()
 
     def _conn(self):
+        local = self._local
+        c = getattr(local, 'conn', None)
+        if c is not None and local.pid == os.getpid():
+            return c
+        if c is not None:
+            _forked_conns.append(c)
         c = sqlite3.connect(self.path, timeout=30, isolation_level=None)
         c.row_factory = sqlite3.Row
+        for name, value in self.pragmas.items():
+            c.execute(f'PRAGMA {name}={value}')
+        local.conn = c
+        local.pid = os.getpid()
         return c
 
-    def _ensure_db(self):
+    def close(self):
+        """Close this thread's connection; the next call reopens it."""
+        c = getattr(self._local, 'conn', None)
+        if c is not None and self._local.pid == os.getpid():
+            c.close()
+        self._local.conn = None
+
+    @contextmanager
+    def _tx(self):
+        """
+        Run the body inside one BEGIN IMMEDIATE ... COMMIT, rolling back on error.
+        Nested calls become SAVEPOINTs of the enclosing transaction, so a failing
+        inner block only undoes its own work; wakeups wait for the outermost COMMIT.
+        """
         c = self._conn()
+        local = self._local
         cur = c.cursor()
-        cur.executescript('''
-        PRAGMA journal_mode=WAL;
-        CREATE TABLE IF NOT EXISTS jobs (
-            id TEXT PRIMARY KEY,
-            command TEXT NOT NULL,
-            state TEXT NOT NULL,
-            attempts INTEGER NOT NULL DEFAULT 0,
-            max_retries INTEGER NOT NULL DEFAULT 3,
-            created_at TEXT,
-            updated_at TEXT,
-            available_at REAL DEFAULT 0,
-            last_error TEXT,
-            stdout TEXT,
-            stderr TEXT,
-            duration REAL,
-            timed_out INTEGER DEFAULT 0,
-            timeout INTEGER DEFAULT 0
-        );
-        CREATE INDEX IF NOT EXISTS idx_state_available ON jobs(state, available_at);
-        CREATE TABLE IF NOT EXISTS config (
-            key TEXT PRIMARY KEY,
-            value TEXT
-        );
-        ''')
-
-        # Migrate older DB by adding missing columns if necessary
-        add_cols = {
-            'stdout': 'TEXT',
-            'stderr': 'TEXT',
-            'duration': 'REAL',
-            'timed_out': 'INTEGER DEFAULT 0',
-            'timeout': 'INTEGER DEFAULT 0'
-        }
-        cur.execute("PRAGMA table_info(jobs)")
-        existing = {r['name'] for r in cur.fetchall()}
-        for col, typ in add_cols.items():
-            if col not in existing:
-                try:
-                    cur.execute(f'ALTER TABLE jobs ADD COLUMN {col} {typ}')
-                except Exception:
-                    # ignore migration errors (best-effort)
-                    pass
+        depth = getattr(local, 'depth', 0)
+        if depth:
+            name = f'sp{depth}'
+            cur.execute(f'SAVEPOINT {name}')
+            local.depth = depth + 1
+            try:
+                yield cur
+            except BaseException:
+                cur.execute(f'ROLLBACK TO {name}')
+                cur.execute(f'RELEASE {name}')
+                raise
+            finally:
+                local.depth = depth
+            cur.execute(f'RELEASE {name}')
+            return
+        cur.execute('BEGIN IMMEDIATE')
+        local.depth = 1
+        local.notify = False
+        try:
+            yield cur
+        except BaseException:
+            if c.in_transaction:
+                cur.execute('ROLLBACK')
+            raise
+        finally:
+            local.depth = 0
+        cur.execute('COMMIT')
+        if local.notify:
+            local.notify = False
+            notify(self.wake_path)
 
-        for k, v in DEFAULT_CONFIG.items():
-            cur.execute('INSERT OR IGNORE INTO config(key,value) VALUES(?,?)', (k, json.dumps(v)))
-        c.commit()
-        c.close()
+    def _notify(self):
+        if getattr(self._local, 'depth', 0):
+            self._local.notify = True
+        else:
+            notify(self.wake_path)
 
-    def enqueue(self, job):
+    def data_version(self):
+        """Changes whenever another connection commits to the database; costs no table reads."""
+        return self._conn().execute('PRAGMA data_version').fetchone()[0]
+
+    def next_available_at(self, queues=None):
+        """Earliest available_at among pending jobs (an index seek per queue), or None if there are none."""
         c = self._conn()
-        cur = c.cursor()
-        job_id = job.get('id') or str(uuid.uuid4())
-        command = job['command']
-        max_retries = job.get('max_retries', DEFAULT_CONFIG['max_retries'])
-        created_at = job.get('created_at', now_iso())
-        updated_at = created_at
-        state = 'pending'
-        available_at = 0
-        timeout = job.get('timeout', 0)
-        cur.execute('''INSERT INTO jobs(id,command,state,attempts,max_retries,created_at,updated_at,available_at,timeout) VALUES(?,?,?,?,?,?,?,?,?)''',
-                    (job_id, command, state, 0, max_retries, created_at, updated_at, available_at, timeout))
-        c.commit()
-        c.close()
-        return job_id
-
-    def fetch_and_claim_job(self):
+        if not queues:
+            return c.execute("SELECT MIN(available_at) AS t FROM jobs WHERE state = 'pending'").fetchone()['t']
+        times = [c.execute("SELECT MIN(available_at) AS t FROM jobs INDEXED BY idx_pending_queue_available WHERE state = 'pending' AND queue = ?", (q,)).fetchone()['t']
+                 for q in queues]
+        times = [t for t in times if t is not None]
+        return min(times) if times else None
+
+    def _ensure_db(self):
         c = self._conn()
-        cur = c.cursor()
-        now_ts = time.time()
+        version = c.execute('PRAGMA user_version').fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            return
+        if version == 0:
+            if c.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()[0] == 0:
+                # only takes effect on an empty file; lets gc hand freed pages back to the OS
+                c.execute('PRAGMA auto_vacuum=INCREMENTAL')
+            c.execute('PRAGMA journal_mode=WAL')
+        with self._tx() as cur:
+            # another process may have migrated while we waited for the lock
+            version = cur.execute('PRAGMA user_version').fetchone()[0]
+            for migrate in MIGRATIONS[version:]:
+                migrate(cur)
+            cur.execute(f'PRAGMA user_version = {max(version, SCHEMA_VERSION)}')
+
+    def _job_row(self, job):
+        if not isinstance(job, dict) or not (job.get('command') or job.get('args')):
+            raise ValueError('job must be an object with a "command" (or an "args" list)')
+        kind, command, args = _job_kind(job)
         try:
-            cur.execute('BEGIN IMMEDIATE')
-            cur.execute('SELECT * FROM jobs WHERE state = ? AND available_at <= ? ORDER BY created_at LIMIT 1', ('pending', now_ts))
-            row = cur.fetchone()
-            if not row:
-                cur.execute('COMMIT')
-                return None
-            job_id = row['id']
-            cur.execute('UPDATE jobs SET state = ?, updated_at = ? WHERE id = ? AND state = ?', ('processing', now_iso(), job_id, 'pending'))
-            if cur.rowcount == 0:
-                cur.execute('COMMIT')
-                return None
-            cur.execute('SELECT * FROM jobs WHERE id = ?', (job_id,))
-            job = cur.fetchone()
-            cur.execute('COMMIT')
-            return dict(job)
-        except sqlite3.OperationalError:
+            priority = int(job.get('priority', 0))
+        except (TypeError, ValueError):
+            raise ValueError('priority must be an integer')
+        queue = job.get('queue') or DEFAULT_QUEUE
+        if not isinstance(queue, str):
+            raise ValueError('queue must be a string')
+        if job.get('run_at') is not None and job.get('delay') is not None:
+            raise ValueError('give run_at or delay, not both')
+        available_at = 0
+        if job.get('run_at') is not None:
+            available_at = parse_timestamp(job['run_at'])
+        elif job.get('delay') is not None:
+            available_at = time.time() + parse_duration(job['delay'])
+        dedup_key = job.get('dedup_key')
+        if dedup_key is not None and not isinstance(dedup_key, str):
+            raise ValueError('dedup_key must be a string')
+        dedup_ttl = job.get('dedup_ttl')
+        concurrency_key = job.get('concurrency_key')
+        if concurrency_key is not None and not isinstance(concurrency_key, str):
+            raise ValueError('concurrency_key must be a string')
+        depends_on = job.get('depends_on')
+        if depends_on is not None:
+            if not isinstance(depends_on, list) or not all(isinstance(d, str) and d for d in depends_on):
+                raise ValueError('depends_on must be a list of job ids')
+            depends_on = list(dict.fromkeys(depends_on))
+        cpu = job.get('cpu')
+        if cpu is not None:
             try:
-                cur.execute('ROLLBACK')
-            except Exception:
-                pass
+                cpu = round(float(cpu), 3)
+            except (TypeError, ValueError):
+                cpu = 0
+            if not cpu > 0:
+                raise ValueError('cpu must be a positive number of cores')
+        mem_mb = job.get('mem_mb')
+        if mem_mb is not None:
+            if isinstance(mem_mb, bool) or not isinstance(mem_mb, int) or mem_mb < 1:
+                raise ValueError('mem_mb must be a positive integer')
+        created_at = job.get('created_at', now_iso())
+        return {
+            'id': job.get('id') or str(uuid.uuid4()),
+            'command': command,
+            'state': 'pending',
+            'attempts': 0,
+            'max_retries': job.get('max_retries', DEFAULT_CONFIG['max_retries']),
+            'created_at': created_at,
+            'updated_at': created_at,
+            'available_at': available_at,
+            'timeout': job.get('timeout', 0),
+            'priority': priority,
+            'queue': queue,
+            'seq': time.time_ns() // 1000,
+            'kind': kind,
+            'args': args,
+            'dedup_key': dedup_key,
+            'dedup_expires': None if dedup_ttl is None or dedup_key is None else time.time() + parse_duration(dedup_ttl),
+            'pending_deps': 0,
+            'concurrency_key': concurrency_key,
+            'cpu': cpu,
+            'mem_mb': mem_mb,
+            'last_error': None,
+            'depends_on': depends_on or None,
+        }
+
+    _INSERT_JOB = '''INSERT INTO jobs(id,command,state,attempts,max_retries,created_at,updated_at,available_at,timeout,priority,queue,seq,kind,args,dedup_key,dedup_expires,pending_deps,concurrency_key,cpu,mem_mb,last_error)
+                     VALUES(:id,:command,:state,:attempts,:max_retries,:created_at,:updated_at,:available_at,:timeout,:priority,:queue,:seq,:kind,:args,:dedup_key,:dedup_expires,:pending_deps,:concurrency_key,:cpu,:mem_mb,:last_error)'''
+
+    def _insert(self, cur, row):
+        """
+        Insert one job row, unless its dedup_key is held by a pending or processing
+        job whose key has not expired: then nothing is inserted and that job's id is
+        returned. An expired holder gives its key up to the new job. A job with
+        depends_on starts blocked on its unfinished parents, or dead if one is dead;
+        unknown parents raise ValueError before anything is written.
+        """
+        parents = row['depends_on']
+        if parents:
+            marks = ','.join('?' * len(parents))
+            states = {r['id']: r['state'] for r in cur.execute(f'SELECT id, state FROM jobs WHERE id IN ({marks})', parents)}
+            missing = [p for p in parents if p not in states]
+            if missing:
+                raise ValueError(f'unknown dependency {missing[0]}')
+            dead = [p for p in parents if states[p] == 'dead']
+            row['pending_deps'] = sum(1 for p in parents if states[p] != 'completed')
+            if dead:
+                row['state'] = 'dead'
+                row['last_error'] = f'dependency {dead[0]} failed'
+            elif row['pending_deps']:
+                row['state'] = 'blocked'
+        if row['dedup_key'] is not None:
+            held = cur.execute('SELECT id, dedup_expires FROM jobs WHERE dedup_key = ?', (row['dedup_key'],)).fetchone()
+            if held is not None:
+                if held['dedup_expires'] is None or held['dedup_expires'] > time.time():
+                    return held['id']
+                cur.execute('UPDATE jobs SET dedup_key = NULL WHERE id = ?', (held['id'],))
+        cur.execute(self._INSERT_JOB, row)
+        if parents:
+            cur.executemany('INSERT INTO job_deps(parent, child) VALUES(?,?)', [(p, row['id']) for p in parents])
+        return None
+
+    def _count_coalesced(self, n):
+        self.add_metrics('enqueue', [('enqueue_coalesced_total', '', n)])
+
+    def enqueue(self, job):
+        """Insert one job and return its id, or the id of the live job with the same dedup_key."""
+        row = self._job_row(job)
+        if row['dedup_key'] is None and row['depends_on'] is None:
+            self._conn().execute(self._INSERT_JOB, row)
+            self._notify()
+            return row['id']
+        with self._tx() as cur:
+            held = self._insert(cur, row)
+            if held is not None:
+                self._count_coalesced(1)
+                return held
+        self._notify()
+        return row['id']
+
+    def enqueue_many(self, jobs, chunk_size=1000, on_chunk=None, on_reject=None, on_coalesce=None):
+        """
+        Insert jobs from any iterable (typically a generator) in chunks of `chunk_size`,
+        one transaction per chunk, so only the current chunk is ever held in memory.
+        `on_chunk(inserted, elapsed)` is called after each chunk commits and
+        `on_reject(job, error)` for every job that could not be inserted.
+        A job whose dedup_key is held by a live job is coalesced into it instead:
+        counted in neither total and reported to `on_coalesce(job, existing_id)`.
+        A job may depend on jobs earlier in the same stream.
+        Returns (inserted, rejected) counts.
+        """
+        chunk_size = max(1, int(chunk_size))
+        inserted = 0
+        rejected = 0
+        it = iter(jobs)
+        while True:
+            batch = list(islice(it, chunk_size))
+            if not batch:
+                break
+            start = time.time()
+            rows = []
+            for job in batch:
+                try:
+                    rows.append(self._job_row(job))
+                except ValueError as e:
+                    rejected += 1
+                    if on_reject:
+                        on_reject(job, str(e))
+            coalesced = []
+            try:
+                with self._tx() as cur:
+                    cur.executemany(self._INSERT_JOB, [r for r in rows if r['dedup_key'] is None and r['depends_on'] is None])
+                    for row in rows:
+                        if row['dedup_key'] is not None or row['depends_on'] is not None:
+                            held = self._insert(cur, row)
+                            if held is not None:
+                                coalesced.append((row, held))
+                    if coalesced:
+                        self._count_coalesced(len(coalesced))
+                done = len(rows) - len(coalesced)
+            except (sqlite3.IntegrityError, ValueError):
+                # some row in the chunk collides; redo it row by row so the rest still lands
+                done = 0
+                coalesced = []
+                with self._tx() as cur:
+                    for row in rows:
+                        try:
+                            with self._tx() as sp:
+                                held = self._insert(sp, dict(row, state='pending', pending_deps=0, last_error=None))
+                        except (sqlite3.IntegrityError, ValueError) as e:
+                            rejected += 1
+                            if on_reject:
+                                on_reject({'id': row['id'], 'command': row['command']}, str(e))
+                            continue
+                        if held is None:
+                            done += 1
+                        else:
+                            coalesced.append((row, held))
+                    if coalesced:
+                        self._count_coalesced(len(coalesced))
+            if on_coalesce:
+                for row, held in coalesced:
+                    on_coalesce({'id': row['id'], 'command': row['command'], 'dedup_key': row['dedup_key']}, held)
+            inserted += done
+            if done:
+                self._notify()
+            if on_chunk:
+                on_chunk(done, time.time() - start)
+        return inserted, rejected
+
+    def fetch_and_claim_job(self, queues=None, worker_id=None, lease_ttl=None):
+        jobs = self.fetch_and_claim_jobs(1, queues=queues, worker_id=worker_id, lease_ttl=lease_ttl)
+        return jobs[0] if jobs else None
+
+    def fetch_and_claim_jobs(self, limit=1, queues=None, worker_id=None, lease_ttl=None, reserved=None, node=None):
+        """
+        Claim up to `limit` runnable pending jobs under one write lock and return them
+        (highest priority, then oldest first) as dicts. With `queues`, jobs are taken
+        from those queues in the given order until `limit` is reached. Each claim is
+        an index seek on the pending-only claim indexes, independent of backlog size.
+        Claimed jobs are leased to `worker_id` for `lease_ttl` seconds; see heartbeat()
+        and reap_expired_leases(). Jobs asking for cpu/mem_mb are only claimed while
+        they fit the budget of `node`, (name, cores, MB) from resources.this_node()
+        by default (see _node_room); `reserved` is (cpu millicores, mem_mb) the node
+        holds in jobs this database does not see. Returns [] if nothing is runnable
+        or the DB is busy.
+        """
+        node = node or this_node()
+        now_ts = time.time()
+        limit = max(1, int(limit))
+        lease = now_ts + (lease_ttl or DEFAULT_CONFIG['lease_ttl'])
+        jobs = []
+        try:
+            with self._tx() as cur:
+                budgets = self._key_budgets(cur, now_ts)
+                room = self._node_room(cur, node, reserved)
+                for queue in (queues or [None]):
+                    jobs += self._claim(cur, limit - len(jobs), now_ts, queue, [worker_id, lease, node[0]], budgets, room)
+                    if len(jobs) >= limit:
+                        break
+                spent = [(key, b[1] - b[2], now_ts) for key, b in budgets.items() if b[1] is not None and b[2]]
+                if spent:
+                    cur.executemany("""INSERT INTO key_state(key, tokens, refilled_at) VALUES (?,?,?)
+                                       ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, refilled_at = excluded.refilled_at""", spent)
+        except sqlite3.OperationalError as e:
+            if self.metrics is not None:
+                self.metrics.inc('claim_locked_total' if 'locked' in str(e) else 'claim_errors_total')
+            return []
+        return jobs
+
+    def _key_budgets(self, cur, now_ts):
+        """
+        {concurrency_key: [claims left, tokens now or None, claimed]} for every limited
+        key: the in-flight headroom and whole tokens in its bucket, whichever is less.
+        """
+        budgets = {}
+        for r in cur.execute("""SELECT l.key, l.max_in_flight, l.rate, l.burst, s.in_flight, s.tokens, s.refilled_at
+                                FROM key_limits l LEFT JOIN key_state s ON s.key = l.key""").fetchall():
+            left = float('inf') if r['max_in_flight'] is None else r['max_in_flight'] - (r['in_flight'] or 0)
+            tokens = None
+            if r['rate']:
+                tokens = r['burst'] if r['tokens'] is None else min(r['burst'], r['tokens'] + (now_ts - r['refilled_at']) * r['rate'])
+                left = min(left, int(tokens))
+            budgets[r['key']] = [left, tokens, 0]
+        return budgets
+
+    def _node_room(self, cur, node, reserved=None):
+        """
+        {'cpu': [budget, used], 'mem_mb': [budget, used]}, cpu in millicores, when a
+        pending job asks for resources, else None. The budget is node_cpu/node_mem_mb
+        or what the node has; used is its node_usage row. A resource nothing holds
+        counts as unlimited, so a job asking for more than the whole node still runs, alone.
+        """
+        if not self._sized_pending(cur):
             return None
-        finally:
-            c.close()
+        name, cores, mem_mb = node
+        r = cur.execute("""SELECT (SELECT cpu_milli FROM node_usage WHERE node = ?) AS cpu_milli,
+                                 (SELECT mem_mb FROM node_usage WHERE node = ?) AS mem_mb,
+                                 (SELECT value FROM config WHERE key = 'node_cpu') AS node_cpu,
+                                 (SELECT value FROM config WHERE key = 'node_mem_mb') AS node_mem_mb""", (name, name)).fetchone()
+        node_cpu = json.loads(r['node_cpu']) if r['node_cpu'] is not None else None
+        node_mem_mb = json.loads(r['node_mem_mb']) if r['node_mem_mb'] is not None else None
+        used_cpu, used_mem = r['cpu_milli'] or 0, r['mem_mb'] or 0
+        if reserved:
+            used_cpu += reserved[0]
+            used_mem += reserved[1]
+        return {'cpu': [int(float(node_cpu or cores) * 1000), used_cpu], 'mem_mb': [int(node_mem_mb or mem_mb), used_mem]}
 
-    def update_job_after_run(self, job_id, success, attempts, max_retries, error_msg=None, next_available_delay=0, stdout=None, stderr=None, duration=None, timed_out=False):
-        c = self._conn()
-        cur = c.cursor()
+    @staticmethod
+    def _sized_pending(cur):
+        return cur.execute("""SELECT EXISTS (SELECT 1 FROM jobs INDEXED BY idx_pending_sized
+                                              WHERE state = 'pending' AND (cpu IS NOT NULL OR mem_mb IS NOT NULL))""").fetchone()[0]
+
+    @staticmethod
+    def _room_filter(room):
+        """(condition, params) leaving out jobs too big for what the node has left."""
+        cond, params = '', []
+        budget, used = room['cpu']
+        if used:
+            cond += ' AND (cpu IS NULL OR cpu <= ?)'
+            params.append((budget - used) / 1000)
+        budget, used = room['mem_mb']
+        if used:
+            cond += ' AND (mem_mb IS NULL OR mem_mb <= ?)'
+            params.append(budget - used)
+        return cond, params
+
+    @staticmethod
+    def _reserve(room, cpu, mem_mb):
+        """Take a job's cpu/mem_mb from `room`; False (taking nothing) if it does not fit."""
+        need = {'cpu': round(cpu * 1000) if cpu else 0, 'mem_mb': mem_mb or 0}
+        for res, amount in need.items():
+            budget, used = room[res]
+            if amount and used and used + amount > budget:
+                return False
+        for res, amount in need.items():
+            room[res][1] += amount
+        return True
+
+    def _claim(self, cur, limit, now_ts, queue, lease, budgets=None, room=None):
+        # state is a literal so the partial (pending-only) indexes apply; INDEXED BY keeps the
+        # planner from sorting via idx_state_available when it has no statistics
+        where = "state = 'pending' AND available_at <= ?"
+        params = [now_ts]
+        index = 'idx_claim'
+        if queue is not None:
+            where += ' AND queue = ?'
+            params.append(queue)
+            index = 'idx_claim_queue'
+        if budgets or (room and limit > 1):
+            return self._claim_limited(cur, limit, index, where, params, lease, budgets or {}, room)
+        if room:
+            cond, more = self._room_filter(room)
+            where += cond
+            params += more
+        pick = f'SELECT rowid FROM jobs INDEXED BY {index} WHERE {where} ORDER BY priority DESC, seq LIMIT ?'
+        params.append(limit)
+        if HAS_RETURNING:
+            cur.execute(f"{self._CLAIM} WHERE rowid IN ({pick}) RETURNING {_JOB_COLS}", [now_iso()] + lease + params)
+            jobs = [dict(r) for r in cur.fetchall()]
+        else:
+            cur.execute(pick, params)
+            jobs = self._claim_rows(cur, [r[0] for r in cur.fetchall()], lease)
+        jobs.sort(key=lambda j: (-j['priority'], j['seq']))
+        return jobs
+
+    _CLAIM = "UPDATE jobs SET state = 'processing', updated_at = ?, worker_id = ?, lease_expires_at = ?, node = ?"
+
+    def _claim_rows(self, cur, rowids, lease):
+        if not rowids:
+            return []
+        marks = ','.join('?' * len(rowids))
+        if HAS_RETURNING:
+            cur.execute(f"{self._CLAIM} WHERE rowid IN ({marks}) RETURNING {_JOB_COLS}", [now_iso()] + lease + rowids)
+            return [dict(r) for r in cur.fetchall()]
+        cur.execute(f"{self._CLAIM} WHERE rowid IN ({marks})", [now_iso()] + lease + rowids)
+        cur.execute(f'SELECT {_JOB_COLS} FROM jobs WHERE rowid IN ({marks})', rowids)
+        return [dict(r) for r in cur.fetchall()]
+
+    def _claim_limited(self, cur, limit, index, where, params, lease, budgets, room=None):
+        """
+        The claim when some keys are limited or pending jobs ask for resources:
+        saturated keys and jobs bigger than what the node has left are excluded in the
+        index scan, and a picked job that runs out of budget because of the ones taken
+        before it in this batch stays pending (the pick then repeats for the remainder,
+        excluding it too).
+        """
+        jobs = []
+        while len(jobs) < limit:
+            full = [key for key, b in budgets.items() if b[0] < 1]
+            cond = f' AND (concurrency_key IS NULL OR concurrency_key NOT IN ({",".join("?" * len(full))}))' if full else ''
+            sized, more = self._room_filter(room) if room else ('', [])
+            n = limit - len(jobs)
+            rows = cur.execute(f'SELECT rowid, concurrency_key, cpu, mem_mb FROM jobs INDEXED BY {index} WHERE {where}{cond}{sized} ORDER BY priority DESC, seq LIMIT ?',
+                               params + full + more + [n]).fetchall()
+            take = []
+            for rowid, key, cpu, mem_mb in rows:
+                b = budgets.get(key)
+                if b is not None and b[0] < 1:
+                    continue
+                if room and not self._reserve(room, cpu, mem_mb):
+                    continue
+                if b is not None:
+                    b[0] -= 1
+                    b[2] += 1
+                take.append(rowid)
+            jobs += self._claim_rows(cur, take, lease)
+            if len(rows) < n:
+                break
+        jobs.sort(key=lambda j: (-j['priority'], j['seq']))
+        return jobs
+
+    def node_usage(self):
+        """{node: (cpu millicores, mem_mb)} reserved by the processing jobs of this database."""
+        rows = self._conn().execute('SELECT node, cpu_milli, mem_mb FROM node_usage WHERE cpu_milli > 0 OR mem_mb > 0 ORDER BY node')
+        return {r['node']: (r['cpu_milli'], r['mem_mb']) for r in rows}
+
+    def node_load(self, node):
+        """(cpu millicores, mem_mb) `node` holds here, and whether any pending job asks for resources."""
+        cur = self._conn().cursor()
+        r = cur.execute('SELECT cpu_milli, mem_mb FROM node_usage WHERE node = ?', (node,)).fetchone()
+        return (r[0], r[1]) if r else (0, 0), bool(self._sized_pending(cur))
+
+    def next_token_at(self):
+        """Earliest time a rate-limited key that is out of tokens gets one back, or None."""
+        return self._conn().execute("""SELECT MIN(s.refilled_at + (1 - s.tokens) / l.rate) FROM key_limits l JOIN key_state s ON s.key = l.key
+                                       WHERE l.rate > 0 AND s.tokens < 1""").fetchone()[0]
+
+    def set_key_limit(self, key, max_in_flight=None, rate=None, burst=None):
+        """
+        Limit the jobs of one concurrency_key: at most `max_in_flight` processing at
+        once and/or `rate` claims per second, with bursts of up to `burst` (default
+        max(1, rate)). Replaces any earlier limit of the key.
+        """
+        if max_in_flight is None and rate is None:
+            raise ValueError('give max_in_flight and/or rate')
+        if max_in_flight is not None and int(max_in_flight) < 1:
+            raise ValueError('max_in_flight must be at least 1')
+        if rate is not None and float(rate) <= 0:
+            raise ValueError('rate must be positive')
+        if burst is not None and (rate is None or float(burst) < 1):
+            raise ValueError('burst needs a rate and must be at least 1')
+        if rate is not None and burst is None:
+            burst = max(1.0, float(rate))
+        self._conn().execute('INSERT OR REPLACE INTO key_limits(key, max_in_flight, rate, burst) VALUES(?,?,?,?)',
+                             (key, None if max_in_flight is None else int(max_in_flight),
+                              None if rate is None else float(rate), None if burst is None else float(burst)))
+        self._notify()
+
+    def remove_key_limit(self, key):
+        cur = self._conn().execute('DELETE FROM key_limits WHERE key = ?', (key,))
+        if cur.rowcount:
+            self._notify()
+        return cur.rowcount > 0
+
+    def list_key_limits(self):
+        """Limits with their live in_flight count and current tokens."""
+        now_ts = time.time()
+        rows = self._conn().execute("""SELECT l.key, l.max_in_flight, l.rate, l.burst, IFNULL(s.in_flight, 0) AS in_flight,
+                                              s.tokens, s.refilled_at
+                                       FROM key_limits l LEFT JOIN key_state s ON s.key = l.key ORDER BY l.key""").fetchall()
+        out = []
+        for r in rows:
+            r = dict(r)
+            refilled = r.pop('refilled_at')
+            if r['rate']:
+                r['tokens'] = r['burst'] if r['tokens'] is None else min(r['burst'], r['tokens'] + (now_ts - refilled) * r['rate'])
+            out.append(r)
+        return out
+
+    def heartbeat(self, worker_id, lease_ttl):
+        """Extend the leases of every job `worker_id` holds in one statement; returns how many."""
+        cur = self._conn().execute("UPDATE jobs SET lease_expires_at = ? WHERE state = 'processing' AND worker_id = ?",
+                                   (time.time() + lease_ttl, worker_id))
+        return cur.rowcount
+
+    def reap_expired_leases(self, now_ts=None):
+        """
+        Return processing jobs whose lease ran out (their worker died or hung) to
+        pending, counting the lost attempt, or to dead if that was the last one.
+        An index seek on idx_lease. Returns the reaped job ids.
+        """
+        now_ts = now_ts or time.time()
+        with self._tx() as cur:
+            cur.execute("""SELECT rowid, id FROM jobs INDEXED BY idx_lease
+                           WHERE state = 'processing' AND lease_expires_at < ?""", (now_ts,))
+            rows = cur.fetchall()
+            if not rows:
+                return []
+            marks = ','.join('?' * len(rows))
+            cur.execute(f"""UPDATE jobs SET state = CASE WHEN attempts + 1 >= max_retries THEN 'dead' ELSE 'pending' END,
+                                attempts = attempts + 1, available_at = ?, updated_at = ?, lease_expires_at = NULL,
+                                last_error = 'lease expired (worker ' || IFNULL(worker_id, 'unknown') || ')'
+                            WHERE rowid IN ({marks})""", [now_ts, now_iso()] + [r['rowid'] for r in rows])
+        self._notify()
+        return [r['id'] for r in rows]
+
+    def expire_leases(self, worker_id):
+        """Expire every lease `worker_id` holds (it is known to be dead) and reap them now."""
+        self._conn().execute("UPDATE jobs SET lease_expires_at = 0 WHERE state = 'processing' AND worker_id = ?", (worker_id,))
+        return self.reap_expired_leases()
+
+    def release_jobs(self, job_ids):
+        """Hand claimed-but-unstarted jobs back to the queue without counting an attempt."""
+        job_ids = list(job_ids)
+        if not job_ids:
+            return
+        marks = ','.join('?' * len(job_ids))
+        self._conn().execute(f'UPDATE jobs SET state = ?, updated_at = ?, lease_expires_at = NULL WHERE state = ? AND id IN ({marks})', ['pending', now_iso(), 'processing'] + job_ids)
+        self._notify()
+
+    def update_job_after_run(self, job_id, success, attempts, max_retries, error_msg=None, next_available_delay=0, stdout=None, stderr=None, duration=None, timed_out=False, worker_id=None):
+        return self.update_jobs_after_run([dict(job_id=job_id, success=success, attempts=attempts, max_retries=max_retries,
+                                                error_msg=error_msg, next_available_delay=next_available_delay,
+                                                output=text_rows(job_id, attempts, stdout, stderr),
+                                                duration=duration, timed_out=timed_out, worker_id=worker_id)])
+
+    def update_jobs_after_run(self, results):
+        """
+        Write back a batch of job results in one transaction. Each result is a dict with
+        the keyword arguments of `update_job_after_run`, except that output arrives as
+        `output`: the remaining job_output rows of that attempt (see output.JobOutput),
+        plus the run's `peak_rss_kb` and `cpu_time` when they were measured.
+        Output of earlier attempts is dropped. A result only applies while its job is
+        still processing (and, given `worker_id`, still leased to that worker); the ids
+        whose lease was lost to the reaper are returned and their results discarded.
+        A completed job counts down pending_deps of the jobs blocked on it, releasing
+        those that reach 0; the dependents of a job that dies are marked dead after
+        the commit (by cascade_failures, unless this runs inside a larger transaction).
+        """
+        if not results:
+            return []
         updated = now_iso()
-        if success:
-            cur.execute('UPDATE jobs SET state = ?, attempts = ?, updated_at = ?, last_error = NULL, stdout = ?, stderr = ?, duration = ?, timed_out = ? WHERE id = ?', ('completed', attempts, updated, stdout, stderr, duration, int(bool(timed_out)), job_id))
+        lost = []
+        died = False
+        with self._tx() as cur:
+            for r in results:
+                job_id = r['job_id']
+                attempts = r['attempts']
+                next_avail = None
+                error_msg = None
+                if r['success']:
+                    state = 'completed'
+                elif attempts >= r['max_retries']:
+                    state = 'dead'
+                    error_msg = r.get('error_msg')
+                else:
+                    state = 'pending'
+                    error_msg = r.get('error_msg')
+                    next_avail = time.time() + (r.get('next_available_delay') or 0)
+                sql = ("UPDATE jobs SET state = ?, attempts = ?, updated_at = ?, available_at = COALESCE(?, available_at), "
+                       "last_error = ?, duration = ?, timed_out = ?, peak_rss_kb = ?, cpu_time = ?, lease_expires_at = NULL "
+                       "WHERE id = ? AND state = 'processing'")
+                params = [state, attempts, updated, next_avail, error_msg, r.get('duration'), int(bool(r.get('timed_out'))),
+                          r.get('peak_rss_kb'), r.get('cpu_time'), job_id]
+                if r.get('worker_id') is not None:
+                    sql += ' AND worker_id = ?'
+                    params.append(r['worker_id'])
+                cur.execute(sql, params)
+                if cur.rowcount == 0:
+                    lost.append(job_id)
+                    continue
+                died = died or state == 'dead'
+                if state == 'completed':
+                    cur.execute("""UPDATE jobs SET pending_deps = pending_deps - 1, updated_at = ?,
+                                       state = CASE WHEN pending_deps = 1 THEN 'pending' ELSE state END
+                                   WHERE state = 'blocked' AND id IN (SELECT child FROM job_deps WHERE parent = ?)""",
+                                (updated, job_id))
+                    if cur.rowcount:
+                        self._notify()
+                if attempts > 1:
+                    cur.execute('DELETE FROM job_output WHERE job_id = ? AND attempt < ?', (job_id, attempts))
+                if r.get('output'):
+                    cur.executemany(self._INSERT_OUTPUT, r['output'])
+        if died and not getattr(self._local, 'depth', 0):
+            self.cascade_failures()
+        return lost
+
+    _INSERT_OUTPUT = 'INSERT OR REPLACE INTO job_output(job_id,attempt,seq,stream,data) VALUES(?,?,?,?,?)'
+
+    def append_output(self, rows):
+        """Store output chunks flushed while a job is still running."""
+        if rows:
+            with self._tx() as cur:
+                cur.executemany(self._INSERT_OUTPUT, rows)
+
+    def read_output(self, job_id, after_seq=0, attempt=None, limit=256):
+        """
+        Return up to `limit` decompressed chunks [(seq, stream, bytes)] of one attempt
+        (the latest by default) with seq > after_seq, for incremental readers.
+        """
+        if attempt is None:
+            attempt = self.output_attempt(job_id)
+            if attempt is None:
+                return []
+        cur = self._conn().execute('SELECT seq, stream, data FROM job_output WHERE job_id = ? AND attempt = ? AND seq > ? ORDER BY seq LIMIT ?',
+                        (job_id, attempt, after_seq, limit))
+        return [(r['seq'], r['stream'], decompress(r['data'])) for r in cur.fetchall()]
+
+    def output_attempt(self, job_id):
+        """Latest attempt of `job_id` that has stored output, or None."""
+        row = self._conn().execute('SELECT MAX(attempt) AS a FROM job_output WHERE job_id = ?', (job_id,)).fetchone()
+        return row['a']
+
+    def get_output(self, job_id):
+        """Whole retained output of the latest attempt as {'stdout': str, 'stderr': str}."""
+        out = {'stdout': bytearray(), 'stderr': bytearray()}
+        seq = 0
+        while True:
+            chunks = self.read_output(job_id, after_seq=seq)
+            if not chunks:
+                break
+            for seq, stream, data in chunks:
+                out[stream] += data
+        return {k: v.decode(errors='replace') for k, v in out.items()}
+
+    def get_job(self, job_id):
+        row = self._conn().execute(f'SELECT {_JOB_COLS} FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def get_status_counts(self, queue=None):
+        """Job counts by state, read from the trigger-maintained queue_stats table."""
+        if queue is None:
+            cur = self._conn().execute('SELECT state, SUM(count) AS cnt FROM queue_stats GROUP BY state')
         else:
-            if attempts >= max_retries:
-                cur.execute('UPDATE jobs SET state = ?, attempts = ?, updated_at = ?, last_error = ?, stdout = ?, stderr = ?, duration = ?, timed_out = ? WHERE id = ?', ('dead', attempts, updated, error_msg, stdout, stderr, duration, int(bool(timed_out)), job_id))
-            else:
-                next_avail = time.time() + next_available_delay
-                cur.execute('UPDATE jobs SET state = ?, attempts = ?, updated_at = ?, available_at = ?, last_error = ?, stdout = ?, stderr = ?, duration = ?, timed_out = ? WHERE id = ?', ('pending', attempts, updated, next_avail, error_msg, stdout, stderr, duration, int(bool(timed_out)), job_id))
-        c.commit()
-        c.close()
+            cur = self._conn().execute('SELECT state, count AS cnt FROM queue_stats WHERE queue = ?', (queue,))
+        return {r['state']: r['cnt'] for r in cur.fetchall() if r['cnt']}
 
-    def get_status_counts(self):
-        c = self._conn()
-        cur = c.cursor()
-        cur.execute("SELECT state, COUNT(*) as cnt FROM jobs GROUP BY state")
-        rows = cur.fetchall()
-        c.close()
-        return {r['state']: r['cnt'] for r in rows}
+    def get_queue_stats(self):
+        """{queue: {state: count}} from queue_stats."""
+        out = {}
+        for r in self._conn().execute('SELECT queue, state, count FROM queue_stats WHERE count != 0 ORDER BY queue, state'):
+            out.setdefault(r['queue'], {})[r['state']] = r['count']
+        return out
+
+    def register_worker(self, worker_id, hostname, pid, mode, supervisor=None, state='running'):
+        """Record a live worker (or supervisor) process; re-registering refreshes it."""
+        now_ts = time.time()
+        self._conn().execute('''INSERT INTO workers(id, hostname, pid, mode, state, supervisor, started_at, last_seen)
+                                VALUES(?,?,?,?,?,?,?,?)
+                                ON CONFLICT(id) DO UPDATE SET state = excluded.state, last_seen = excluded.last_seen,
+                                supervisor = COALESCE(excluded.supervisor, workers.supervisor)''',
+                             (worker_id, hostname, pid, mode, state, supervisor, now_ts, now_ts))
+
+    def touch_worker(self, worker_id):
+        self._conn().execute('UPDATE workers SET last_seen = ? WHERE id = ?', (time.time(), worker_id))
+
+    def set_worker_state(self, worker_id, state):
+        self._conn().execute('UPDATE workers SET state = ? WHERE id = ?', (state, worker_id))
+
+    def remove_worker(self, worker_id):
+        self._conn().execute('DELETE FROM workers WHERE id = ?', (worker_id,))
+
+    def list_workers(self, hostname=None):
+        sql = 'SELECT * FROM workers'
+        params = []
+        if hostname:
+            sql += ' WHERE hostname = ?'
+            params.append(hostname)
+        return [dict(r) for r in self._conn().execute(sql + ' ORDER BY started_at', params)]
+
+    def prune_workers(self, stale_after):
+        """Forget workers not seen for `stale_after` seconds (killed without cleaning up)."""
+        cur = self._conn().execute('DELETE FROM workers WHERE last_seen < ?', (time.time() - stale_after,))
+        return cur.rowcount
+
+    def add_metrics(self, worker, rows):
+        """Add (name, key, delta) rows to `worker`'s totals in one transaction."""
+        if not rows:
+            return
+        now_ts = time.time()
+        with self._tx() as cur:
+            cur.executemany('''INSERT INTO metrics(worker, name, key, value, updated_at) VALUES(?,?,?,?,?)
+                               ON CONFLICT(worker, name, key) DO UPDATE SET value = value + excluded.value,
+                               updated_at = excluded.updated_at''',
+                            [(worker, name, key, value, now_ts) for name, key, value in rows])
+
+    def get_metrics(self, worker=None):
+        """All metric rows (worker, name, key, value, updated_at), optionally for one worker."""
+        sql = 'SELECT worker, name, key, value, updated_at FROM metrics'
+        params = []
+        if worker:
+            sql += ' WHERE worker = ?'
+            params.append(worker)
+        return [dict(r) for r in self._conn().execute(sql + ' ORDER BY worker, name, key', params)]
+
+    def count_completed_since(self, since_ts):
+        """Jobs that completed at or after `since_ts` (and are not yet gc'd)."""
+        return self._conn().execute("SELECT COUNT(*) FROM jobs WHERE state = 'completed' AND updated_at >= ?",
+                                    (_iso(since_ts),)).fetchone()[0]
+
+    def metric_totals(self, name):
+        """{key: value summed over all workers} for one metric."""
+        return {r[0]: r[1] for r in self._conn().execute('SELECT key, SUM(value) FROM metrics WHERE name = ? GROUP BY key', (name,))}
+
+    def reset_metrics(self):
+        self._conn().execute('DELETE FROM metrics')
+
+    def add_schedule(self, name, cron, job, next_run):
+        """Create or replace the schedule `name`; `job` is the template (a dict) of every job it fires."""
+        self._job_row(dict(job))
+        with self._tx() as cur:
+            cur.execute('INSERT OR REPLACE INTO schedules(name, cron, job, next_run, created_at) VALUES(?,?,?,?,?)',
+                        (name, cron, json.dumps(job), next_run, now_iso()))
+            self._bump_schedules(cur)
+
+    def remove_schedule(self, name):
+        with self._tx() as cur:
+            cur.execute('DELETE FROM schedules WHERE name = ?', (name,))
+            removed = cur.rowcount
+            self._bump_schedules(cur)
+        return bool(removed)
+
+    def _bump_schedules(self, cur):
+        # running schedulers reload their heap when this changes
+        cur.execute("""INSERT INTO config(key, value) VALUES('schedules_rev', '1')
+                       ON CONFLICT(key) DO UPDATE SET value = CAST(value + 1 AS TEXT)""")
+
+    def list_schedules(self):
+        rows = self._conn().execute('SELECT name, cron, job, next_run, last_run, created_at FROM schedules ORDER BY next_run, name')
+        return [dict(r, job=json.loads(r['job'])) for r in rows]
+
+    def advance_schedules(self, updates):
+        """
+        Record fired schedules: `updates` are (name, fired next_run, new next_run, fire time).
+        A row only moves if its next_run is still the one fired, so two schedulers
+        never advance the same tick twice. Returns the names that moved.
+        """
+        moved = []
+        with self._tx() as cur:
+            for name, fired, next_run, last_run in updates:
+                cur.execute('UPDATE schedules SET next_run = ?, last_run = ? WHERE name = ? AND next_run = ?',
+                            (next_run, last_run, name, fired))
+                if cur.rowcount:
+                    moved.append(name)
+        return moved
+
+    def verify_status_counts(self, repair=True):
+        """
+        Reconcile queue_stats against a full count of the jobs table. Returns a list of
+        (queue, state, counter, actual) mismatches; with `repair` they are fixed.
+        """
+        with self._tx() as cur:
+            actual = {(r['queue'], r['state']): r['cnt'] for r in
+                      cur.execute('SELECT queue, state, COUNT(*) AS cnt FROM jobs GROUP BY queue, state').fetchall()}
+            stored = {(r['queue'], r['state']): r['count'] for r in cur.execute('SELECT queue, state, count FROM queue_stats').fetchall()}
+            diffs = [(q, st, stored.get((q, st), 0), actual.get((q, st), 0))
+                     for q, st in sorted(set(actual) | set(stored)) if stored.get((q, st), 0) != actual.get((q, st), 0)]
+            if repair and diffs:
+                cur.execute('DELETE FROM queue_stats')
+                cur.executemany('INSERT INTO queue_stats(queue, state, count) VALUES(?,?,?)',
+                                [(q, st, n) for (q, st), n in actual.items()])
+        return diffs
 
     def list_jobs(self, state=None):
+        return [row for _, row in self.iter_jobs(state=state)]
+
+    def iter_jobs(self, state=None, queue=None, since=None, until=None, error=None, fields=None,
+                  limit=None, after=None, batch_size=500):
+        """
+        Stream jobs in enqueue order as (cursor, row) pairs with constant memory.
+        Rows are fetched in keyset-paginated batches of `batch_size`, so no read
+        transaction stays open while the caller consumes them. `since`/`until` bound
+        the enqueue time (epoch seconds), or for state 'dead' the time the job died;
+        `error` matches a substring of last_error,
+        `fields` projects the columns read (output bytes are never read), and
+        `after` resumes from a cursor previously yielded.
+        """
+        fields = list(fields or JOB_COLUMNS)
+        unknown = [f for f in fields if f not in JOB_COLUMNS]
+        if unknown:
+            raise ValueError(f"unknown field(s): {', '.join(unknown)}")
+        cols = ','.join(dict.fromkeys(fields + ['seq', 'id']))
+        where, params = _job_filter(state, queue, since, until, error)
+        last = None
+        if after:
+            seq, _, job_id = after.partition(':')
+            last = (int(seq), job_id)
+        remaining = limit
         c = self._conn()
-        cur = c.cursor()
-        if state:
-            cur.execute('SELECT * FROM jobs WHERE state = ? ORDER BY created_at', (state,))
-        else:
-            cur.execute('SELECT * FROM jobs ORDER BY created_at')
-        rows = cur.fetchall()
-        c.close()
-        return [dict(r) for r in rows]
+        while remaining is None or remaining > 0:
+            conds = list(where)
+            args = list(params)
+            if last is not None:
+                conds.append('(seq, id) > (?, ?)')
+                args += list(last)
+            n = batch_size if remaining is None else min(batch_size, remaining)
+            sql = f"SELECT {cols} FROM jobs {'WHERE ' + ' AND '.join(conds) if conds else ''} ORDER BY seq, id LIMIT ?"
+            rows = c.execute(sql, args + [n]).fetchall()
+            for r in rows:
+                last = (r['seq'], r['id'])
+                yield f'{last[0]}:{last[1]}', {f: r[f] for f in fields}
+            if remaining is not None:
+                remaining -= len(rows)
+            if len(rows) < n:
+                return
+
+    def _delete_jobs(self, cur, rowids):
+        """
+        Delete jobs (by rowid) with their output and the dependency edges out of them.
+        A job still waiting on a deleted job that never completed cannot run: it is
+        marked dead if it was blocked (its own dependents follow via cascade_failures),
+        and its pending_deps keeps counting the deleted parent, which is how dlq_retry
+        tells that it can never be released. Returns how many jobs were marked dead.
+        """
+        marks = ','.join('?' * len(rowids))
+        gone = f"SELECT d.child, d.parent FROM job_deps d CROSS JOIN jobs p ON p.id = d.parent WHERE p.rowid IN ({marks}) AND p.state != 'completed'"
+        cur.execute(f"""UPDATE jobs SET state = 'dead', updated_at = ?,
+                              last_error = 'dependency ' || (SELECT g.parent FROM ({gone}) g WHERE g.child = jobs.id LIMIT 1) || ' was deleted'
+                          WHERE state = 'blocked' AND id IN (SELECT child FROM ({gone}))""", [now_iso()] + rowids + rowids)
+        marked = cur.rowcount
+        cur.execute(f'DELETE FROM job_output WHERE job_id IN (SELECT id FROM jobs WHERE rowid IN ({marks}))', rowids)
+        cur.execute(f'DELETE FROM job_deps WHERE parent IN (SELECT id FROM jobs WHERE rowid IN ({marks}))', rowids)
+        cur.execute(f'DELETE FROM dep_failures WHERE job_id IN (SELECT id FROM jobs WHERE rowid IN ({marks}))', rowids)
+        cur.execute(f'DELETE FROM jobs WHERE rowid IN ({marks})', rowids)
+        return marked
+
+    # parents a job still counts in pending_deps but that are gone (deleted while it waited)
+    _MISSING_PARENTS = """{job}.pending_deps > 0 AND {job}.pending_deps > (SELECT COUNT(*) FROM job_deps d CROSS JOIN jobs p ON p.id = d.parent
+                                                                           WHERE d.child = {job}.id AND p.state != 'completed')"""
 
     def dlq_retry(self, job_id):
-        c = self._conn()
-        cur = c.cursor()
-        cur.execute('SELECT * FROM jobs WHERE id = ? AND state = ?', (job_id, 'dead'))
-        row = cur.fetchone()
-        if not row:
-            c.close()
-            return False, 'not found or not dead'
-        cur.execute('UPDATE jobs SET state = ?, attempts = ?, available_at = ?, updated_at = ?, last_error = NULL WHERE id = ?', ('pending', 0, 0, now_iso(), job_id))
-        c.commit()
-        c.close()
+        """
+        Requeue a dead job: pending again, or blocked if it still waits on parents.
+        A job whose parent is itself dead stays dead until that parent is retried,
+        and one whose parent was deleted (purged or gc'd) stays dead for good.
+        """
+        with self._tx() as cur:
+            dead = cur.execute("""SELECT d.parent FROM job_deps d CROSS JOIN jobs p ON p.id = d.parent
+                                  WHERE d.child = ? AND p.state = 'dead' LIMIT 1""", (job_id,)).fetchone()
+            if dead is not None:
+                return False, f'dependency {dead[0]} is dead; retry it first'
+            missing = cur.execute(f'SELECT 1 FROM jobs j WHERE id = ? AND {self._MISSING_PARENTS.format(job="j")}', (job_id,)).fetchone()
+            if missing is not None:
+                return False, 'a dependency was deleted; it can never run'
+            cur.execute("""UPDATE jobs SET state = CASE WHEN pending_deps > 0 THEN 'blocked' ELSE 'pending' END,
+                                  attempts = 0, available_at = 0, updated_at = ?, last_error = NULL
+                              WHERE id = ? AND state = 'dead'""", (now_iso(), job_id))
+            if cur.rowcount == 0:
+                return False, 'not found or not dead'
+            # its blocked children are no longer doomed
+            cur.execute('DELETE FROM dep_failures WHERE job_id = ?', (job_id,))
+        self._notify()
         return True, None
 
-    def set_config(self, key, value):
+    def dlq_retry_many(self, queue=None, since=None, until=None, error=None, limit=None, stagger=0,
+                       batch_size=1000, pause=0.01, on_batch=None):
+        """
+        Requeue dead jobs matching the filters (as iter_jobs), oldest first, up to
+        `limit`, one UPDATE per batch of `batch_size` in its own short transaction.
+        With `stagger` seconds they fall due at random times across that window
+        rather than all at once. Jobs whose parent is still dead (or was deleted) are
+        left alone (parents requeued in the same run come first, so their children follow).
+        Returns the number requeued.
+        """
+        where, params = _job_filter('dead', queue, since, until, error)
+        where.append("""NOT EXISTS (SELECT 1 FROM job_deps d CROSS JOIN jobs p ON p.id = d.parent
+                                  WHERE d.child = jobs.id AND p.state = 'dead')""")
+        where.append(f'NOT ({self._MISSING_PARENTS.format(job="jobs")})')
+        done = 0
+        # keyset passes over the dead jobs in (seq, id) order; a pass that requeued
+        # parents is followed by another, for the children it had to skip
+        last = None
+        swept = 0
+        while limit is None or done < limit:
+            n = batch_size if limit is None else min(batch_size, limit - done)
+            with self._tx() as cur:
+                conds = where + (['(seq, id) > (?, ?)'] if last else [])
+                rows = cur.execute(f'SELECT rowid, seq, id FROM jobs WHERE {" AND ".join(conds)} ORDER BY seq, id LIMIT ?',
+                                   params + list(last or ()) + [n]).fetchall()
+                if not rows:
+                    if last is None or not swept:
+                        break
+                    last, swept = None, 0
+                    continue
+                rowids = [r[0] for r in rows]
+                marks = ','.join('?' * len(rowids))
+                cur.execute(f"""UPDATE jobs SET state = CASE WHEN pending_deps > 0 THEN 'blocked' ELSE 'pending' END,
+                                      attempts = 0, updated_at = ?, last_error = NULL,
+                                      available_at = ? + (abs(random()) % 1000000) / 1000000.0 * ?
+                                  WHERE rowid IN ({marks})""", [now_iso(), time.time(), float(stagger or 0)] + rowids)
+                cur.execute(f'DELETE FROM dep_failures WHERE job_id IN (SELECT id FROM jobs WHERE rowid IN ({marks}))', rowids)
+                self._notify()
+            last = (rows[-1]['seq'], rows[-1]['id'])
+            swept += len(rowids)
+            done += len(rowids)
+            if on_batch:
+                on_batch(len(rowids))
+            time.sleep(pause)
+        return done
+
+    def dlq_purge(self, queue=None, since=None, until=None, error=None, limit=None, batch_size=1000, pause=0.01, on_batch=None):
+        """
+        Delete dead jobs matching the filters (as iter_jobs) with their output, in
+        batches like dlq_retry_many (see _delete_jobs for their dependents). Returns
+        the number deleted.
+        """
+        where, params = _job_filter('dead', queue, since, until, error)
+        done = 0
+        orphaned = 0
+        while limit is None or done < limit:
+            n = batch_size if limit is None else min(batch_size, limit - done)
+            with self._tx() as cur:
+                rowids = [r[0] for r in cur.execute(f'SELECT rowid FROM jobs WHERE {" AND ".join(where)} ORDER BY seq LIMIT ?',
+                                                    params + [n]).fetchall()]
+                if not rowids:
+                    break
+                orphaned += self._delete_jobs(cur, rowids)
+            done += len(rowids)
+            if on_batch:
+                on_batch(len(rowids))
+            if len(rowids) < n:
+                break
+            time.sleep(pause)
+        if orphaned:
+            self.cascade_failures()
+        return done
+
+    def dlq_summary(self, limit=20):
+        """
+        Dead jobs grouped by (last_error, first 32 characters of the command), largest
+        groups first: [{last_error, command, count, first, last}] with first/last the
+        oldest and newest updated_at. Walks idx_dead_summary, so only dead rows are
+        visited and they arrive already grouped.
+        """
+        rows = self._conn().execute(f"""SELECT last_error, {_DLQ_PREFIX} AS command, COUNT(*) AS count,
+                                                 MIN(updated_at) AS first, MAX(updated_at) AS last
+                                          FROM jobs INDEXED BY idx_dead_summary WHERE state = 'dead'
+                                          GROUP BY last_error, {_DLQ_PREFIX} ORDER BY count DESC, last_error LIMIT ?""",
+                                    (-1 if limit is None else limit,)).fetchall()
+        return [dict(r) for r in rows]
+
+    def cascade_failures(self, batch_size=500, pause=0.01):
+        """
+        Mark dead every blocked job downstream of a dead one, walking at most
+        `batch_size` edges per short transaction (children killed here cascade
+        to their own children in later batches). Returns how many were marked.
+        """
+        marked = 0
+        while True:
+            budget = batch_size
+            with self._tx() as cur:
+                failures = cur.execute('SELECT job_id, after FROM dep_failures LIMIT ?', (batch_size,)).fetchall()
+                for f in failures:
+                    children = [r[0] for r in cur.execute('SELECT child FROM job_deps WHERE parent = ? AND child > ? ORDER BY child LIMIT ?',
+                                                          (f['job_id'], f['after'], budget)).fetchall()]
+                    budget -= len(children)
+                    if children:
+                        marks = ','.join('?' * len(children))
+                        cur.execute(f"UPDATE jobs SET state = 'dead', updated_at = ?, last_error = ? WHERE state = 'blocked' AND id IN ({marks})",
+                                    [now_iso(), f'dependency {f["job_id"]} failed'] + children)
+                        marked += cur.rowcount
+                    if budget > 0:
+                        cur.execute('DELETE FROM dep_failures WHERE job_id = ?', (f['job_id'],))
+                    else:
+                        cur.execute('UPDATE dep_failures SET after = ? WHERE job_id = ?', (children[-1], f['job_id']))
+                        break
+            if not failures:
+                return marked
+            time.sleep(pause)
+
+    def job_graph(self, job_id, depth=5, limit=1000):
+        """
+        Edges around `job_id` up to `depth` hops: {'up': [...], 'down': [...]}, each edge a
+        dict(parent, child, state, pending_deps) where state is that of the node farther
+        from `job_id` (None if it was deleted). At most `limit` edges each way.
+        """
+        out = {}
+        for name, near, far in (('up', 'child', 'parent'), ('down', 'parent', 'child')):
+            rows = self._conn().execute(f"""
+                WITH RECURSIVE walk(parent, child, depth) AS (
+                    SELECT parent, child, 1 FROM job_deps WHERE {near} = ?
+                    UNION
+                    SELECT d.parent, d.child, walk.depth + 1 FROM job_deps d JOIN walk ON d.{near} = walk.{far}
+                    WHERE walk.depth < ?)
+                SELECT DISTINCT walk.parent, walk.child, j.state, j.pending_deps
+                FROM walk LEFT JOIN jobs j ON j.id = walk.{far} LIMIT ?""", (job_id, depth, limit)).fetchall()
+            out[name] = [dict(r) for r in rows]
+        return out
+
+    def gc_jobs(self, state, max_age=None, keep=None, batch_size=500, archive=None, pause=0.01, on_batch=None):
+        """
+        Remove finished jobs of one `state` (with their output) that are older than
+        `max_age` seconds or beyond the newest `keep`. Rows go in batches of
+        `batch_size`, each in its own short transaction with a `pause` in between so
+        workers are never stalled for long. With `archive` (see archive.open_archive)
+        every batch is copied there before it is deleted. Jobs that depend on a removed
+        one are handled as in _delete_jobs. Returns the number removed.
+        """
+        if state in ('pending', 'processing', 'blocked'):
+            raise ValueError(f'refusing to gc {state} jobs')
+        if max_age is None and keep is None:
+            raise ValueError('gc needs max_age and/or keep')
         c = self._conn()
-        cur = c.cursor()
-        cur.execute('INSERT OR REPLACE INTO config(key,value) VALUES(?,?)', (key, json.dumps(value)))
-        c.commit()
-        c.close()
+        cutoffs = []
+        if max_age is not None:
+            cutoffs.append(datetime.fromtimestamp(time.time() - max_age, timezone.utc).isoformat())
+        if keep is not None:
+            if int(keep) <= 0:
+                cutoffs.append('\uffff')
+            else:
+                row = c.execute('SELECT updated_at FROM jobs WHERE state = ? ORDER BY updated_at DESC LIMIT 1 OFFSET ?',
+                                (state, int(keep) - 1)).fetchone()
+                if row is not None:
+                    cutoffs.append(row['updated_at'])
+        if not cutoffs:
+            return 0
+        cutoff = max(cutoffs)
+        removed = 0
+        orphaned = 0
+        if archive is not None:
+            archive.open(c)
+        try:
+            while True:
+                with self._tx() as cur:
+                    rowids = [r[0] for r in cur.execute('SELECT rowid FROM jobs WHERE state = ? AND updated_at < ? ORDER BY updated_at LIMIT ?',
+                                                        (state, cutoff, batch_size)).fetchall()]
+                    if not rowids:
+                        break
+                    marks = ','.join('?' * len(rowids))
+                    if archive is not None:
+                        archive.store(cur, rowids, marks)
+                    orphaned += self._delete_jobs(cur, rowids)
+                removed += len(rowids)
+                if on_batch:
+                    on_batch(len(rowids))
+                if len(rowids) < batch_size:
+                    break
+                time.sleep(pause)
+        finally:
+            if archive is not None:
+                archive.close(c)
+        if orphaned:
+            self.cascade_failures()
+        return removed
 
-    def get_config(self, key):
+    def run_retention(self, policy, archive=None, batch_size=500, on_batch=None):
+        """
+        Apply a retention policy {state: {'max_age': duration, 'keep': n}} via gc_jobs.
+        Returns {state: removed}.
+        """
+        removed = {}
+        for state, rule in policy.items():
+            max_age = rule.get('max_age')
+            removed[state] = self.gc_jobs(state, max_age=None if max_age is None else parse_duration(max_age),
+                                          keep=rule.get('keep'), batch_size=batch_size, archive=archive,
+                                          on_batch=on_batch)
+        return removed
+
+    def compact(self, vacuum_pages=1000, checkpoint='PASSIVE'):
+        """
+        Return up to `vacuum_pages` free pages to the OS (incremental vacuum; a no-op
+        unless auto_vacuum is INCREMENTAL) and checkpoint the WAL. Returns
+        (free pages left, (busy, wal frames, frames checkpointed)).
+        """
         c = self._conn()
-        cur = c.cursor()
-        cur.execute('SELECT value FROM config WHERE key = ?', (key,))
-        row = cur.fetchone()
-        c.close()
+        if vacuum_pages:
+            c.execute(f'PRAGMA incremental_vacuum({int(vacuum_pages)})').fetchall()
+        mode = checkpoint.upper()
+        if mode not in ('PASSIVE', 'FULL', 'RESTART', 'TRUNCATE'):
+            raise ValueError(f'unknown checkpoint mode {checkpoint}')
+        ckpt = tuple(c.execute(f'PRAGMA wal_checkpoint({mode})').fetchone())
+        free = c.execute('PRAGMA freelist_count').fetchone()[0]
+        return free, ckpt
+
+    def vacuum(self):
+        """Full VACUUM (takes an exclusive lock); also switches the file to incremental auto_vacuum."""
+        c = self._conn()
+        c.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        c.execute('VACUUM')
+
+    def try_claim_periodic(self, name, interval):
+        """
+        Compare-and-set on a `<name>_last_run` config entry so only one of many workers
+        runs a periodic chore per `interval` seconds. Returns True for the winner.
+        """
+        key = f'{name}_last_run'
+        now_ts = time.time()
+        with self._tx() as cur:
+            row = cur.execute('SELECT value FROM config WHERE key = ?', (key,)).fetchone()
+            if row is not None and now_ts - json.loads(row['value']) < interval:
+                return False
+            cur.execute('INSERT OR REPLACE INTO config(key,value) VALUES(?,?)', (key, json.dumps(now_ts)))
+        return True
+
+    def set_config(self, key, value):
+        self._conn().execute('INSERT OR REPLACE INTO config(key,value) VALUES(?,?)', (key, json.dumps(value)))
+
+    def get_config(self, key):
+        row = self._conn().execute('SELECT value FROM config WHERE key = ?', (key,)).fetchone()
         if not row:
             return None
         return json.loads(row['value'])
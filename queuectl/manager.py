@@ -1,41 +1,190 @@
 import os
-import json
+import math
+import time
 import signal
+import socket
+import threading
+from collections import deque
 from multiprocessing import Process
-from .worker import worker_loop
+from .db import DEFAULT_CONFIG
+from .broker import open_db
+from .worker import worker_loop, lease_owner
+from .async_worker import async_worker_loop
 
-PID_FILE = os.path.join(os.getcwd(), 'queuectl_workers.pid')
+# a worker crashing more often than this is restarted no faster than once per tick
+MAX_RESTARTS = 5
+RESTART_WINDOW = 60.0
+
+def desired_workers(current, pending, wait, lo, hi, capacity=1, target_wait=1.0, idle_ticks=0, scale_down_after=5):
+    """
+    Worker count for the next tick. Grows (at most doubling) while the runnable
+    backlog exceeds what the current workers can hold or the observed queue wait
+    is above `target_wait`; shrinks by one once the queue has been empty for
+    `scale_down_after` ticks. Always within [lo, hi].
+    """
+    if pending > current * capacity or (wait is not None and wait > target_wait):
+        want = max(current + 1, math.ceil(pending / max(1, capacity)))
+        want = min(want, max(1, current * 2))
+    elif pending == 0 and idle_ticks >= scale_down_after:
+        want = current - 1
+    else:
+        want = current
+    return max(lo, min(hi, want))
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
 
 class WorkerManager:
-    def __init__(self):
-        self.procs = []
-
-    def start(self, count):
-        for i in range(count):
-            # do NOT pass multiprocessing.Event here; child creates its own stop flag
-            p = Process(target=worker_loop, args=(i+1,))
-            p.start()
-            self.procs.append(p)
-        with open(PID_FILE, 'w') as f:
-            f.write(json.dumps([p.pid for p in self.procs]))
-        print(f"Started {len(self.procs)} worker(s). PIDs written to {PID_FILE}")
+    """
+    Supervisor behind `worker start`: keeps between `min` and `max` worker
+    processes alive, scaling on the pending backlog and the queue wait workers
+    report through the metrics table, restarting workers that die (their leases
+    are reaped at once) and draining surplus ones with SIGTERM. Every process is
+    tracked in the workers table, which `worker stop` and `status` read.
+    """
+    def __init__(self, db=None):
+        self.db = db or open_db()
+        self.hostname = socket.gethostname()
+        self.id = lease_owner()
+        # pid -> Process in spawn order (dicts keep insertion order), newest last
+        self.procs = {}
+        self.draining = {}
+        self.crashes = deque()
+        self.stop_event = threading.Event()
+        self.next_slot = 1
 
-    def stop(self):
-        if not os.path.exists(PID_FILE):
-            print('No PID file found; no workers appear to be running')
-            return
+    def _spawn(self):
+        slot = self.next_slot
+        self.next_slot += 1
+        if self.mode == 'async':
+            p = Process(target=async_worker_loop, args=(slot, self.concurrency, self.queues))
+        else:
+            p = Process(target=worker_loop, args=(slot, self.prefetch, self.queues))
+        p.start()
+        self.db.register_worker(f'{self.hostname}:{p.pid}', self.hostname, p.pid, self.mode, supervisor=self.id)
+        self.procs[p.pid] = p
+
+    def _drain(self, pid):
+        p = self.procs.pop(pid)
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+        self.db.set_worker_state(f'{self.hostname}:{pid}', 'draining')
+        self.draining[pid] = p
+
+    def _collect(self):
+        """Forget exited workers; a worker that exited unasked has its jobs requeued."""
+        for pid, p in list(self.procs.items()):
+            if p.is_alive():
+                continue
+            p.join()
+            del self.procs[pid]
+            wid = f'{self.hostname}:{pid}'
+            reaped = self.db.expire_leases(wid)
+            self.db.remove_worker(wid)
+            self.crashes.append(time.time())
+            print(f"[supervisor] worker {wid} exited unexpectedly (exit {p.exitcode}); requeued {len(reaped)} job(s)")
+        for pid, p in list(self.draining.items()):
+            if not p.is_alive():
+                p.join()
+                del self.draining[pid]
+                self.db.remove_worker(f'{self.hostname}:{pid}')
+
+    def _can_restart(self):
+        while self.crashes and self.crashes[0] < time.time() - RESTART_WINDOW:
+            self.crashes.popleft()
+        return len(self.crashes) < MAX_RESTARTS
+
+    def _observe(self):
+        """(runnable backlog in our queues, mean queue wait since the last tick or None)."""
+        stats = self.db.get_queue_stats()
+        names = [q for q, _ in self.queues] if self.queues else list(stats)
+        pending = sum(stats.get(q, {}).get('pending', 0) for q in names)
+        totals = self.db.metric_totals('queue_wait_seconds')
+        now = (totals.get('sum', 0), totals.get('count', 0))
+        prev, self.last_wait = self.last_wait, now
+        if prev is None or now[1] <= prev[1]:
+            return pending, None
+        return pending, (now[0] - prev[0]) / (now[1] - prev[1])
+
+    def supervise(self, min_workers, max_workers, prefetch=1, mode='sync', concurrency=10, queues=None, interval=2.0):
+        """Run until SIGTERM/SIGINT, then drain every worker and return."""
+        self.prefetch, self.mode, self.concurrency, self.queues = prefetch, mode, concurrency, queues
+        lo, hi = max(0, min_workers), max(1, max_workers, min_workers)
+        capacity = concurrency if mode == 'async' else 1
+        target_wait = float(self.db.get_config('autoscale_target_wait') or DEFAULT_CONFIG['autoscale_target_wait'])
+        self.last_wait = None
+
+        def handle_signal(signum, frame):
+            self.stop_event.set()
+
+        signal.signal(signal.SIGINT, handle_signal)
+        signal.signal(signal.SIGTERM, handle_signal)
+        self.db.register_worker(self.id, self.hostname, os.getpid(), 'supervisor')
+        print(f"[supervisor] started (pid={os.getpid()}, workers {lo}..{hi}, mode={mode})")
+        target = lo
+        idle_ticks = 0
         try:
-            with open(PID_FILE, 'r') as f:
-                pids = json.loads(f.read())
-        except Exception:
-            pids = []
-        print(f"Will attempt graceful shutdown of {len(pids)} worker(s)")
-        for pid in pids:
+            while True:
+                self._collect()
+                while len(self.procs) < target and self._can_restart():
+                    self._spawn()
+                while len(self.procs) > target:
+                    # the newest worker: pids wrap, so the highest may be the oldest, mid long jobs
+                    self._drain(next(reversed(self.procs)))
+                if self.stop_event.wait(interval):
+                    break
+                self.db.touch_worker(self.id)
+                pending, wait = self._observe()
+                idle_ticks = idle_ticks + 1 if pending == 0 else 0
+                want = desired_workers(len(self.procs), pending, wait, lo, hi, capacity, target_wait, idle_ticks)
+                if want != target:
+                    print(f"[supervisor] scaling {len(self.procs)} -> {want} worker(s) (pending={pending}, "
+                          f"wait={'n/a' if wait is None else f'{wait:.2f}s'})")
+                    if want < target:
+                        idle_ticks = 0
+                    target = want
+        finally:
+            print(f"[supervisor] draining {len(self.procs)} worker(s)")
+            for pid in list(self.procs):
+                self._drain(pid)
+            for p in self.draining.values():
+                p.join()
+            self._collect()
+            self.db.remove_worker(self.id)
+            print('[supervisor] exiting')
+
+    def stop(self):
+        """
+        SIGTERM every supervisor and unsupervised worker on this host (supervisors
+        drain their own workers). Workers whose supervisor is gone (e.g. SIGKILLed)
+        are signalled directly. Rows not seen within lease_ttl are never signalled,
+        since their PID may belong to another process by now; they and rows of
+        processes that are already gone are removed. Returns the number signalled.
+        """
+        lease_ttl = float(self.db.get_config('lease_ttl') or DEFAULT_CONFIG['lease_ttl'])
+        cutoff = time.time() - lease_ttl
+        rows = []
+        for r in self.db.list_workers(self.hostname):
+            if r['last_seen'] >= cutoff:
+                rows.append(r)
+            else:
+                self.db.remove_worker(r['id'])
+        supervisors = {r['id'] for r in rows if r['mode'] == 'supervisor' and _alive(r['pid'])}
+        sent = 0
+        for r in rows:
+            if r['supervisor'] in supervisors:
+                continue
             try:
-                os.kill(pid, signal.SIGTERM)
+                os.kill(r['pid'], signal.SIGTERM)
+                sent += 1
             except ProcessLookupError:
-                pass
-        try:
-            os.remove(PID_FILE)
-        except Exception:
-            pass
+                self.db.remove_worker(r['id'])
+        return sent
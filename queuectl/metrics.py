@@ -0,0 +1,233 @@
+# queuectl/metrics.py
+"""
+Worker instrumentation. Each worker process aggregates counters and fixed-bucket
+latency histograms in memory and adds the deltas to the `metrics` table every few
+seconds, so recording a sample never touches the database. `queuectl metrics`
+renders the table as Prometheus text or JSON.
+"""
+import json
+import math
+import time
+import threading
+from datetime import datetime
+
+# Upper bounds (seconds) shared by every histogram; the last bucket is +Inf.
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1, 2.5, 5, 10, 30, 60, 300, 1800, math.inf)
+
+HELP = {
+    'queue_wait_seconds': 'Time from a job becoming runnable to being claimed.',
+    'claim_seconds': 'Time spent in one claim transaction, including waits for the write lock.',
+    'run_seconds': 'Job execution time.',
+    'writeback_seconds': 'Time spent writing back one batch of results.',
+    'claims_total': 'Claim transactions that returned at least one job.',
+    'claim_empty_total': 'Claim transactions that found nothing runnable.',
+    'claim_locked_total': 'Claims abandoned because the database stayed locked past busy_timeout.',
+    'claim_errors_total': 'Claims abandoned on any other sqlite3.OperationalError.',
+    'jobs_total': 'Jobs run to completion or failure.',
+    'jobs_failed_total': 'Job runs that failed or timed out.',
+    'leases_lost_total': 'Results discarded because the lease had been reaped.',
+    'busy_seconds_total': 'Seconds spent running jobs.',
+    'uptime_seconds_total': 'Seconds the worker has been running.',
+    'enqueue_coalesced_total': 'Enqueues folded into a live job with the same dedup_key.',
+}
+
+# a worker whose rows were not flushed for this long is gone
+STALE_AFTER = 60.0
+# the JSON total's jobs_per_sec counts the jobs completed over this many seconds
+RATE_WINDOW = 60.0
+
+def _num(value):
+    """A sample value exactly: integers as integers (no 1e+06 rounding), else repr."""
+    value = float(value)
+    return '%d' % value if value.is_integer() else repr(value)
+
+def _le(bound):
+    return '+Inf' if bound == math.inf else repr(float(bound))
+
+def job_wait(job, now_ts=None):
+    """Seconds `job` waited between becoming runnable (enqueue or retry due) and now."""
+    now_ts = now_ts or time.time()
+    ready = job.get('available_at') or 0
+    try:
+        ready = max(ready, datetime.fromisoformat(job['created_at']).timestamp())
+    except (KeyError, TypeError, ValueError):
+        pass
+    return max(0.0, now_ts - ready) if ready else None
+
+class Metrics:
+    """
+    In-process aggregation for one worker. `inc` and `observe` only touch dicts
+    under a lock; `flush(db)` moves the accumulated deltas into the metrics table.
+    """
+    def __init__(self, worker, flush_interval=5.0):
+        self.worker = worker
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.hists = {}
+        self.last_flush = time.time()
+
+    def inc(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, seconds):
+        if seconds is None:
+            return
+        with self.lock:
+            h = self.hists.get(name)
+            if h is None:
+                h = self.hists[name] = [[0] * len(BUCKETS), 0.0, 0]
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    h[0][i] += 1
+                    break
+            h[1] += seconds
+            h[2] += 1
+
+    def take(self):
+        """Return and reset the pending deltas as (name, key, value) rows."""
+        now_ts = time.time()
+        with self.lock:
+            counters, hists = self.counters, self.hists
+            self.counters, self.hists = {}, {}
+            uptime = now_ts - self.last_flush
+            self.last_flush = now_ts
+        rows = [(name, '', value) for name, value in counters.items()]
+        rows.append(('uptime_seconds_total', '', uptime))
+        for name, (buckets, total, count) in hists.items():
+            rows += [(name, f'le={_le(b)}', n) for b, n in zip(BUCKETS, buckets) if n]
+            rows += [(name, 'sum', total), (name, 'count', count)]
+        return rows
+
+    def flush(self, db):
+        rows = self.take()
+        try:
+            db.add_metrics(self.worker, rows)
+        except Exception as e:
+            print(f"[metrics {self.worker}] flush failed, dropped {len(rows)} delta(s): {e}")
+
+    def record_claim(self, batch, elapsed):
+        self.observe('claim_seconds', elapsed)
+        if not batch:
+            self.inc('claim_empty_total')
+            return
+        self.inc('claims_total')
+        now_ts = time.time()
+        for job in batch:
+            self.observe('queue_wait_seconds', job_wait(job, now_ts))
+
+    def record_result(self, result):
+        self.inc('jobs_total')
+        if not result['success']:
+            self.inc('jobs_failed_total')
+        self.observe('run_seconds', result.get('duration'))
+        self.inc('busy_seconds_total', result.get('duration') or 0)
+
+    def record_writeback(self, lost, elapsed):
+        self.observe('writeback_seconds', elapsed)
+        if lost:
+            self.inc('leases_lost_total', len(lost))
+
+    def maybe_flush(self, db):
+        if time.time() - self.last_flush >= self.flush_interval:
+            self.flush(db)
+
+def _load(rows):
+    """{worker: {'counters': {name: value}, 'hists': {name: {'buckets': {bound: n}, 'sum', 'count'}}, 'updated_at'}}"""
+    workers = {}
+    for r in rows:
+        w = workers.setdefault(r['worker'], {'counters': {}, 'hists': {}, 'updated_at': 0})
+        w['updated_at'] = max(w['updated_at'], r['updated_at'] or 0)
+        if r['key'] == '':
+            w['counters'][r['name']] = r['value']
+            continue
+        h = w['hists'].setdefault(r['name'], {'buckets': {}, 'sum': 0.0, 'count': 0})
+        if r['key'].startswith('le='):
+            h['buckets'][float(r['key'][3:])] = int(r['value'])
+        else:
+            h[r['key']] = r['value']
+    return workers
+
+def _quantile(hist, q):
+    """Upper bound of the bucket holding quantile `q` (None when it is the +Inf bucket)."""
+    target = q * hist['count']
+    seen = 0
+    for bound in BUCKETS:
+        seen += hist['buckets'].get(bound, 0)
+        if seen >= target and seen:
+            return None if bound == math.inf else bound
+    return None
+
+def _merge(workers):
+    total = {'counters': {}, 'hists': {}}
+    for w in workers.values():
+        for name, value in w['counters'].items():
+            total['counters'][name] = total['counters'].get(name, 0) + value
+        for name, h in w['hists'].items():
+            t = total['hists'].setdefault(name, {'buckets': {}, 'sum': 0.0, 'count': 0})
+            for bound, n in h['buckets'].items():
+                t['buckets'][bound] = t['buckets'].get(bound, 0) + n
+            t['sum'] += h['sum']
+            t['count'] += h['count']
+    return total
+
+def _summary(agg):
+    c = agg['counters']
+    uptime = c.get('uptime_seconds_total') or 0
+    out = {name: round(v, 6) if isinstance(v, float) else v for name, v in sorted(c.items())}
+    if uptime:
+        out['jobs_per_sec'] = round(c.get('jobs_total', 0) / uptime, 3)
+        out['utilization'] = round(c.get('busy_seconds_total', 0) / uptime, 4)
+    for name, h in sorted(agg['hists'].items()):
+        count = int(h['count'])
+        out[name] = {'count': count, 'sum': round(h['sum'], 6),
+                     'mean': round(h['sum'] / count, 6) if count else None,
+                     'p50': _quantile(h, 0.5), 'p90': _quantile(h, 0.9), 'p99': _quantile(h, 0.99)}
+    return out
+
+def to_json(rows, completed=None, window=RATE_WINDOW, now_ts=None):
+    """
+    Summaries of the live workers (flushed within STALE_AFTER) plus a cluster-wide
+    total of every worker's counters; quantiles are bucket upper bounds. The total's
+    jobs_per_sec is `completed`, the jobs completed in the last `window` seconds,
+    over the window (left out when not given): summing each worker's lifetime
+    average would keep counting workers long gone.
+    """
+    now_ts = now_ts or time.time()
+    workers = _load(rows)
+    per_worker = {w: dict(_summary(agg), last_flush=agg['updated_at']) for w, agg in workers.items()
+                  if agg['updated_at'] >= now_ts - STALE_AFTER}
+    total = _summary(_merge(workers))
+    total.pop('jobs_per_sec', None)
+    if completed is not None:
+        total['jobs_per_sec'] = round(completed / window, 3)
+    return json.dumps({'total': total, 'workers': per_worker}, indent=2)
+
+def to_prometheus(rows, prefix='queuectl_'):
+    """Prometheus text exposition format, one series per worker."""
+    workers = _load(rows)
+    counters = sorted({n for w in workers.values() for n in w['counters']})
+    hists = sorted({n for w in workers.values() for n in w['hists']})
+    lines = []
+    for name in counters:
+        lines.append(f'# HELP {prefix}{name} {HELP.get(name, name)}')
+        lines.append(f'# TYPE {prefix}{name} counter')
+        for worker, agg in workers.items():
+            if name in agg['counters']:
+                lines.append(f'{prefix}{name}{{worker="{worker}"}} {_num(agg["counters"][name])}')
+    for name in hists:
+        lines.append(f'# HELP {prefix}{name} {HELP.get(name, name)}')
+        lines.append(f'# TYPE {prefix}{name} histogram')
+        for worker, agg in workers.items():
+            h = agg['hists'].get(name)
+            if h is None:
+                continue
+            seen = 0
+            for bound in BUCKETS:
+                seen += h['buckets'].get(bound, 0)
+                lines.append(f'{prefix}{name}_bucket{{worker="{worker}",le="{_le(bound)}"}} {seen}')
+            lines.append(f'{prefix}{name}_sum{{worker="{worker}"}} {_num(h["sum"])}')
+            lines.append(f'{prefix}{name}_count{{worker="{worker}"}} {int(h["count"])}')
+    return '\n'.join(lines) + '\n'
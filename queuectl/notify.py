@@ -0,0 +1,110 @@
+# queuectl/notify.py
+import os
+import time
+import select
+import socket
+import hashlib
+import tempfile
+
+# Unix-domain datagram sockets are the wakeup channel; without them workers fall back to polling
+HAS_UNIX = hasattr(socket, 'AF_UNIX')
+
+def runtime_dir(db_path):
+    """
+    Per-database directory for local rendezvous files. It lives under the temp dir
+    (keyed by a hash of the DB path) so socket paths stay short.
+    """
+    digest = hashlib.sha1(os.path.abspath(db_path).encode()).hexdigest()[:12]
+    return os.path.join(tempfile.gettempdir(), f'queuectl-{digest}')
+
+def notify(db_path):
+    """Wake every worker waiting on this database. Best-effort and never blocks."""
+    if not HAS_UNIX:
+        return
+    d = runtime_dir(db_path)
+    try:
+        names = os.listdir(d)
+    except OSError:
+        return
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    s.setblocking(False)
+    try:
+        for name in names:
+            if not (name.startswith('wake-') and name.endswith('.sock')):
+                continue
+            path = os.path.join(d, name)
+            try:
+                s.sendto(b'!', path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # nobody bound: the worker died without cleaning up
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            except OSError:
+                # receive buffer full: that worker already has a wakeup pending
+                pass
+    finally:
+        s.close()
+
+class Waiter:
+    """
+    A worker's wakeup endpoint. `wait(timeout)` blocks until `notify()` is called
+    for the same database or the timeout elapses.
+    """
+    def __init__(self, db_path):
+        self.sock = None
+        self.path = None
+        if not HAS_UNIX:
+            return
+        d = runtime_dir(db_path)
+        path = os.path.join(d, f'wake-{os.getpid()}-{id(self):x}.sock')
+        try:
+            os.makedirs(d, mode=0o700, exist_ok=True)
+            s = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            s.bind(path)
+            s.setblocking(False)
+        except OSError:
+            return
+        self.sock = s
+        self.path = path
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def drain(self):
+        while True:
+            try:
+                self.sock.recv(64)
+            except OSError:
+                return
+
+    def wait(self, timeout):
+        """Returns True if woken by a notification, False on timeout."""
+        if self.sock is None:
+            time.sleep(max(0, timeout))
+            return False
+        r, _, _ = select.select([self.sock], [], [], max(0, timeout))
+        if r:
+            self.drain()
+            return True
+        return False
+
+    def interrupt(self):
+        """Wake our own wait(), e.g. from a signal handler."""
+        if self.sock is None:
+            return
+        try:
+            self.sock.sendto(b'!', self.path)
+        except OSError:
+            pass
+
+    def close(self):
+        if self.sock is None:
+            return
+        self.sock.close()
+        self.sock = None
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
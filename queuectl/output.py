@@ -0,0 +1,93 @@
+# queuectl/output.py
+import time
+import zlib
+
+STREAMS = ('stdout', 'stderr')
+
+def compress(data: bytes) -> bytes:
+    return zlib.compress(data, 6)
+
+def decompress(blob: bytes) -> bytes:
+    return zlib.decompress(blob)
+
+class _Stream:
+    def __init__(self, head_cap, tail_cap):
+        self.head_left = head_cap
+        self.tail_cap = tail_cap
+        self.pending = bytearray()
+        self.tail = bytearray()
+        self.dropped = 0
+
+class JobOutput:
+    """
+    Bounded collector for one run of a job. The first `max_bytes / 2` of each stream
+    (the head) is compressed and handed to `flush` as it arrives, so `queuectl logs
+    --follow` can read it while the job runs. After that only a rolling tail of
+    `max_bytes / 2` is kept in memory; it is emitted, behind a truncation marker,
+    by `close()`. Rows are (job_id, attempt, seq, stream, zlib blob).
+    """
+    def __init__(self, job_id, attempt, max_bytes, flush=None, flush_bytes=65536, flush_interval=1.0):
+        self.job_id = job_id
+        self.attempt = attempt
+        self.flush = flush
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.seq = 0
+        self.last_flush = time.time()
+        head = max(0, int(max_bytes)) // 2
+        self.streams = {s: _Stream(head, max(0, int(max_bytes)) - head) for s in STREAMS}
+
+    def _row(self, stream, data):
+        self.seq += 1
+        return (self.job_id, self.attempt, self.seq, stream, compress(bytes(data)))
+
+    def _take_pending(self):
+        rows = []
+        for name, st in self.streams.items():
+            if st.pending:
+                rows.append(self._row(name, st.pending))
+                st.pending = bytearray()
+        self.last_flush = time.time()
+        return rows
+
+    def write(self, stream, data: bytes):
+        st = self.streams[stream]
+        if st.head_left > 0:
+            take = data[:st.head_left]
+            st.pending += take
+            st.head_left -= len(take)
+            data = data[len(take):]
+        if data:
+            st.tail += data
+            extra = len(st.tail) - st.tail_cap
+            if extra > 0:
+                st.dropped += extra
+                del st.tail[:extra]
+        self.tick()
+
+    def tick(self):
+        """Flush buffered head bytes if enough piled up or they have waited long enough."""
+        if self.flush is None:
+            return
+        size = sum(len(s.pending) for s in self.streams.values())
+        if size >= self.flush_bytes or (size and time.time() - self.last_flush >= self.flush_interval):
+            self.flush(self._take_pending())
+
+    def close(self):
+        """Return the rows not yet flushed, including each stream's retained tail."""
+        rows = self._take_pending()
+        for name, st in self.streams.items():
+            if st.dropped:
+                rows.append(self._row(name, f'\n...[{st.dropped} bytes truncated]...\n'.encode()))
+            if st.tail:
+                rows.append(self._row(name, st.tail))
+                st.tail = bytearray()
+        return rows
+
+def text_rows(job_id, attempt, stdout=None, stderr=None, max_bytes=1 << 62):
+    """Rows for output that was captured as whole strings."""
+    out = JobOutput(job_id, attempt, max_bytes)
+    for name, text in (('stdout', stdout), ('stderr', stderr)):
+        if text:
+            out.write(name, text.encode() if isinstance(text, str) else text)
+    return out.close()
@@ -0,0 +1,148 @@
+# queuectl/pool.py
+"""
+Warm pool for `python:module:function` jobs. Pool processes are forked from a
+forkserver that has already imported queuectl (and any `python_preload` modules),
+so a job costs one pipe round trip instead of fork + exec + interpreter start-up.
+Each process is recycled after `max_jobs` jobs or once its RSS exceeds `max_rss_mb`.
+A job's cpu_time is what its pool process spent on it; its peak_rss_kb is that
+process's high-water mark so far (jobs share the process, so it is an upper bound).
+"""
+import io
+import os
+import queue
+import resource
+import importlib
+import threading
+import traceback
+import multiprocessing as mp
+from contextlib import redirect_stdout, redirect_stderr
+
+PREFIX = 'python:'
+
+def noop(*args):
+    """Trivial target used by `queuectl bench --scenarios spawn`."""
+    return None
+
+def parse_target(command):
+    """'python:pkg.mod:func' -> ('pkg.mod', 'func')."""
+    spec = command[len(PREFIX):] if command.startswith(PREFIX) else command
+    module, sep, func = spec.partition(':')
+    if not sep or not module or not func:
+        raise ValueError(f'python jobs look like "python:module:function", got {command!r}')
+    return module, func
+
+def _rss_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1 << 20)
+    except (OSError, ValueError, IndexError):
+        # peak rather than current RSS, in KiB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def _serve(conn, max_jobs, max_rss_mb):
+    """Pool process main loop: run (module, func, args) requests until it is time to recycle."""
+    done = 0
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            return
+        module, func, args = request
+        out, err = io.StringIO(), io.StringIO()
+        code = 0
+        before = resource.getrusage(resource.RUSAGE_SELF)
+        try:
+            with redirect_stdout(out), redirect_stderr(err):
+                result = getattr(importlib.import_module(module), func)(*args)
+            if result is not None:
+                out.write(f'{result}\n')
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+        except BaseException:
+            err.write(traceback.format_exc())
+            code = 1
+        done += 1
+        after = resource.getrusage(resource.RUSAGE_SELF)
+        usage = {'peak_rss_kb': after.ru_maxrss,
+                 'cpu_time': round(after.ru_utime + after.ru_stime - before.ru_utime - before.ru_stime, 6)}
+        recycle = done >= max_jobs or _rss_mb() > max_rss_mb
+        conn.send((code, out.getvalue().encode(), err.getvalue().encode(), recycle, usage))
+        if recycle:
+            return
+
+class _Proc:
+    def __init__(self, ctx, max_jobs, max_rss_mb):
+        self.conn, child = ctx.Pipe()
+        self.proc = ctx.Process(target=_serve, args=(child, max_jobs, max_rss_mb), daemon=True)
+        self.proc.start()
+        child.close()
+
+    def kill(self):
+        self.proc.kill()
+        self.proc.join()
+        self.conn.close()
+
+class PythonPool:
+    """
+    Up to `size` warm processes, started lazily and shared by the threads of one
+    worker. `run` blocks the calling thread until the job finishes or times out.
+    """
+    def __init__(self, size=1, max_jobs=1000, max_rss_mb=512, preload=()):
+        try:
+            self.ctx = mp.get_context('forkserver')
+            self.ctx.set_forkserver_preload(['queuectl.pool'] + list(preload or ()))
+        except ValueError:
+            self.ctx = mp.get_context('spawn')
+        self.size = max(1, size)
+        self.max_jobs = max(1, int(max_jobs))
+        self.max_rss_mb = float(max_rss_mb)
+        self.idle = queue.LifoQueue()
+        self.started = 0
+        self.lock = threading.Lock()
+
+    def _checkout(self):
+        with self.lock:
+            if self.idle.empty() and self.started < self.size:
+                self.started += 1
+                return _Proc(self.ctx, self.max_jobs, self.max_rss_mb)
+        return self.idle.get()
+
+    def _discard(self, proc):
+        proc.kill()
+        with self.lock:
+            self.started -= 1
+
+    def run(self, command, args, timeout, output, usage=None):
+        """
+        Run `python:module:function` with positional `args`, capturing what it prints
+        into `output` (a JobOutput). A non-None return value is printed to stdout.
+        Returns (exit_code, timed_out) and fills `usage` like runner.run_process.
+        """
+        module, func = parse_target(command)
+        proc = self._checkout()
+        try:
+            proc.conn.send((module, func, list(args or ())))
+            if not proc.conn.poll(timeout or None):
+                self._discard(proc)
+                return -1, True
+            code, out, err, recycle, used = proc.conn.recv()
+        except (EOFError, OSError, BrokenPipeError):
+            # the pool process died mid-job (e.g. os._exit or a crash in C code)
+            self._discard(proc)
+            output.write('stderr', b'python pool process died while running the job\n')
+            return -1, False
+        if recycle:
+            self._discard(proc)
+        else:
+            self.idle.put(proc)
+        if usage is not None:
+            usage.update(used)
+        if out:
+            output.write('stdout', out)
+        if err:
+            output.write('stderr', err)
+        return code, False
+
+    def close(self):
+        while not self.idle.empty():
+            self.idle.get().kill()
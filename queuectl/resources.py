@@ -0,0 +1,169 @@
+# queuectl/resources.py
+"""
+Per-job resource requests. A job may declare `cpu` (cores) and `mem_mb`; claims
+only take jobs that fit in what the node budget (`node_cpu`, `node_mem_mb`,
+detected from the machine when unset) leaves after the jobs processing on that
+node (QUEUECTL_NODE, else the hostname, which `worker start --node` sets), and the
+worker runs the job confined to what it asked for: in its own cgroup v2
+sub-group under `cgroup_root` when that is set and writable, else under rlimits
+(RLIMIT_DATA for memory, RLIMIT_CPU of cpu x timeout seconds for cpu). Either way
+the run's peak RSS and CPU time are measured and stored with the job.
+
+Workers run heartbeat and executor threads, so nothing runs between fork and exec
+(no preexec_fn). A confined job instead starts behind a gate, a /bin/sh waiting on
+its stdin: the worker moves that pid into the cgroup or prlimit()s it, then opens
+the gate and the shell execs the job, which inherits both.
+"""
+import os
+import math
+import uuid
+import socket
+import resource
+import subprocess
+from functools import lru_cache
+
+# cgroup roots already reported as unusable, so each is only warned about once
+_unusable = set()
+
+# holds the job until its limits are in place; EOF instead of a line (the worker
+# died) means the job never starts
+_GATE = ['/bin/sh', '-c', 'read -r _ && exec "$@" </dev/null', 'queuectl-gate']
+
+@lru_cache(maxsize=1)
+def detect_budget():
+    """(cores, MB of RAM) of this machine."""
+    mem_mb = None
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemTotal:'):
+                    mem_mb = int(line.split()[1]) // 1024
+                    break
+    except (OSError, ValueError, IndexError):
+        pass
+    if mem_mb is None:
+        try:
+            mem_mb = os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') // (1 << 20)
+        except (ValueError, OSError):
+            mem_mb = 0
+    return float(os.cpu_count() or 1), mem_mb
+
+def node_name():
+    """The name this machine's jobs are reserved under: QUEUECTL_NODE, else the hostname."""
+    return os.environ.get('QUEUECTL_NODE') or socket.gethostname()
+
+def this_node():
+    """(name, cores, MB of RAM) of the node a claim is made for."""
+    return (node_name(),) + detect_budget()
+
+def rusage_of(ru):
+    """The usage columns of a job from a struct rusage (ru_maxrss is KiB on Linux)."""
+    return {'peak_rss_kb': int(ru.ru_maxrss), 'cpu_time': round(ru.ru_utime + ru.ru_stime, 6)}
+
+class Confinement:
+    """
+    Limits for one process job and the measurement of what it used. `popen`
+    starts the job under them; `finish` takes the rusage from reaping it and
+    returns the usage columns.
+    """
+    def __init__(self, cpu=None, mem_mb=None, timeout=None, cgroup_root=None):
+        self.cpu = cpu
+        self.mem_mb = mem_mb
+        self.timeout = timeout
+        self.cgroup = None
+        if cgroup_root and (cpu or mem_mb):
+            self.cgroup = self._make_cgroup(cgroup_root)
+        self.limited = bool(cpu or mem_mb)
+
+    def _make_cgroup(self, root):
+        path = os.path.join(root, f'job-{uuid.uuid4().hex[:12]}')
+        try:
+            os.mkdir(path)
+            if self.mem_mb:
+                with open(os.path.join(path, 'memory.max'), 'w') as f:
+                    f.write(str(int(self.mem_mb) << 20))
+            if self.cpu:
+                with open(os.path.join(path, 'cpu.max'), 'w') as f:
+                    f.write(f'{max(1000, int(self.cpu * 100000))} 100000')
+        except OSError as e:
+            if root not in _unusable:
+                _unusable.add(root)
+                print(f"[resources] cannot use cgroup under {root} ({e}); falling back to rlimits")
+            self._remove_cgroup(path)
+            return None
+        if self.mem_mb:
+            try:
+                # without this the group would swap instead of hitting memory.max
+                with open(os.path.join(path, 'memory.swap.max'), 'w') as f:
+                    f.write('0')
+            except OSError:
+                pass
+        return path
+
+    def popen(self, cmd, shell=False, **kwargs):
+        """subprocess.Popen(cmd, ...) with stdin from /dev/null, confined from its first instruction."""
+        if not self.limited:
+            return subprocess.Popen(cmd, shell=shell, stdin=subprocess.DEVNULL, **kwargs)
+        argv = ['/bin/sh', '-c', cmd] if shell else list(cmd)
+        proc = subprocess.Popen(_GATE + argv, stdin=subprocess.PIPE, **kwargs)
+        try:
+            self._apply(proc.pid)
+            proc.stdin.write(b'go\n')
+        except BaseException:
+            proc.kill()
+            proc.wait()
+            raise
+        finally:
+            proc.stdin.close()
+            proc.stdin = None
+        return proc
+
+    def _apply(self, pid):
+        # join the cgroup, or set rlimits, on the gated process from the outside
+        if self.cgroup is not None:
+            with open(os.path.join(self.cgroup, 'cgroup.procs'), 'w') as f:
+                f.write(str(pid))
+            return
+        if self.mem_mb:
+            # RLIMIT_DATA caps the heap and private writable mappings (Linux 4.7+);
+            # RLIMIT_AS would count reserved address space, which JVMs, Go and glibc
+            # arenas take far beyond what they touch
+            limit = int(self.mem_mb) << 20
+            resource.prlimit(pid, resource.RLIMIT_DATA, (limit, limit))
+        if self.cpu and self.timeout:
+            seconds = max(1, math.ceil(self.cpu * self.timeout))
+            resource.prlimit(pid, resource.RLIMIT_CPU, (seconds, seconds + 1))
+
+    def finish(self, ru):
+        """Usage of the run from its rusage (or its cgroup's counters); removes the cgroup."""
+        usage = rusage_of(ru) if ru is not None else {}
+        if self.cgroup is not None:
+            usage.update(self._cgroup_usage())
+            self._remove_cgroup(self.cgroup)
+            self.cgroup = None
+        return usage
+
+    def _cgroup_usage(self):
+        # the group's counters include every descendant, not just the reaped child
+        usage = {}
+        try:
+            with open(os.path.join(self.cgroup, 'memory.peak')) as f:
+                usage['peak_rss_kb'] = int(f.read()) // 1024
+        except (OSError, ValueError):
+            pass
+        try:
+            with open(os.path.join(self.cgroup, 'cpu.stat')) as f:
+                for line in f:
+                    name, _, value = line.partition(' ')
+                    if name == 'usage_usec':
+                        usage['cpu_time'] = int(value) / 1e6
+        except (OSError, ValueError):
+            pass
+        return usage
+
+    @staticmethod
+    def _remove_cgroup(path):
+        try:
+            os.rmdir(path)
+        except OSError:
+            pass
@@ -0,0 +1,149 @@
+# queuectl/runner.py
+import os
+import json
+import time
+import shlex
+import shutil
+import signal
+import selectors
+import subprocess
+from functools import lru_cache
+from .pool import PREFIX as PYTHON_PREFIX
+from .resources import Confinement
+
+# anything that makes /bin/sh do more than split words and run one program
+SHELL_META = set('|&;<>()$`\\*?[]{}~#!\n')
+
+def kill_group(pid):
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+@lru_cache(maxsize=1024)
+def _resolve(program):
+    return shutil.which(program)
+
+def plain_argv(command):
+    """
+    The argv to exec `command` directly when the shell would add nothing: no
+    metacharacters, no variable assignment, and a program found on PATH (so shell
+    builtins such as `exit` or `cd` still go through the shell). Otherwise None.
+    """
+    if SHELL_META.intersection(command):
+        return None
+    try:
+        argv = shlex.split(command)
+    except ValueError:
+        return None
+    if not argv or '=' in argv[0] or _resolve(argv[0]) is None:
+        return None
+    return argv
+
+def job_argv(job):
+    """argv for a job run without a shell, or None when it needs /bin/sh."""
+    if job.get('kind') == 'exec':
+        return json.loads(job['args'])
+    return plain_argv(job['command'])
+
+def run_command(job, timeout, output, pool=None, usage=None, cgroup_root=None):
+    """
+    Run a claimed job by kind: `python:` jobs in the warm `pool`, argv jobs and
+    metacharacter-free commands by direct exec, everything else via /bin/sh.
+    Process jobs are confined to the job's cpu/mem_mb (see resources.Confinement).
+    Returns (exit_code, timed_out); what the run used goes into the `usage` dict.
+    """
+    if job.get('kind') == 'python' or job['command'].startswith(PYTHON_PREFIX):
+        if pool is None:
+            raise RuntimeError('python jobs need a worker with a python pool')
+        return pool.run(job['command'], json.loads(job.get('args') or '[]'), timeout, output, usage)
+    confine = Confinement(job.get('cpu'), job.get('mem_mb'), timeout, cgroup_root)
+    argv = job_argv(job)
+    if argv is not None:
+        return run_process(argv, timeout, output, confine=confine, usage=usage)
+    return run_process(job['command'], timeout, output, shell=True, confine=confine, usage=usage)
+
+def exit_code(status):
+    """Popen-style return code from a wait status (-N when killed by signal N)."""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+def reap(proc, deadline=None):
+    """
+    Wait for `proc` with os.wait4, which also returns its rusage (Popen.wait does
+    not). Sets proc.returncode and returns the rusage, or None if `deadline`
+    (a time.monotonic() value) passes first.
+    """
+    if deadline is None:
+        _, status, ru = os.wait4(proc.pid, 0)
+    else:
+        pause = 0.001
+        while True:
+            pid, status, ru = os.wait4(proc.pid, os.WNOHANG)
+            if pid:
+                break
+            left = deadline - time.monotonic()
+            if left <= 0:
+                return None
+            time.sleep(min(pause, left))
+            pause = min(pause * 2, 0.05)
+    proc.returncode = exit_code(status)
+    return ru
+
+def run_process(cmd, timeout, output, shell=False, confine=None, usage=None):
+    """
+    Run `cmd` (an argv list, or a shell command line with `shell`) in its own process
+    group, streaming stdout and stderr into `output` (a JobOutput) as they arrive
+    instead of buffering them. On timeout the whole process group is killed.
+    `confine` (a resources.Confinement) limits the process; its peak RSS and CPU
+    time are stored in `usage`. Returns (exit_code, timed_out).
+    """
+    confine = confine or Confinement()
+    try:
+        proc = confine.popen(cmd, shell=shell, stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True)
+    except BaseException:
+        confine.finish(None)
+        raise
+    deadline = time.monotonic() + timeout if timeout else None
+    timed_out = False
+    ru = None
+    sel = selectors.DefaultSelector()
+    sel.register(proc.stdout, selectors.EVENT_READ, 'stdout')
+    sel.register(proc.stderr, selectors.EVENT_READ, 'stderr')
+    try:
+        while sel.get_map():
+            wait = None if deadline is None else deadline - time.monotonic()
+            if wait is not None and wait <= 0:
+                timed_out = True
+                kill_group(proc.pid)
+                break
+            # wake at least once per flush interval so quiet jobs still surface buffered output
+            events = sel.select(output.flush_interval if wait is None else min(wait, output.flush_interval))
+            for key, _ in events:
+                data = os.read(key.fd, 65536)
+                if not data:
+                    sel.unregister(key.fileobj)
+                    continue
+                output.write(key.data, data)
+            output.tick()
+        if timed_out:
+            ru = reap(proc)
+        else:
+            ru = reap(proc, deadline)
+            if ru is None:
+                # pipes closed (e.g. redirected away) but the process lingers past its deadline
+                timed_out = True
+                kill_group(proc.pid)
+                ru = reap(proc)
+    finally:
+        sel.close()
+        proc.stdout.close()
+        proc.stderr.close()
+        if proc.returncode is None:
+            kill_group(proc.pid)
+            ru = reap(proc)
+        used = confine.finish(ru)
+        if usage is not None:
+            usage.update(used)
+    return proc.returncode, timed_out
@@ -0,0 +1,173 @@
+# queuectl/scheduler.py
+"""
+Recurring jobs. A schedule pairs a cron expression with a job template; `queuectl
+scheduler run` keeps the schedules in a heap keyed on their next fire time, so each
+tick only looks at the ones that are due, and materializes them in one batch.
+A fired job's id is "<schedule>@<fire time>", so re-firing a tick after a crash
+(or from a second scheduler) is rejected as a duplicate instead of running twice.
+Cron times are UTC.
+"""
+import time
+import heapq
+from datetime import datetime, timedelta, timezone
+from .db import parse_duration
+
+MACROS = {'@yearly': '0 0 1 1 *', '@annually': '0 0 1 1 *', '@monthly': '0 0 1 * *', '@weekly': '0 0 * * 0',
+          '@daily': '0 0 * * *', '@midnight': '0 0 * * *', '@hourly': '0 * * * *'}
+MONTHS = {m: i for i, m in enumerate(('jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec'), 1)}
+DAYS = {d: i for i, d in enumerate(('sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat'))}
+# (name, lowest, highest, names); weekday 7 is Sunday as well as 0
+FIELDS = (('minute', 0, 59, {}), ('hour', 0, 23, {}), ('day', 1, 31, {}), ('month', 1, 12, MONTHS), ('weekday', 0, 7, DAYS))
+# a date no expression matches within this many years (e.g. "0 0 30 2 *") never comes
+MAX_YEARS = 8
+
+def _field(spec, name, lo, hi, names):
+    def value(text):
+        text = text.lower()
+        if text in names:
+            return names[text]
+        if not text.isdigit():
+            raise ValueError(f'bad {name} in cron expression: {spec!r}')
+        return int(text)
+
+    out = set()
+    for part in spec.split(','):
+        part, slash, step = part.partition('/')
+        step = int(step) if step.isdigit() else (1 if not slash else 0)
+        if step < 1:
+            raise ValueError(f'bad step in cron {name}: {spec!r}')
+        if part == '*':
+            a, b = lo, hi
+        elif '-' in part:
+            a, b = (value(x) for x in part.split('-', 1))
+        else:
+            a = value(part)
+            b = hi if slash else a
+        if not lo <= a <= b <= hi:
+            raise ValueError(f'cron {name} out of range {lo}-{hi}: {spec!r}')
+        out.update(range(a, b + 1, step))
+    return out
+
+class Cron:
+    """
+    A five-field cron expression ("minute hour day month weekday", with lists,
+    ranges, steps and month/day names), one of the @daily-style macros, or
+    "@every <duration>" for a fixed interval aligned to the epoch.
+    """
+    def __init__(self, expr):
+        self.expr = expr.strip()
+        self.interval = None
+        if self.expr.startswith('@every'):
+            self.interval = parse_duration(self.expr[len('@every'):])
+            if self.interval < 1:
+                raise ValueError('@every needs an interval of at least 1s')
+            return
+        spec = MACROS.get(self.expr, self.expr)
+        parts = spec.split()
+        if len(parts) != 5:
+            raise ValueError(f'cron expressions have 5 fields, got {self.expr!r}')
+        self.minutes, self.hours, self.days, self.months, self.weekdays = (
+            _field(p, *f) for p, f in zip(parts, FIELDS))
+        if 7 in self.weekdays:
+            self.weekdays = (self.weekdays - {7}) | {0}
+        # as in cron, a restricted day and weekday match when either does
+        self.any_day = parts[2] == '*'
+        self.any_weekday = parts[4] == '*'
+
+    def _day_ok(self, dt):
+        day = dt.day in self.days
+        weekday = dt.isoweekday() % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def next(self, after):
+        """First fire time (epoch seconds) strictly after `after`."""
+        if self.interval is not None:
+            return (int(after // self.interval) + 1) * self.interval
+        dt = datetime.fromtimestamp(after, timezone.utc).replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = dt.year + MAX_YEARS
+        while dt.year <= limit:
+            if dt.month not in self.months:
+                dt = datetime(dt.year + dt.month // 12, dt.month % 12 + 1, 1, tzinfo=timezone.utc)
+            elif not self._day_ok(dt):
+                dt = (dt + timedelta(days=1)).replace(hour=0, minute=0)
+            elif dt.hour not in self.hours:
+                dt = (dt + timedelta(hours=1)).replace(minute=0)
+            elif dt.minute not in self.minutes:
+                dt += timedelta(minutes=1)
+            else:
+                return dt.timestamp()
+        raise ValueError(f'cron expression {self.expr!r} never fires')
+
+def fire_id(name, fire_ts):
+    return f'{name}@{int(fire_ts)}'
+
+class Scheduler:
+    """
+    Materializes due schedules from a min-heap of (next_run, name). The heap is
+    rebuilt only when `schedule add/remove` bumps the schedules_rev config entry.
+    A schedule that missed several ticks (scheduler down) fires once, for the latest.
+    """
+    def __init__(self, db, max_batch=500):
+        self.db = db
+        self.max_batch = max_batch
+        self.heap = []
+        self.schedules = {}
+        self.crons = {}
+        self.rev = object()
+
+    def load(self):
+        self.rev = self.db.get_config('schedules_rev')
+        self.schedules = {s['name']: s for s in self.db.list_schedules()}
+        self.crons = {}
+        self.heap = [(s['next_run'], name) for name, s in self.schedules.items()]
+        heapq.heapify(self.heap)
+
+    def next_due(self):
+        return self.heap[0][0] if self.heap else None
+
+    def tick(self, now_ts=None):
+        """Enqueue every due schedule in one batch; returns [(schedule, job id, ticks skipped)]."""
+        now_ts = now_ts or time.time()
+        if self.db.get_config('schedules_rev') != self.rev:
+            self.load()
+        due = []
+        while self.heap and self.heap[0][0] <= now_ts and len(due) < self.max_batch:
+            fired, name = heapq.heappop(self.heap)
+            s = self.schedules[name]
+            cron = self.crons.get(name) or self.crons.setdefault(name, Cron(s['cron']))
+            fire, nxt, skipped = fired, cron.next(fired), 0
+            while nxt <= now_ts:
+                fire, nxt, skipped = nxt, cron.next(nxt), skipped + 1
+            due.append((s, fired, fire, nxt, skipped))
+        if not due:
+            return []
+        errors = []
+
+        def on_reject(job, err):
+            # a duplicate id means this tick was already materialized
+            if 'UNIQUE' not in err:
+                errors.append((job.get('id'), err))
+
+        self.db.enqueue_many((dict(s['job'], id=fire_id(s['name'], fire)) for s, _, fire, _, _ in due),
+                             chunk_size=self.max_batch, on_reject=on_reject)
+        for job_id, err in errors:
+            print(f"[scheduler] could not enqueue {job_id}: {err}")
+        moved = self.db.advance_schedules([(s['name'], fired, nxt, fire) for s, fired, fire, nxt, _ in due])
+        if len(moved) < len(due):
+            # another scheduler got there first; take its view on the next tick
+            self.rev = object()
+        for s, _, _, nxt, _ in due:
+            s['next_run'] = nxt
+            heapq.heappush(self.heap, (nxt, s['name']))
+        return [(s['name'], fire_id(s['name'], fire), skipped) for s, _, fire, _, skipped in due]
+
+    def run(self, stop_event, max_sleep=1.0):
+        """Tick until `stop_event` is set, sleeping until the next schedule is due (at most `max_sleep`)."""
+        self.load()
+        while not stop_event.is_set():
+            for name, job_id, skipped in self.tick():
+                print(f"[scheduler] {name} -> {job_id}" + (f" (skipped {skipped} missed tick(s))" if skipped else ''))
+            due = self.next_due()
+            stop_event.wait(max_sleep if due is None else min(max_sleep, max(0.0, due - time.time())))
@@ -0,0 +1,467 @@
+# queuectl/shards.py
+"""
+Sharded storage. With the `shards` config set above 1, jobs are spread over that
+many SQLite files, each with its own write lock: shard 0 is queuectl.db itself
+(which also keeps config, workers and metrics) and shard i is queuectl-shard{i}.db
+next to it. A job lives in one shard for its whole life, chosen by hashing its id
+or, with `shard_by` = "queue", its queue name. Workers claim from the shards in a
+rotating order; status, list and dlq read every shard and merge the results.
+Dependencies never cross shards: a job is placed with its parents, and one whose
+parents are spread out, or whose concurrency_key (or queue) belongs to another
+shard, is refused.
+"""
+import os
+import time
+import uuid
+import heapq
+import zlib
+import sqlite3
+from itertools import islice
+from .db import DB, DEFAULT_CONFIG, DEFAULT_QUEUE
+from .resources import this_node
+
+SHARD_BY = ('id', 'queue')
+
+# served by shard 0, which holds the only copy of these tables
+MAIN_OPS = ('get_config', 'set_config', 'try_claim_periodic', 'register_worker', 'touch_worker', 'set_worker_state',
+            'remove_worker', 'list_workers', 'prune_workers', 'add_metrics', 'add_schedule', 'remove_schedule', 'list_schedules', 'advance_schedules')
+
+def shard_path(path, index):
+    if index == 0:
+        return path
+    root, ext = os.path.splitext(path)
+    return f'{root}-shard{index}{ext}'
+
+def shard_of(key, count):
+    """Stable shard index for a routing key (crc32, so every process agrees)."""
+    return zlib.crc32(key.encode()) % count
+
+def _cursor_key(pair):
+    seq, _, job_id = pair[0].partition(':')
+    return int(seq), job_id
+
+class ShardedDB:
+    """
+    The job methods of DB over several shard databases. Shard files beyond the
+    configured count (left from a larger setting) are still claimed from and
+    listed, but receive no new jobs, so lowering `shards` drains them.
+    """
+    def __init__(self, path=None, shards=None, shard_by=None, pragmas=None):
+        main = DB(path, pragmas)
+        self.path = main.path
+        self.count = max(1, int(shards or main.get_config('shards') or DEFAULT_CONFIG['shards']))
+        self.shard_by = shard_by or main.get_config('shard_by') or DEFAULT_CONFIG['shard_by']
+        if self.shard_by not in SHARD_BY:
+            raise ValueError(f'shard_by must be one of {", ".join(SHARD_BY)}')
+        self.shards = [main]
+        while len(self.shards) < self.count or os.path.exists(shard_path(self.path, len(self.shards))):
+            shard = DB(shard_path(self.path, len(self.shards)), pragmas)
+            shard.wake_path = self.path
+            self.shards.append(shard)
+        # shard of every job this process holds a claim on, for output and write-back
+        self.claimed = {}
+        # shard index -> (data_version, next due time) recorded when a claim found it empty;
+        # cleared by our own writes, which do not move our data_version
+        self.idle = {}
+        self.turn = os.getpid()
+        self._metrics = None
+
+    @property
+    def metrics(self):
+        return self._metrics
+
+    @metrics.setter
+    def metrics(self, value):
+        self._metrics = value
+        for shard in self.shards:
+            shard.metrics = value
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+    def _route(self, job, placed=None):
+        """
+        (shard, job) for a new job; a job routed by id gets its id assigned here.
+        Jobs with depends_on go to their parents' shard (`placed` maps the ids routed
+        earlier in the same batch). Otherwise a concurrency_key, then a dedup_key,
+        picks the shard, so that a key's limits and its duplicates are each decided
+        within one shard. Raises ValueError when the parents are spread over several
+        shards, or sit in another shard than the job's concurrency_key (or queue,
+        with shard_by "queue") sends it to.
+        """
+        if not isinstance(job, dict):
+            return self.shards[0], job
+        parents = job.get('depends_on')
+        homes = {}
+        if isinstance(parents, list):
+            for parent in parents:
+                if not isinstance(parent, str):
+                    continue
+                shard = (placed or {}).get(parent) or self._locate(parent)
+                if shard is not None:
+                    homes.setdefault(self.shards.index(shard), []).append(parent)
+        if len(homes) > 1:
+            spread = '; '.join(f'shard {i}: {", ".join(ids)}' for i, ids in sorted(homes.items()))
+            raise ValueError(f'depends_on spans shards ({spread}); a job and its parents must share one shard')
+        key = job.get('concurrency_key')
+        if self.shard_by == 'queue':
+            queue = job.get('queue') or DEFAULT_QUEUE
+            index, reason = shard_of(queue, self.count), f'queue {queue!r}'
+        elif isinstance(key, str):
+            index, reason = shard_of(key, self.count), f'concurrency_key {key!r}'
+        elif homes:
+            index, reason = next(iter(homes)), None
+        elif isinstance(job.get('dedup_key'), str):
+            index, reason = shard_of(job['dedup_key'], self.count), None
+        else:
+            if not job.get('id'):
+                job = dict(job, id=str(uuid.uuid4()))
+            index, reason = shard_of(str(job['id']), self.count), None
+        if homes and index not in homes:
+            (home, ids), = homes.items()
+            raise ValueError(f'{reason} routes the job to shard {index} but depends_on ({", ".join(ids)}) '
+                             f'is in shard {home}; dependencies cannot cross shards')
+        if homes and not job.get('id'):
+            job = dict(job, id=str(uuid.uuid4()))
+        return self.shards[index], job
+
+    def _locate(self, job_id):
+        """Shard holding `job_id`, or None."""
+        index = self.claimed.get(job_id)
+        if index is not None:
+            return self.shards[index]
+        if self.shard_by == 'id':
+            shard = self.shards[shard_of(job_id, self.count)]
+            if shard.get_job(job_id) is not None:
+                return shard
+        for shard in self.shards:
+            if shard.get_job(job_id) is not None:
+                return shard
+        return None
+
+    def _group(self, items, job_id):
+        """{shard index: [items]} using job_id(item) to find each item's shard."""
+        groups = {}
+        for item in items:
+            shard = self._locate(job_id(item))
+            if shard is not None:
+                groups.setdefault(self.shards.index(shard), []).append(item)
+        return groups
+
+    def enqueue(self, job):
+        shard, job = self._route(job)
+        self.idle.clear()
+        return shard.enqueue(job)
+
+    def enqueue_many(self, jobs, chunk_size=1000, on_chunk=None, on_reject=None, on_coalesce=None):
+        """As DB.enqueue_many; each chunk is split by shard and inserted one transaction per shard."""
+        chunk_size = max(1, int(chunk_size))
+        inserted = rejected = 0
+        it = iter(jobs)
+        while True:
+            batch = list(islice(it, chunk_size))
+            if not batch:
+                return inserted, rejected
+            start = time.time()
+            self.idle.clear()
+            groups = {}
+            placed = {}
+            for job in batch:
+                try:
+                    shard, job = self._route(job, placed)
+                except ValueError as e:
+                    rejected += 1
+                    if on_reject:
+                        on_reject(job, str(e))
+                    continue
+                groups.setdefault(id(shard), (shard, []))[1].append(job)
+                if isinstance(job, dict) and job.get('id'):
+                    placed[job['id']] = shard
+            done = 0
+            for shard, part in groups.values():
+                n, bad = shard.enqueue_many(part, chunk_size=len(part), on_reject=on_reject, on_coalesce=on_coalesce)
+                done += n
+                rejected += bad
+            inserted += done
+            if on_chunk:
+                on_chunk(done, time.time() - start)
+
+    def fetch_and_claim_job(self, queues=None, worker_id=None, lease_ttl=None):
+        jobs = self.fetch_and_claim_jobs(1, queues=queues, worker_id=worker_id, lease_ttl=lease_ttl)
+        return jobs[0] if jobs else None
+
+    def fetch_and_claim_jobs(self, limit=1, queues=None, worker_id=None, lease_ttl=None, node=None):
+        """
+        Claim up to `limit` jobs, visiting the shards in rotating order (starting one
+        further along on every call). A shard found empty is skipped, at the cost of
+        one PRAGMA data_version, until another connection commits to it or its next
+        delayed job falls due, so idle shards cost no write locks. Jobs carry their 'shard'.
+        A node has one budget however many shards its jobs live in: each shard's
+        claim counts what the node holds in the other shards (and took so far in this
+        call), and while any shard has jobs asking for resources the claim runs under
+        shard 0's write lock, so two workers of a node cannot both spend the same room.
+        """
+        node = tuple(node or this_node())
+        loads = [shard.node_load(node[0]) for shard in self.shards]
+        if not any(sized for _, sized in loads):
+            return self._claim_shards(limit, queues, worker_id, lease_ttl, node, [usage for usage, _ in loads])
+        try:
+            with self.shards[0]._tx():
+                usage = [shard.node_load(node[0])[0] for shard in self.shards]
+                return self._claim_shards(limit, queues, worker_id, lease_ttl, node, usage)
+        except sqlite3.OperationalError:
+            return []
+
+    def _claim_shards(self, limit, queues, worker_id, lease_ttl, node, usage):
+        limit = max(1, int(limit))
+        now_ts = time.time()
+        jobs = []
+        held = [sum(u[0] for u in usage), sum(u[1] for u in usage)]
+        self.turn += 1
+        for k in range(len(self.shards)):
+            index = (self.turn + k) % len(self.shards)
+            shard = self.shards[index]
+            version = shard.data_version()
+            idle = self.idle.get(index)
+            if idle is not None and idle[0] == version and (idle[1] is None or idle[1] > now_ts):
+                continue
+            reserved = (held[0] - usage[index][0], held[1] - usage[index][1])
+            got = shard.fetch_and_claim_jobs(limit - len(jobs), queues, worker_id, lease_ttl, reserved, node)
+            if not got:
+                self.idle[index] = (version, shard.next_available_at(queues))
+                continue
+            self.idle.pop(index, None)
+            for job in got:
+                job['shard'] = index
+                self.claimed[job['id']] = index
+                held[0] += round((job['cpu'] or 0) * 1000)
+                held[1] += job['mem_mb'] or 0
+                jobs.append(job)
+            if len(jobs) >= limit:
+                break
+        return jobs
+
+    def heartbeat(self, worker_id, lease_ttl):
+        held = set(self.claimed.values())
+        return sum(self.shards[i].heartbeat(worker_id, lease_ttl) for i in held)
+
+    def reap_expired_leases(self, now_ts=None):
+        return [job_id for shard in self.shards for job_id in shard.reap_expired_leases(now_ts)]
+
+    def expire_leases(self, worker_id):
+        return [job_id for shard in self.shards for job_id in shard.expire_leases(worker_id)]
+
+    def release_jobs(self, job_ids):
+        self.idle.clear()
+        for index, ids in self._group(job_ids, lambda job_id: job_id).items():
+            self.shards[index].release_jobs(ids)
+            for job_id in ids:
+                self.claimed.pop(job_id, None)
+
+    def update_job_after_run(self, job_id, *args, **kwargs):
+        self.idle.clear()
+        shard = self._locate(job_id)
+        self.claimed.pop(job_id, None)
+        if shard is None:
+            return [job_id]
+        return shard.update_job_after_run(job_id, *args, **kwargs)
+
+    def update_jobs_after_run(self, results):
+        """As DB.update_jobs_after_run: one transaction per shard touched."""
+        self.idle.clear()
+        lost = []
+        groups = self._group(results, lambda r: r['job_id'])
+        found = {r['job_id'] for part in groups.values() for r in part}
+        lost += [r['job_id'] for r in results if r['job_id'] not in found]
+        for index, part in groups.items():
+            lost += self.shards[index].update_jobs_after_run(part)
+        for r in results:
+            self.claimed.pop(r['job_id'], None)
+        return lost
+
+    def append_output(self, rows):
+        for index, part in self._group(rows, lambda row: row[0]).items():
+            self.shards[index].append_output(part)
+
+    def read_output(self, job_id, after_seq=0, attempt=None, limit=256):
+        shard = self._locate(job_id)
+        return shard.read_output(job_id, after_seq, attempt, limit) if shard else []
+
+    def output_attempt(self, job_id):
+        shard = self._locate(job_id)
+        return shard.output_attempt(job_id) if shard else None
+
+    def get_output(self, job_id):
+        shard = self._locate(job_id)
+        return shard.get_output(job_id) if shard else {'stdout': '', 'stderr': ''}
+
+    def get_job(self, job_id):
+        shard = self._locate(job_id)
+        if shard is None:
+            return None
+        job = shard.get_job(job_id)
+        job['shard'] = self.shards.index(shard)
+        return job
+
+    def dlq_retry(self, job_id):
+        shard = self._locate(job_id)
+        if shard is None:
+            return False, 'not found or not dead'
+        return shard.dlq_retry(job_id)
+
+    def dlq_retry_many(self, limit=None, **kwargs):
+        done = 0
+        for shard in self.shards:
+            done += shard.dlq_retry_many(limit=None if limit is None else limit - done, **kwargs)
+        self.idle.clear()
+        return done
+
+    def dlq_purge(self, limit=None, **kwargs):
+        done = 0
+        for shard in self.shards:
+            done += shard.dlq_purge(limit=None if limit is None else limit - done, **kwargs)
+        return done
+
+    def dlq_summary(self, limit=20):
+        """As DB.dlq_summary, merging every shard's groups."""
+        groups = {}
+        for shard in self.shards:
+            for g in shard.dlq_summary(limit=None):
+                k = (g['last_error'], g['command'])
+                if k in groups:
+                    m = groups[k]
+                    m['count'] += g['count']
+                    m['first'], m['last'] = min(m['first'], g['first']), max(m['last'], g['last'])
+                else:
+                    groups[k] = g
+        return sorted(groups.values(), key=lambda g: (-g['count'], g['last_error'] or ''))[:limit]
+
+    def cascade_failures(self, batch_size=500, pause=0.01):
+        return sum(shard.cascade_failures(batch_size, pause) for shard in self.shards)
+
+    def job_graph(self, job_id, depth=5, limit=1000):
+        shard = self._locate(job_id)
+        return shard.job_graph(job_id, depth, limit) if shard else {'up': [], 'down': []}
+
+    def data_version(self):
+        return sum(shard.data_version() for shard in self.shards)
+
+    def node_usage(self):
+        total = {}
+        for shard in self.shards:
+            for node, (cpu_milli, mem_mb) in shard.node_usage().items():
+                held = total.get(node, (0, 0))
+                total[node] = (held[0] + cpu_milli, held[1] + mem_mb)
+        return dict(sorted(total.items()))
+
+    def next_token_at(self):
+        times = [t for t in (shard.next_token_at() for shard in self.shards) if t is not None]
+        return min(times) if times else None
+
+    def set_key_limit(self, key, max_in_flight=None, rate=None, burst=None):
+        """As DB.set_key_limit, on every shard (a key's jobs all live in one of them)."""
+        for shard in self.shards:
+            shard.set_key_limit(key, max_in_flight, rate, burst)
+
+    def remove_key_limit(self, key):
+        return any([shard.remove_key_limit(key) for shard in self.shards])
+
+    def list_key_limits(self):
+        """As DB.list_key_limits: the limits of shard 0 with in-flight counts and tokens summed."""
+        rows = {r['key']: r for r in self.shards[0].list_key_limits()}
+        for shard in self.shards[1:]:
+            for r in shard.list_key_limits():
+                if r['key'] in rows:
+                    rows[r['key']]['in_flight'] += r['in_flight']
+        return list(rows.values())
+
+    def next_available_at(self, queues=None):
+        times = [t for t in (shard.next_available_at(queues) for shard in self.shards) if t is not None]
+        return min(times) if times else None
+
+    def get_status_counts(self, queue=None):
+        out = {}
+        for shard in self.shards:
+            for state, n in shard.get_status_counts(queue).items():
+                out[state] = out.get(state, 0) + n
+        return out
+
+    def get_queue_stats(self):
+        out = {}
+        for shard in self.shards:
+            for queue, counts in shard.get_queue_stats().items():
+                q = out.setdefault(queue, {})
+                for state, n in counts.items():
+                    q[state] = q.get(state, 0) + n
+        return dict(sorted(out.items()))
+
+    def verify_status_counts(self, repair=True):
+        return [d for shard in self.shards for d in shard.verify_status_counts(repair)]
+
+    def list_jobs(self, state=None):
+        return [row for _, row in self.iter_jobs(state=state)]
+
+    def iter_jobs(self, limit=None, **kwargs):
+        """As DB.iter_jobs, merging the shards' streams in (seq, id) order; cursors stay valid."""
+        streams = [shard.iter_jobs(limit=limit, **kwargs) for shard in self.shards]
+        return islice(heapq.merge(*streams, key=_cursor_key), limit)
+
+    def gc_jobs(self, state, **kwargs):
+        return sum(shard.gc_jobs(state, **kwargs) for shard in self.shards)
+
+    def run_retention(self, policy, archive=None, batch_size=500, on_batch=None):
+        removed = {}
+        for shard in self.shards:
+            for state, n in shard.run_retention(policy, archive, batch_size, on_batch).items():
+                removed[state] = removed.get(state, 0) + n
+        return removed
+
+    def compact(self, vacuum_pages=1000, checkpoint='PASSIVE'):
+        """As DB.compact, summed over the shards."""
+        free, busy, frames, done = 0, 0, 0, 0
+        for shard in self.shards:
+            f, (b, w, c) = shard.compact(vacuum_pages, checkpoint)
+            free, busy, frames, done = free + f, busy or b, frames + w, done + c
+        return free, (busy, frames, done)
+
+    def count_completed_since(self, since_ts):
+        return sum(shard.count_completed_since(since_ts) for shard in self.shards)
+
+    def get_metrics(self, worker=None):
+        """As DB.get_metrics, summed over the shards (shards count coalesced enqueues locally)."""
+        rows = {}
+        for shard in self.shards:
+            for r in shard.get_metrics(worker):
+                k = (r['worker'], r['name'], r['key'])
+                if k in rows:
+                    rows[k]['value'] += r['value']
+                    rows[k]['updated_at'] = max(rows[k]['updated_at'] or 0, r['updated_at'] or 0)
+                else:
+                    rows[k] = r
+        return [rows[k] for k in sorted(rows)]
+
+    def metric_totals(self, name):
+        out = {}
+        for shard in self.shards:
+            for key, value in shard.metric_totals(name).items():
+                out[key] = out.get(key, 0) + value
+        return out
+
+    def reset_metrics(self):
+        for shard in self.shards:
+            shard.reset_metrics()
+
+    def vacuum(self):
+        for shard in self.shards:
+            shard.vacuum()
+
+def _main_op(op):
+    def method(self, *args, **kwargs):
+        return getattr(self.shards[0], op)(*args, **kwargs)
+    method.__name__ = op
+    method.__doc__ = getattr(DB, op).__doc__
+    return method
+
+for _op in MAIN_OPS:
+    setattr(ShardedDB, _op, _main_op(_op))
@@ -1,85 +1,330 @@
 # queuectl/worker.py
-import subprocess
+import os
 import time
 import signal
+import socket
+import sqlite3
 import threading
 from multiprocessing import current_process
-from .db import DB, DEFAULT_CONFIG
+from .db import DEFAULT_CONFIG
+from .broker import open_db, BrokerLost
+from .metrics import Metrics
+from .notify import Waiter
+from .output import JobOutput
+from .pool import PythonPool
+from .resources import this_node
+from .runner import run_command
 
-def worker_loop(worker_id: int):
+# how often to check PRAGMA data_version when no wakeup socket is available
+FALLBACK_POLL = 0.05
+
+def parse_queues(spec):
+    """Parse "a:3,b,c:2" into [('a', 3), ('b', 1), ('c', 2)]."""
+    out = []
+    for part in (spec or '').split(','):
+        part = part.strip()
+        if not part:
+            continue
+        name, _, weight = part.partition(':')
+        weight = int(weight) if weight else 1
+        if weight < 1:
+            raise ValueError(f'queue weight must be >= 1: {part}')
+        out.append((name, weight))
+    return out
+
+class QueueSelector:
+    """
+    Smooth weighted round-robin over named queues: over any window a queue with
+    weight 3 is tried first three times as often as one with weight 1, without
+    bursts. `order()` returns every queue, preferred one first, so a trip to the DB
+    can fall through to the others when the preferred queue is empty.
+    """
+    def __init__(self, weighted):
+        self.weights = dict(weighted)
+        self.current = {q: 0 for q in self.weights}
+
+    def order(self):
+        if not self.weights:
+            return None
+        total = sum(self.weights.values())
+        for q, w in self.weights.items():
+            self.current[q] += w
+        best = max(self.current, key=self.current.get)
+        self.current[best] -= total
+        rest = sorted((q for q in self.weights if q != best), key=lambda q: -self.weights[q])
+        return [best] + rest
+
+def retry_delay(backoff_base, attempts):
+    try:
+        base = float(backoff_base)
+    except Exception:
+        base = DEFAULT_CONFIG['backoff_base']
+    return int(base ** attempts)
+
+def run_job(worker_id, job, global_timeout, backoff_base, output_max_bytes=DEFAULT_CONFIG['output_max_bytes'], flush=None, pool=None,
+            cgroup_root=None):
+    """
+    Execute one claimed job and return its result as a dict suitable for
+    DB.update_jobs_after_run. Output streams into a capped JobOutput; head chunks
+    go to `flush` while the job runs and the rest rides along in the result.
+    `python:` jobs run in `pool` (a PythonPool); others are confined to their
+    cpu/mem_mb, in a sub-group of `cgroup_root` when given.
+    """
+    job_id = job['id']
+    command = job['command']
+    attempts = job['attempts']
+    job_timeout = job.get('timeout') or global_timeout
+    print(f"[worker {worker_id}] picked job {job_id} (attempts={attempts}) -> {command} (timeout={job_timeout})")
+    output = JobOutput(job_id, attempts + 1, output_max_bytes, flush=flush)
+    start = time.time()
+    timed_out = False
+    success = False
+    exit_code = None
+    usage = {}
+    try:
+        exit_code, timed_out = run_command(job, job_timeout, output, pool, usage, cgroup_root)
+        success = (exit_code == 0 and not timed_out)
+        if timed_out:
+            exit_code = -1
+            print(f"[worker {worker_id}] job {job_id} timed out after {job_timeout}s")
+        elif success:
+            print(f"[worker {worker_id}] job {job_id} completed (exit {exit_code}) in {time.time()-start:.2f}s")
+        else:
+            print(f"[worker {worker_id}] job {job_id} failed (exit {exit_code})")
+    except Exception as e:
+        exit_code = -1
+        output.write('stderr', str(e).encode())
+        print(f"[worker {worker_id}] job {job_id} raised exception: {e}")
+
+    duration = time.time() - start
+    return job_result(worker_id, job, success, exit_code, output.close(), duration, timed_out, backoff_base, usage)
+
+def job_result(worker_id, job, success, exit_code, output, duration, timed_out, backoff_base, usage=None):
+    """
+    Turn the outcome of one run into a result dict suitable for DB.update_jobs_after_run.
+    `usage` holds the run's peak_rss_kb and cpu_time, when they were measured.
+    """
+    job_id = job['id']
+    attempts = job['attempts'] + 1
+    max_retries = job['max_retries']
+    result = dict(job_id=job_id, success=success, attempts=attempts, max_retries=max_retries,
+                  output=output, duration=duration, timed_out=timed_out, worker_id=job.get('worker_id'))
+    result.update(usage or {})
+    if not success:
+        delay = retry_delay(backoff_base, attempts)
+        result['error_msg'] = f"exit={exit_code}" + (", timeout" if timed_out else "")
+        result['next_available_delay'] = delay
+        if attempts >= max_retries:
+            print(f"[worker {worker_id}] job {job_id} moved to DLQ after {attempts} attempts")
+        else:
+            print(f"[worker {worker_id}] will retry job {job_id} after {delay}s (attempt {attempts}/{max_retries})")
+    return result
+
+def python_pool(db, size=1):
+    """A PythonPool configured from python_pool_max_jobs, python_pool_max_rss_mb and python_preload."""
+    return PythonPool(size, max_jobs=db.get_config('python_pool_max_jobs') or DEFAULT_CONFIG['python_pool_max_jobs'],
+                      max_rss_mb=db.get_config('python_pool_max_rss_mb') or DEFAULT_CONFIG['python_pool_max_rss_mb'],
+                      preload=db.get_config('python_preload') or ())
+
+def maybe_run_gc(db):
+    """
+    Background retention: when `gc_interval` is set, whichever idle worker wins the
+    periodic slot applies `gc_policy` and compacts the database.
+    """
+    interval = db.get_config('gc_interval') or 0
+    if not interval or not db.try_claim_periodic('gc', float(interval)):
+        return
+    policy = db.get_config('gc_policy') or DEFAULT_CONFIG['gc_policy']
+    try:
+        removed = db.run_retention(policy)
+        db.compact()
+    except Exception as e:
+        print(f"[gc] failed: {e}")
+        return
+    if any(removed.values()):
+        print(f"[gc] removed {removed}")
+
+def lease_owner():
+    """Identity recorded on the jobs a worker process leases."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+class Heartbeat(threading.Thread):
+    """
+    Every lease_ttl / 3 seconds marks the worker alive in the workers table and,
+    while `active` is set (i.e. jobs are claimed), extends the leases of everything
+    it holds with one UPDATE. Runs on its own thread (and so its own connection) while the main thread is
+    busy running a job.
+    """
+    def __init__(self, db, owner, lease_ttl):
+        super().__init__(name='queuectl-heartbeat', daemon=True)
+        self.db = db
+        self.owner = owner
+        self.lease_ttl = lease_ttl
+        self.interval = max(0.5, lease_ttl / 3)
+        self.active = threading.Event()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.db.touch_worker(self.owner)
+                if self.active.is_set():
+                    self.db.heartbeat(self.owner, self.lease_ttl)
+            except (sqlite3.Error, OSError) as e:
+                print(f"[heartbeat {self.owner}] failed: {e}")
+
+    def stop(self):
+        self.stopped.set()
+
+class LeaseReaper:
+    """
+    Runs DB.reap_expired_leases at most every lease_ttl / 2 seconds, cascades job
+    failures to their dependents, and forgets workers that have not been seen for
+    several lease TTLs.
+    """
+    def __init__(self, db, worker_id, lease_ttl):
+        self.db = db
+        self.worker_id = worker_id
+        self.lease_ttl = lease_ttl
+        self.interval = max(1.0, lease_ttl / 2)
+        self.next_at = 0
+
+    def maybe_reap(self):
+        if time.time() < self.next_at:
+            return
+        self.next_at = time.time() + self.interval
+        try:
+            reaped = self.db.reap_expired_leases()
+            cascaded = self.db.cascade_failures()
+            self.db.prune_workers(3 * self.lease_ttl)
+        except sqlite3.OperationalError:
+            return
+        if reaped:
+            print(f"[worker {self.worker_id}] recovered {len(reaped)} job(s) with expired leases: {', '.join(reaped[:10])}")
+        if cascaded:
+            print(f"[worker {self.worker_id}] marked {cascaded} job(s) dead after a dependency failed")
+
+def next_due(db, queues, claimed_at):
+    """
+    When an idle worker should try to claim again: when the next pending job falls
+    due. Jobs that were already due when the claim at `claimed_at` came back empty
+    are held back by concurrency or rate limits or the node's cpu/memory budget, so
+    then only a token refill (or a commit freeing a slot or resources, which wakes
+    the worker anyway) can help.
+    """
+    next_at = db.next_available_at(queues)
+    if next_at is not None and next_at <= claimed_at:
+        return db.next_token_at()
+    return next_at
+
+def wait_for_work(db, waiter, stop_event, seen_version, poll_interval, queues=None, wake_at=None, claimed_at=None):
+    """
+    Block an idle worker until there may be something to claim: a wakeup from an
+    enqueue, the earliest delayed retry becoming due, or (as a fallback for writers
+    that do not notify) another connection committing since `seen_version`.
+    Also returns at `wake_at` so periodic chores (lease reaping) keep running.
+    """
+    next_at = db.next_available_at(queues) if claimed_at is None else next_due(db, queues, claimed_at)
+    if wake_at is not None:
+        next_at = wake_at if next_at is None else min(next_at, wake_at)
+    if waiter.sock is None:
+        poll_interval = min(poll_interval, FALLBACK_POLL)
+    while not stop_event.is_set():
+        now = time.time()
+        if next_at is not None and next_at <= now:
+            return
+        timeout = poll_interval if next_at is None else min(poll_interval, next_at - now)
+        if waiter.wait(timeout):
+            return
+        if db.data_version() != seen_version:
+            return
+
+def worker_loop(worker_id: int, prefetch: int = 1, queues=None):
     """
     Worker loop runs inside the child process.
     Create a local threading.Event here to watch for shutdown.
+    With prefetch > 1 the worker claims up to that many jobs per trip to the DB,
+    runs them in order and writes all results back in one transaction.
+    `queues` is a list of (name, weight) pairs to serve; None serves every queue.
     """
-    db = DB()
+    db = open_db()
     proc = current_process()
     print(f"[worker {worker_id}] started (pid={proc.pid})")
 
     stop_event = threading.Event()
+    waiter = Waiter(db.path)
 
     def handle_sigterm(signum, frame):
         print(f"[worker {worker_id}] received shutdown signal; will exit after current job")
         stop_event.set()
+        waiter.interrupt()
 
     signal.signal(signal.SIGINT, handle_sigterm)
     signal.signal(signal.SIGTERM, handle_sigterm)
 
     backoff_base = db.get_config('backoff_base') or DEFAULT_CONFIG['backoff_base']
     global_timeout = db.get_config('job_timeout') or DEFAULT_CONFIG['job_timeout']
+    poll_interval = float(db.get_config('idle_poll_interval') or DEFAULT_CONFIG['idle_poll_interval'])
+    output_max_bytes = db.get_config('output_max_bytes') or DEFAULT_CONFIG['output_max_bytes']
+    lease_ttl = float(db.get_config('lease_ttl') or DEFAULT_CONFIG['lease_ttl'])
+    cgroup_root = db.get_config('cgroup_root')
+    selector = QueueSelector(queues or [])
+    names = [q for q, _ in queues] if queues else None
+    owner = lease_owner()
+    node = this_node()
+    db.register_worker(owner, socket.gethostname(), os.getpid(), 'sync')
+    heartbeat = Heartbeat(db, owner, lease_ttl)
+    heartbeat.start()
+    reaper = LeaseReaper(db, worker_id, lease_ttl)
+    metrics = db.metrics = Metrics(owner)
+    pool = python_pool(db)
 
-    while not stop_event.is_set():
-        job = db.fetch_and_claim_job()
-        if not job:
-            time.sleep(0.5)
-            continue
-        job_id = job['id']
-        command = job['command']
-        attempts = job['attempts']
-        max_retries = job['max_retries']
-        job_timeout = job.get('timeout') or global_timeout
-        print(f"[worker {worker_id}] picked job {job_id} (attempts={attempts}) -> {command} (timeout={job_timeout})")
-        start = time.time()
-        timed_out = False
-        stdout = None
-        stderr = None
-        success = False
-        exit_code = None
-        try:
-            completed = subprocess.run(command, shell=True, capture_output=True, text=True, timeout=job_timeout)
-            exit_code = completed.returncode
-            stdout = completed.stdout
-            stderr = completed.stderr
-            success = (exit_code == 0)
-            if success:
-                print(f"[worker {worker_id}] job {job_id} completed (exit {exit_code}) in {time.time()-start:.2f}s")
-            else:
-                print(f"[worker {worker_id}] job {job_id} failed (exit {exit_code})")
-        except subprocess.TimeoutExpired as e:
-            timed_out = True
-            stdout = getattr(e, 'output', '') or ''
-            stderr = getattr(e, 'stderr', '') or ''
-            exit_code = -1
-            print(f"[worker {worker_id}] job {job_id} timed out after {job_timeout}s")
-        except Exception as e:
-            exit_code = -1
-            stderr = str(e)
-            print(f"[worker {worker_id}] job {job_id} raised exception: {e}")
-
-        duration = time.time() - start
-        attempts = attempts + 1
-        if success:
-            db.update_job_after_run(job_id, True, attempts, max_retries, stdout=stdout, stderr=stderr, duration=duration, timed_out=timed_out)
-        else:
+    try:
+        while not stop_event.is_set():
+            reaper.maybe_reap()
+            metrics.maybe_flush(db)
+            # read before claiming so a commit racing with the claim still wakes us
+            seen_version = db.data_version()
+            claimed_at = time.time()
+            started = time.perf_counter()
+            try:
+                batch = db.fetch_and_claim_jobs(prefetch, queues=selector.order(), worker_id=owner, lease_ttl=lease_ttl, node=node)
+            except BrokerLost as e:
+                # anything it did claim comes back when the lease expires
+                print(f"[worker {worker_id}] {e}")
+                continue
+            metrics.record_claim(batch, time.perf_counter() - started)
+            if not batch:
+                maybe_run_gc(db)
+                wait_for_work(db, waiter, stop_event, seen_version, poll_interval, names, wake_at=reaper.next_at,
+                              claimed_at=claimed_at)
+                continue
+            heartbeat.active.set()
+            results = []
+            for i, job in enumerate(batch):
+                if stop_event.is_set():
+                    # give the unstarted part of the batch back to other workers
+                    db.release_jobs([j['id'] for j in batch[i:]])
+                    break
+                results.append(run_job(worker_id, job, global_timeout, backoff_base, output_max_bytes, flush=db.append_output, pool=pool,
+                                       cgroup_root=cgroup_root))
+                metrics.record_result(results[-1])
+            started = time.perf_counter()
             try:
-                base = float(backoff_base)
-            except Exception:
-                base = DEFAULT_CONFIG['backoff_base']
-            delay = int(base ** attempts)
-            err_msg = f"exit={exit_code}" + (", timeout" if timed_out else "")
-            db.update_job_after_run(job_id, False, attempts, max_retries, error_msg=err_msg, next_available_delay=delay, stdout=stdout, stderr=stderr, duration=duration, timed_out=timed_out)
-            if attempts >= max_retries:
-                print(f"[worker {worker_id}] job {job_id} moved to DLQ after {attempts} attempts")
-            else:
-                print(f"[worker {worker_id}] will retry job {job_id} after {delay}s (attempt {attempts}/{max_retries})")
+                lost = db.update_jobs_after_run(results)
+            except BrokerLost as e:
+                # if the broker did not commit them, the jobs run again when their leases expire
+                print(f"[worker {worker_id}] {e}")
+                lost = []
+            metrics.record_writeback(lost, time.perf_counter() - started)
+            heartbeat.active.clear()
+            if lost:
+                print(f"[worker {worker_id}] discarded results of {len(lost)} job(s) whose lease expired: {', '.join(lost[:10])}")
+    finally:
+        heartbeat.stop()
+        metrics.flush(db)
+        db.remove_worker(owner)
+        pool.close()
+        waiter.close()
 
     print(f"[worker {worker_id}] exiting")
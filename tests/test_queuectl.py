@@ -2,6 +2,7 @@
 import os
 import time
 import json
+import sqlite3
 import signal
 import shutil
 import pytest
@@ -13,13 +14,15 @@ ROOT = Path(__file__).resolve().parents[1]
 import sys
 sys.path.insert(0, str(ROOT))
 
-from queuectl.db import DB
-from queuectl.worker import worker_loop
+from queuectl.db import DB, SCHEMA_VERSION
+from queuectl.archive import open_archive
+from queuectl.worker import worker_loop, run_job, QueueSelector
+from queuectl.async_worker import async_worker_loop
 
 CLI = ROOT / 'bin' / 'queuectl'
 
-def start_worker_proc(worker_id=1):
-    p = Process(target=worker_loop, args=(worker_id,))
+def start_worker_proc(worker_id=1, prefetch=1):
+    p = Process(target=worker_loop, args=(worker_id, prefetch))
     p.start()
     return p
 
@@ -63,7 +66,7 @@ def test_basic_job_completes():
     for _ in range(50):
         r = read_job(db, jobid)
         if r and r['state'] == 'completed':
-            assert r['stdout'] is not None and 'test-basic' in (r['stdout'] or '')
+            assert 'test-basic' in db.get_output(jobid)['stdout']
             stop_proc(p)
             return
         time.sleep(0.1)
@@ -125,7 +128,7 @@ def test_invalid_command_fails_gracefully():
             # should not be completed; expect dead
             assert r['state'] == 'dead'
             # stderr should contain something or last_error set
-            assert (r.get('stderr') and r['stderr'] != '') or (r.get('last_error') and r['last_error'] != '')
+            assert db.get_output(jobid)['stderr'] != '' or (r.get('last_error') and r['last_error'] != '')
             stop_proc(p)
             return
         time.sleep(0.1)
@@ -148,3 +151,727 @@ def test_persistence_across_restart():
         time.sleep(0.05)
     stop_proc(p)
     pytest.fail("persistence test failed: job not completed after restart")
+
+def test_enqueue_many_chunks_and_rejects():
+    db = DB()
+    db.enqueue({'id': 'dup', 'command': 'true'})
+    jobs = ({'id': f'bulk-{i}', 'command': 'true'} for i in range(25))
+    chunks = []
+    rejects = []
+    extra = [{'id': 'dup', 'command': 'true'}, {'id': 'nocmd'}]
+    inserted, rejected = db.enqueue_many(
+        list(jobs) + extra, chunk_size=10,
+        on_chunk=lambda n, elapsed: chunks.append(n),
+        on_reject=lambda job, err: rejects.append(job.get('id')))
+    assert inserted == 25
+    assert rejected == 2
+    assert chunks == [10, 10, 5]
+    assert sorted(rejects) == ['dup', 'nocmd']
+    assert db.get_status_counts().get('pending') == 26
+
+def test_batch_claim_and_prefetch_worker():
+    db = DB()
+    for i in range(5):
+        db.enqueue({'id': f'b{i}', 'command': f'echo batch-{i}', 'max_retries': 1})
+    claimed = db.fetch_and_claim_jobs(3)
+    assert [j['id'] for j in claimed] == ['b0', 'b1', 'b2']
+    assert all(j['state'] == 'processing' for j in claimed)
+    db.release_jobs([j['id'] for j in claimed])
+    assert db.get_status_counts().get('pending') == 5
+    p = start_worker_proc(1, prefetch=4)
+    for _ in range(100):
+        if db.get_status_counts().get('completed', 0) == 5:
+            stop_proc(p)
+            return
+        time.sleep(0.05)
+    stop_proc(p)
+    pytest.fail("prefetching worker did not drain the queue")
+
+def _claim_in_child(db, q):
+    job = db.fetch_and_claim_job()
+    q.put(job['id'] if job else None)
+
+def test_persistent_connection_schema_version_and_fork():
+    import multiprocessing
+    db = DB(pragmas={'synchronous': 'NORMAL'})
+    assert db._conn() is db._conn()
+    assert db._conn().execute('PRAGMA user_version').fetchone()[0] == SCHEMA_VERSION
+    assert db._conn().execute('PRAGMA synchronous').fetchone()[0] == 1
+    with pytest.raises(ValueError):
+        DB(pragmas={'journal_mode': 'DELETE'})
+    db.enqueue({'id': 'fork-1', 'command': 'true'})
+    # a DB object inherited across fork must open its own connection in the child
+    ctx = multiprocessing.get_context('fork')
+    q = ctx.Queue()
+    p = ctx.Process(target=_claim_in_child, args=(db, q))
+    p.start()
+    assert q.get(timeout=5) == 'fork-1'
+    p.join(timeout=5)
+    assert read_job(db, 'fork-1')['state'] == 'processing'
+
+def test_enqueue_wakes_idle_worker_quickly():
+    from queuectl.notify import Waiter, notify
+    db = DB()
+    w = Waiter(db.path)
+    assert not w.wait(0.01)
+    notify(db.path)
+    assert w.wait(1)
+    w.close()
+    p = start_worker_proc(1)
+    time.sleep(0.5)  # let the worker go idle
+    start = time.time()
+    db.enqueue({'id': 'wake-1', 'command': 'true', 'max_retries': 1})
+    for _ in range(200):
+        r = read_job(db, 'wake-1')
+        if r['state'] == 'completed':
+            break
+        time.sleep(0.005)
+    stop_proc(p)
+    assert read_job(db, 'wake-1')['state'] == 'completed'
+    # far below the idle poll interval, so the enqueue itself woke the worker
+    assert time.time() - start < 1.0
+
+def test_async_worker_runs_jobs_concurrently_and_times_out():
+    db = DB()
+    db.set_config('backoff_base', 1)
+    for i in range(8):
+        db.enqueue({'id': f'a{i}', 'command': 'sleep 0.5; echo async-ok', 'max_retries': 1})
+    db.enqueue({'id': 'a-slow', 'command': 'sleep 5', 'max_retries': 1, 'timeout': 1})
+    p = Process(target=async_worker_loop, args=(1, 16))
+    p.start()
+    start = time.time()
+    for _ in range(100):
+        counts = db.get_status_counts()
+        if counts.get('completed', 0) == 8 and counts.get('dead', 0) == 1:
+            break
+        time.sleep(0.05)
+    elapsed = time.time() - start
+    stop_proc(p)
+    assert db.get_status_counts().get('completed', 0) == 8
+    # 8 half-second jobs ran side by side rather than back to back
+    assert elapsed < 3
+    slow = read_job(db, 'a-slow')
+    assert slow['state'] == 'dead' and slow['timed_out'] == 1
+    assert 'async-ok' in db.get_output('a0')['stdout']
+
+def test_output_is_capped_compressed_and_kept_off_jobs_rows():
+    db = DB()
+    db.set_config('output_max_bytes', 2000)
+    cmd = "python3 -c \"import sys; sys.stdout.write('H' * 1000 + 'x' * 50000 + 'T' * 1000); sys.stderr.write('oops')\""
+    db.enqueue({'id': 'chatty', 'command': cmd, 'max_retries': 1})
+    p = start_worker_proc(1)
+    for _ in range(100):
+        if read_job(db, 'chatty')['state'] == 'completed':
+            break
+        time.sleep(0.05)
+    stop_proc(p)
+    job = read_job(db, 'chatty')
+    assert job['state'] == 'completed'
+    assert 'stdout' not in job
+    out = db.get_output('chatty')
+    assert out['stdout'].startswith('H' * 1000)
+    assert out['stdout'].endswith('T' * 1000)
+    assert '[50000 bytes truncated]' in out['stdout']
+    assert out['stderr'] == 'oops'
+
+def test_priority_and_named_queue_claims():
+    db = DB()
+    db.enqueue({'id': 'low', 'command': 'true'})
+    db.enqueue({'id': 'high', 'command': 'true', 'priority': 5})
+    db.enqueue({'id': 'other', 'command': 'true', 'queue': 'emails', 'priority': 9})
+    assert [j['id'] for j in db.fetch_and_claim_jobs(2, queues=['default'])] == ['high', 'low']
+    assert db.fetch_and_claim_job(queues=['default']) is None
+    assert db.fetch_and_claim_job()['id'] == 'other'
+    plan = ' '.join(r[3] for r in db._conn().execute(
+        "EXPLAIN QUERY PLAN SELECT rowid FROM jobs INDEXED BY idx_claim_queue WHERE state = 'pending' "
+        "AND available_at <= 0 AND queue = 'a' ORDER BY priority DESC, seq LIMIT 1"))
+    assert 'COVERING INDEX' in plan and 'TEMP B-TREE' not in plan
+    sel = QueueSelector([('a', 3), ('b', 1)])
+    picks = [sel.order()[0] for _ in range(8)]
+    assert picks.count('a') == 6 and picks.count('b') == 2
+
+def test_queue_stats_counters_stay_exact():
+    db = DB()
+    db.enqueue_many([{'id': f's{i}', 'command': 'true', 'queue': 'q1' if i % 2 else 'q2'} for i in range(6)])
+    job = db.fetch_and_claim_job(queues=['q1'])
+    db.update_job_after_run(job['id'], False, 1, 1, error_msg='boom')
+    assert db.get_status_counts() == {'pending': 5, 'dead': 1}
+    assert db.get_queue_stats() == {'q1': {'pending': 2, 'dead': 1}, 'q2': {'pending': 3}}
+    assert db.dlq_retry(job['id'])[0]
+    assert db.get_status_counts(queue='q1') == {'pending': 3}
+    assert db.verify_status_counts() == []
+    db._conn().execute("UPDATE queue_stats SET count = 99 WHERE queue = 'q2'")
+    assert db.verify_status_counts() == [('q2', 'pending', 99, 3)]
+    assert db.get_status_counts() == {'pending': 6}
+
+def test_gc_archives_old_finished_jobs_in_batches():
+    import gzip
+    db = DB()
+    for i in range(7):
+        db.enqueue({'id': f'g{i}', 'command': 'true'})
+    for job in db.fetch_and_claim_jobs(7):
+        db.update_job_after_run(job['id'], job['id'] != 'g6', 1, 1, stdout=f"out-{job['id']}")
+    db._conn().execute("UPDATE jobs SET updated_at = '2000-01-01T00:00:00+00:00' WHERE id IN ('g0','g1','g2','g3','g4')")
+    batches = []
+    removed = db.gc_jobs('completed', max_age=86400, batch_size=2, archive=open_archive('old.jsonl.gz'), on_batch=batches.append)
+    assert removed == 5 and batches == [2, 2, 1]
+    archived = [json.loads(l) for l in gzip.open('old.jsonl.gz', 'rt')]
+    assert sorted(j['id'] for j in archived) == ['g0', 'g1', 'g2', 'g3', 'g4']
+    assert archived[0]['stdout'].startswith('out-')
+    assert db.gc_jobs('dead', keep=0, archive=open_archive('arch.db')) == 1
+    assert db.get_status_counts() == {'completed': 1}
+    assert db.get_output('g0') == {'stdout': '', 'stderr': ''}
+    import sqlite3
+    assert sqlite3.connect('arch.db').execute('SELECT id FROM jobs').fetchall() == [('g6',)]
+    with pytest.raises(ValueError):
+        db.gc_jobs('pending', keep=0)
+
+def test_iter_jobs_keyset_pagination_filters_and_projection():
+    db = DB()
+    db.enqueue_many({'id': f'p{i:02d}', 'command': 'true', 'queue': 'odd' if i % 2 else 'even'} for i in range(12))
+    first = list(db.iter_jobs(limit=5, fields=['id', 'state'], batch_size=2))
+    assert [r['id'] for _, r in first] == [f'p{i:02d}' for i in range(5)]
+    assert set(first[0][1]) == {'id', 'state'}
+    rest = list(db.iter_jobs(after=first[-1][0], batch_size=3))
+    assert [r['id'] for _, r in rest] == [f'p{i:02d}' for i in range(5, 12)]
+    assert [r['id'] for _, r in db.iter_jobs(queue='odd', limit=2)] == ['p01', 'p03']
+    job = db.fetch_and_claim_job()
+    db.update_job_after_run(job['id'], False, 1, 1, error_msg='exit=137')
+    assert [r['id'] for _, r in db.iter_jobs(state='dead', error='=137')] == ['p00']
+    assert list(db.iter_jobs(error='exit_1')) == []
+    assert list(db.iter_jobs(until=0)) == []
+    with pytest.raises(ValueError):
+        list(db.iter_jobs(fields=['stdout']))
+
+def test_expired_leases_are_reaped_and_stale_results_discarded():
+    db = DB()
+    db.enqueue({'id': 'lease1', 'command': 'true', 'max_retries': 3})
+    db.enqueue({'id': 'lease2', 'command': 'true', 'max_retries': 3})
+    jobs = db.fetch_and_claim_jobs(2, worker_id='hostA:1', lease_ttl=0.2)
+    assert {j['worker_id'] for j in jobs} == {'hostA:1'}
+    time.sleep(0.3)
+    assert db.heartbeat('hostB:2', 60) == 0
+    db._conn().execute("UPDATE jobs SET lease_expires_at = ? WHERE id = 'lease2'", (time.time() + 60,))
+    assert db.reap_expired_leases() == ['lease1']
+    job = db.get_job('lease1')
+    assert job['state'] == 'pending' and job['attempts'] == 1
+    assert 'lease expired (worker hostA:1)' in job['last_error']
+    # the original worker finishing late must not clobber the requeued job
+    assert db.update_job_after_run('lease1', True, 1, 3, worker_id='hostA:1') == ['lease1']
+    assert db.get_job('lease1')['state'] == 'pending'
+    assert db.heartbeat('hostA:1', 60) == 1
+    assert db.update_job_after_run('lease2', True, 1, 3, worker_id='hostA:1') == []
+    assert db.get_job('lease2')['state'] == 'completed'
+
+def test_bench_reports_json_results_per_scenario():
+    from queuectl.bench import run_benchmarks, parse_count, percentiles
+    assert parse_count('10k') == 10_000 and parse_count('1M') == 1_000_000
+    assert percentiles([0.001] * 99 + [0.1])['p99_us'] == 1000.0
+    report = run_benchmarks(('enqueue', 'claim', 'retry'), backlogs=(200,), workers=(2,), jobs=20, claims=10, base_dir='.')
+    json.dumps(report)
+    assert [r['scenario'] for r in report['results']] == ['enqueue', 'claim', 'retry']
+    claim = report['results'][1]
+    assert claim['workers'] == 2 and claim['claims'] == 20 and claim['latency']['p50_us'] > 0
+    assert report['results'][2]['retry_us_per_job'] > 0
+    assert report['meta']['schema_version'] == SCHEMA_VERSION
+
+def test_worker_metrics_flush_to_table_and_render():
+    from queuectl.metrics import to_json, to_prometheus
+    db = DB()
+    db.enqueue_many({'id': f'm{i}', 'command': 'exit 1' if i == 0 else 'true', 'max_retries': 1} for i in range(3))
+    p = start_worker_proc(1)
+    for _ in range(50):
+        if db.get_status_counts() == {'completed': 2, 'dead': 1}:
+            break
+        time.sleep(0.1)
+    p.terminate()
+    p.join(timeout=5)
+    rows = db.get_metrics()
+    assert rows and len({r['worker'] for r in rows}) == 1
+    report = json.loads(to_json(rows, db.count_completed_since(time.time() - 60)))
+    summary = report['total']
+    assert summary['jobs_total'] == 3 and summary['jobs_failed_total'] == 1 and summary['jobs_per_sec'] == round(2 / 60, 3)
+    # a worker that stopped flushing drops out of the listing but its counts stay in the total
+    later = json.loads(to_json(rows, 0, now_ts=time.time() + 3600))
+    assert later['workers'] == {} and later['total']['jobs_total'] == 3 and later['total']['jobs_per_sec'] == 0
+    assert summary['queue_wait_seconds']['count'] == 3 and summary['run_seconds']['count'] == 3
+    assert summary['claim_seconds']['count'] >= 1 and 0 <= summary['utilization'] <= 1
+    text = to_prometheus(rows)
+    assert '# TYPE queuectl_run_seconds histogram' in text
+    assert 'queuectl_run_seconds_bucket{worker="' in text and 'le="+Inf"} 3' in text
+    assert 'queuectl_jobs_total{worker="' in text
+    big = [{'worker': 'w', 'name': 'jobs_total', 'key': '', 'value': 1234567.0, 'updated_at': time.time()}]
+    assert 'queuectl_jobs_total{worker="w"} 1234567\n' in to_prometheus(big)
+
+def _supervise(lo, hi):
+    from queuectl.manager import WorkerManager
+    WorkerManager().supervise(lo, hi, interval=0.2)
+
+def _sync_workers(db, count, timeout=5):
+    workers = []
+    for _ in range(int(timeout * 10)):
+        workers = [w for w in db.list_workers() if w['mode'] == 'sync']
+        if len(workers) == count:
+            break
+        time.sleep(0.1)
+    return workers
+
+def test_supervisor_scales_restarts_and_tracks_workers_in_db():
+    import subprocess
+    from queuectl.manager import WorkerManager, desired_workers
+    assert desired_workers(2, 100, None, 1, 8) == 4
+    assert desired_workers(4, 0, 5.0, 1, 8) == 5
+    assert desired_workers(3, 0, None, 1, 8, idle_ticks=5) == 2
+    assert desired_workers(1, 0, None, 1, 8, idle_ticks=9) == 1
+    db = DB()
+    db.enqueue_many({'id': f'sup{i}', 'command': 'sleep 0.3'} for i in range(12))
+    sup = Process(target=_supervise, args=(1, 3))
+    sup.start()
+    workers = _sync_workers(db, 3)
+    assert len(workers) == 3 and {w['supervisor'] for w in workers} == {f'{workers[0]["hostname"]}:{sup.pid}'}
+    os.kill(workers[0]['pid'], signal.SIGKILL)
+    for _ in range(50):
+        pids = {w['pid'] for w in db.list_workers() if w['mode'] == 'sync'}
+        if workers[0]['pid'] not in pids and len(pids) == 3:
+            break
+        time.sleep(0.1)
+    assert workers[0]['pid'] not in pids and len(pids) == 3
+    # a row nobody has touched within lease_ttl is never signalled (its pid may be reused)
+    bystander = subprocess.Popen(['sleep', '30'])
+    db.register_worker('stale', workers[0]['hostname'], bystander.pid, 'sync')
+    db._conn().execute('UPDATE workers SET last_seen = 0 WHERE id = ?', ('stale',))
+    assert WorkerManager().stop() == 1
+    sup.join(timeout=10)
+    assert not sup.is_alive() and db.list_workers() == []
+    assert bystander.poll() is None
+    bystander.kill()
+    bystander.wait()
+    assert db.get_status_counts().get('processing', 0) == 0
+    # workers of a SIGKILLed supervisor are signalled directly
+    sup = Process(target=_supervise, args=(1, 1))
+    sup.start()
+    assert len(_sync_workers(db, 1)) == 1
+    os.kill(sup.pid, signal.SIGKILL)
+    sup.join()
+    assert WorkerManager().stop() == 1
+    for _ in range(50):
+        if not db.list_workers():
+            break
+        time.sleep(0.1)
+    assert db.list_workers() == []
+
+def test_exec_and_python_jobs_skip_the_shell():
+    from queuectl.output import JobOutput, decompress
+    from queuectl.pool import PythonPool
+    from queuectl.runner import plain_argv
+    assert plain_argv('echo "a b"') == ['echo', 'a b']
+    assert plain_argv('exit 1') is None and plain_argv('echo $HOME') is None and plain_argv('a | b') is None
+    db = DB()
+    db.enqueue({'id': 'ex', 'args': ['echo', 'a  b']})
+    db.enqueue({'id': 'py', 'command': 'python:json:dumps', 'args': [[1, 2]]})
+    db.enqueue({'id': 'pybad', 'command': 'python:queuectl.pool:parse_target', 'args': ['nope'], 'max_retries': 1})
+    assert db.get_job('ex')['kind'] == 'exec' and db.get_job('ex')['command'] == "echo 'a  b'"
+    assert db.get_job('py')['kind'] == 'python'
+    with pytest.raises(ValueError):
+        db.enqueue({'command': 'echo', 'kind': 'python'})
+    with pytest.raises(ValueError):
+        db.enqueue({'command': 'echo', 'args': 'x'})
+    rejects = []
+    assert db.enqueue_many([{'command': 123}], on_reject=lambda job, err: rejects.append(err)) == (0, 1)
+    assert rejects == ['command must be a string']
+    p = start_worker_proc(1)
+    for _ in range(100):
+        if db.get_status_counts() == {'completed': 2, 'dead': 1}:
+            break
+        time.sleep(0.1)
+    stop_proc(p)
+    assert db.get_output('ex')['stdout'] == 'a  b\n'
+    assert db.get_output('py')['stdout'] == '[1, 2]\n'
+    assert 'ValueError' in db.get_output('pybad')['stderr']
+    pool = PythonPool(1, max_jobs=2)
+    try:
+        outs = [JobOutput('pid', 1, 1024) for _ in range(3)]
+        for out in outs:
+            assert pool.run('python:os:getpid', [], 10, out) == (0, False)
+        pids = [decompress(o.close()[0][4]) for o in outs]
+        assert pids[0] == pids[1] != pids[2]
+    finally:
+        pool.close()
+
+def test_broker_group_commits_and_clients_fall_back_when_it_stops():
+    import asyncio
+    import sqlite3
+    import threading
+    from queuectl.broker import Broker, BrokerDB, socket_path
+    db = DB()
+    # nested transactions are savepoints: the inner failure keeps the outer work
+    with db._tx():
+        db.enqueue({'id': 'outer', 'command': 'true'})
+        with pytest.raises(sqlite3.IntegrityError):
+            with db._tx():
+                db.enqueue({'id': 'inner', 'command': 'true'})
+                db.enqueue({'id': 'outer', 'command': 'true'})
+    assert db.get_job('outer') and db.get_job('inner') is None
+
+    broker = Broker(db.path, window=0.02)
+    loop = asyncio.new_event_loop()
+    stop = asyncio.Event()
+    t = threading.Thread(target=lambda: loop.run_until_complete(broker.serve(socket_path(db.path), stop=stop)))
+    t.start()
+    client = BrokerDB(('unix', socket_path(db.path)), db.path)
+    for _ in range(50):
+        if client.ping():
+            break
+        time.sleep(0.05)
+    errors = []
+
+    def enqueue(i):
+        try:
+            client.enqueue({'id': 'outer' if i == 0 else f'bk{i}', 'command': 'true'})
+        except sqlite3.IntegrityError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=enqueue, args=(i,)) for i in range(20)]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    assert len(errors) == 1 and db.get_status_counts() == {'pending': 20}
+    assert broker.requests == 20 and broker.commits < 20
+    rejects = []
+    jobs = [{'id': 'bk1', 'command': 'true'}, {'id': 'bk99', 'command': 'true'}]
+    assert client.enqueue_many(jobs, on_reject=lambda job, err: rejects.append(err)) == (1, 1)
+    assert rejects == ['UNIQUE constraint failed: jobs.id']
+    assert len(client.fetch_and_claim_jobs(3, worker_id='w:1')) == 3
+    loop.call_soon_threadsafe(stop.set)
+    t.join(timeout=5)
+    assert client.ping() is None
+    client.enqueue({'id': 'direct', 'command': 'true'})
+    assert db.get_job('direct')['state'] == 'pending'
+
+def test_broker_lost_after_send_is_not_retried_directly():
+    import socket
+    import threading
+    from queuectl.broker import BrokerDB, BrokerLost, socket_path
+    db = DB()
+    path = socket_path(db.path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    server = socket.socket(socket.AF_UNIX)
+    server.bind(path)
+    server.listen(1)
+
+    def swallow():
+        # read the request, then die without replying, as a broker killed mid-commit would
+        conn, _ = server.accept()
+        conn.makefile('rb').readline()
+        conn.close()
+
+    t = threading.Thread(target=swallow)
+    t.start()
+    client = BrokerDB(('unix', path), db.path)
+    with pytest.raises(BrokerLost):
+        client.enqueue({'id': 'maybe', 'command': 'true'})
+    t.join(timeout=5)
+    assert db.get_job('maybe') is None
+    server.close()
+    os.unlink(path)
+    # nothing listening: the request was never sent, so it goes to SQLite
+    client.enqueue({'id': 'direct', 'command': 'true'})
+    assert db.get_job('direct')['state'] == 'pending'
+
+def test_broker_tcp_requires_the_token(monkeypatch):
+    import asyncio
+    import socket
+    import threading
+    from queuectl.broker import Broker, BrokerDB, is_loopback
+    assert is_loopback('127.0.0.1') and is_loopback('localhost') and not is_loopback('0.0.0.0')
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    db = DB()
+    broker = Broker(db.path, token='s3cret')
+    loop = asyncio.new_event_loop()
+    stop = asyncio.Event()
+    t = threading.Thread(target=lambda: loop.run_until_complete(broker.serve(tcp=('127.0.0.1', port), stop=stop)))
+    t.start()
+    try:
+        client = BrokerDB(('tcp', ('127.0.0.1', port)), remote=True)
+        monkeypatch.setenv('QUEUECTL_BROKER_TOKEN', 'wrong')
+        for _ in range(50):
+            try:
+                client.enqueue({'id': 'evil', 'command': 'true'})
+            except PermissionError:
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.05)
+        else:
+            pytest.fail('broker accepted a bad token')
+        monkeypatch.setenv('QUEUECTL_BROKER_TOKEN', 's3cret')
+        client.enqueue({'id': 'good', 'command': 'true'})
+        assert db.get_job('evil') is None and db.get_job('good')['state'] == 'pending'
+    finally:
+        loop.call_soon_threadsafe(stop.set)
+        t.join(timeout=5)
+
+def test_sharded_db_routes_claims_and_aggregates():
+    from queuectl.broker import open_db
+    from queuectl.shards import ShardedDB, shard_path, shard_of
+    DB().set_config('shards', 3)
+    db = open_db()
+    assert isinstance(db, ShardedDB) and len(db.shards) == 3
+    assert db.enqueue_many({'id': f'sh{i}', 'command': 'exit 1' if i == 0 else 'true', 'max_retries': 1}
+                           for i in range(30)) == (30, 0)
+    assert all(os.path.exists(shard_path(db.path, i)) for i in range(3))
+    assert all(s.get_status_counts().get('pending') for s in db.shards)
+    assert db.get_status_counts() == {'pending': 30}
+    rows = db.list_jobs()
+    assert len(rows) == 30 and [r['seq'] for r in rows] == sorted(r['seq'] for r in rows)
+    page = list(db.iter_jobs(limit=10))
+    assert [r['id'] for _, r in db.iter_jobs(after=page[-1][0])] == [r['id'] for r in rows[10:]]
+    p = start_worker_proc(1, prefetch=4)
+    try:
+        for _ in range(100):
+            if db.get_status_counts() == {'completed': 29, 'dead': 1}:
+                break
+            time.sleep(0.1)
+    finally:
+        stop_proc(p)
+    assert db.get_status_counts() == {'completed': 29, 'dead': 1}
+    assert [r['id'] for r in db.list_jobs('dead')] == ['sh0'] and db.dlq_retry('sh0') == (True, None)
+    assert db.get_job('sh0')['shard'] == db.shards.index(db._locate('sh0'))
+    # a child goes with its parents, and cannot have them in two shards or its key in a third
+    home = {i: db.shards.index(db._locate(f'sh{i}')) for i in range(1, 30)}
+    a = next(i for i in home if home[i] == 0)
+    b = next(i for i in home if home[i] == 1)
+    db.enqueue({'id': 'kid', 'command': 'true', 'depends_on': [f'sh{a}']})
+    assert db.shards.index(db._locate('kid')) == 0
+    with pytest.raises(ValueError, match=f'shard 0: sh{a}; shard 1: sh{b}'):
+        db.enqueue({'command': 'true', 'depends_on': [f'sh{a}', f'sh{b}']})
+    key = next(k for k in (f'k{i}' for i in range(100)) if shard_of(k, 3) != 0)
+    with pytest.raises(ValueError, match=f"concurrency_key '{key}' routes the job to shard {shard_of(key, 3)}"):
+        db.enqueue({'command': 'true', 'depends_on': [f'sh{a}'], 'concurrency_key': key})
+    rejects = []
+    assert db.enqueue_many([{'command': 'true', 'depends_on': [f'sh{a}', f'sh{b}']}, {'id': 'fine', 'command': 'true'}],
+                           on_reject=lambda job, err: rejects.append(err)) == (1, 1)
+    assert 'spans shards' in rejects[0]
+    # by queue: a queue's jobs share one shard
+    db.set_config('shard_by', 'queue')
+    db = open_db()
+    db.enqueue_many({'command': 'true', 'queue': 'q1'} for _ in range(5))
+    assert sorted(s.get_status_counts('q1').get('pending', 0) for s in db.shards) == [0, 0, 5]
+
+def test_delayed_jobs_and_schedules_fire_once_per_tick():
+    from datetime import datetime, timezone
+    from queuectl.scheduler import Cron, Scheduler
+    ts = lambda *a: datetime(*a, tzinfo=timezone.utc).timestamp()
+    assert Cron('*/15 9-17 * * mon-fri').next(ts(2025, 1, 3, 17, 50)) == ts(2025, 1, 6, 9, 0)
+    assert Cron('@yearly').next(ts(2025, 6, 1)) == ts(2026, 1, 1)
+    assert Cron('0 0 1,15 * 0').next(ts(2025, 3, 2, 0, 0)) == ts(2025, 3, 9)
+    assert Cron('@every 30s').next(ts(2025, 1, 1, 0, 0, 10)) == ts(2025, 1, 1, 0, 0, 30)
+    with pytest.raises(ValueError):
+        Cron('61 * * * *')
+    db = DB()
+    db.enqueue({'id': 'later', 'command': 'true', 'delay': '1h'})
+    db.enqueue({'id': 'at', 'command': 'true', 'run_at': '2020-01-01T00:00:00Z'})
+    assert db.fetch_and_claim_job()['id'] == 'at' and db.fetch_and_claim_job() is None
+    assert db.next_available_at() > time.time() + 3500
+    start = ts(2025, 1, 1)
+    db.add_schedule('tick', '*/5 * * * *', {'command': 'echo tick'}, Cron('*/5 * * * *').next(start))
+    db.add_schedule('daily', '@daily', {'command': 'true', 'queue': 'ops'}, Cron('@daily').next(start))
+    sched = Scheduler(db)
+    assert sched.tick(start + 60) == []
+    # down for 12 minutes: the 00:05 and 00:10 ticks collapse into one job
+    assert sched.tick(start + 720) == [('tick', f'tick@{int(start + 600)}', 1)]
+    assert db.list_schedules()[0]['next_run'] == start + 900
+    # a restart that lost the advance re-fires the same tick as a duplicate, not a second job
+    db.advance_schedules([('tick', start + 900, start + 600, None)])
+    assert Scheduler(db).tick(start + 720) == [('tick', f'tick@{int(start + 600)}', 0)]
+    assert sum(1 for j in db.list_jobs() if j['id'].startswith('tick@')) == 1
+    fired = Scheduler(db).tick(start + 86400)
+    assert sorted(name for name, _, _ in fired) == ['daily', 'tick']
+    assert db.get_job(f'daily@{int(start + 86400)}')['queue'] == 'ops'
+    assert db.remove_schedule('tick') and [s['name'] for s in db.list_schedules()] == ['daily']
+
+def test_dedup_key_coalesces_live_duplicates():
+    db = DB()
+    assert db.enqueue({'id': 'a', 'command': 'true', 'dedup_key': 'export'}) == 'a'
+    assert db.enqueue({'id': 'b', 'command': 'true', 'dedup_key': 'export'}) == 'a'
+    merged = []
+    assert db.enqueue_many([{'id': 'c', 'command': 'true', 'dedup_key': 'export'},
+                            {'id': 'd', 'command': 'true', 'dedup_key': 'other'},
+                            {'id': 'e', 'command': 'true', 'dedup_key': 'other'},
+                            {'id': 'f', 'command': 'true'}],
+                           on_coalesce=lambda job, held: merged.append((job['id'], held))) == (2, 0)
+    assert merged == [('c', 'a'), ('e', 'd')]
+    assert sorted(j['id'] for j in db.list_jobs()) == ['a', 'd', 'f']
+    assert db.metric_totals('enqueue_coalesced_total') == {'': 3}
+    # a duplicate id is still an error, reported per job in bulk
+    with pytest.raises(sqlite3.IntegrityError):
+        db.enqueue({'id': 'f', 'command': 'true'})
+    rejected = []
+    assert db.enqueue_many([{'id': 'f', 'command': 'true'}, {'id': 'g', 'command': 'true', 'dedup_key': 'export'}],
+                           on_reject=lambda job, err: rejected.append(job['id'])) == (0, 1)
+    assert rejected == ['f']
+    # the key is held while processing, and let go once the job finishes
+    job = db.fetch_and_claim_job()
+    assert job['id'] == 'a' and db.enqueue({'command': 'true', 'dedup_key': 'export'}) == 'a'
+    db.update_job_after_run('a', True, 1, 3)
+    assert db.enqueue({'id': 'h', 'command': 'true', 'dedup_key': 'export'}) == 'h'
+    # a held key past its ttl passes to the next job
+    db.enqueue({'id': 'i', 'command': 'true', 'dedup_key': 'ttl', 'dedup_ttl': 0})
+    assert db.enqueue({'id': 'j', 'command': 'true', 'dedup_key': 'ttl'}) == 'j'
+    assert db.get_job('i')['dedup_key'] is None
+    # sharded: duplicates route by key to one shard, and the counters are summed over shards
+    from queuectl.shards import ShardedDB
+    sharded = ShardedDB(shards=3)
+    assert len({sharded.enqueue({'command': 'true', 'dedup_key': 'sk'}) for _ in range(3)}) == 1
+    assert sharded.get_status_counts()['pending'] == 6
+    assert sharded.metric_totals('enqueue_coalesced_total') == {'': 7}
+
+def test_dependencies_release_children_and_cascade_failures():
+    db = DB()
+    db.enqueue({'id': 'fetch', 'command': 'true'})
+    assert db.enqueue_many([{'id': 'build', 'command': 'true', 'depends_on': ['fetch']},
+                            {'id': 'lint', 'command': 'true', 'depends_on': ['fetch'], 'max_retries': 1},
+                            {'id': 'test', 'command': 'true', 'depends_on': ['build', 'lint']},
+                            {'id': 'orphan', 'command': 'true', 'depends_on': ['nope']}],
+                           on_reject=lambda job, err: None) == (3, 1)
+    assert db.get_status_counts() == {'pending': 1, 'blocked': 3}
+    assert db.get_job('test')['pending_deps'] == 2
+    # the claim only ever sees ready jobs; each success counts its children down
+    assert [j['id'] for j in db.fetch_and_claim_jobs(10)] == ['fetch']
+    db.update_job_after_run('fetch', True, 1, 3)
+    assert sorted(j['id'] for j in db.fetch_and_claim_jobs(10)) == ['build', 'lint']
+    db.update_job_after_run('build', True, 1, 3)
+    assert db.get_job('test')['state'] == 'blocked' and db.get_job('test')['pending_deps'] == 1
+    graph = db.job_graph('test')
+    assert sorted((e['parent'], e['child'], e['state']) for e in graph['up']) == [
+        ('build', 'test', 'completed'), ('fetch', 'build', 'completed'), ('fetch', 'lint', 'completed'), ('lint', 'test', 'processing')]
+    assert sorted((e['child'], e['state']) for e in db.job_graph('fetch', depth=1)['down']) == [('build', 'completed'), ('lint', 'processing')]
+    # lint dies (its lease runs out): test, and what waits on test, are marked dead in batches
+    db.enqueue_many({'id': f'fan{i}', 'command': 'true', 'depends_on': ['test']} for i in range(7))
+    assert db.reap_expired_leases(time.time() + 3600) == ['lint']
+    assert db.cascade_failures(batch_size=3) == 8 and db.cascade_failures() == 0
+    assert db.get_job('fan6')['last_error'] == 'dependency test failed'
+    assert db.enqueue({'id': 'late', 'command': 'true', 'depends_on': ['lint']}) == 'late'
+    assert db.get_job('late')['state'] == 'dead'
+    assert db.dlq_retry('test') == (False, 'dependency lint is dead; retry it first')
+    # retrying the parent and then the child puts the child back to waiting
+    assert db.dlq_retry('lint') == (True, None) and db.dlq_retry('test') == (True, None)
+    assert db.get_job('test')['state'] == 'blocked'
+    db.fetch_and_claim_job()
+    db.update_job_after_run('lint', True, 1, 1)
+    assert db.fetch_and_claim_job()['id'] == 'test'
+    # a failure written back by a worker cascades at once
+    db.update_job_after_run('test', False, 3, 3, 'exit=1')
+    assert db.get_status_counts() == {'completed': 3, 'dead': 9}
+
+def test_concurrency_and_rate_limits_apply_at_claim():
+    db = DB()
+    db.set_key_limit('export', max_in_flight=2)
+    db.set_key_limit('api', rate=2, burst=3)
+    db.enqueue_many([{'id': f'e{i}', 'command': 'true', 'concurrency_key': 'export', 'priority': 5} for i in range(4)] +
+                    [{'id': f'a{i}', 'command': 'true', 'concurrency_key': 'api', 'priority': 5} for i in range(6)] +
+                    [{'id': f'x{i}', 'command': 'true'} for i in range(3)])
+    # saturated keys are skipped and the rest of the backlog keeps flowing
+    got = [j['id'] for j in db.fetch_and_claim_jobs(20)]
+    assert got == ['e0', 'e1', 'a0', 'a1', 'a2', 'x0', 'x1', 'x2']
+    assert db.fetch_and_claim_job() is None
+    assert {r['key']: r['in_flight'] for r in db.list_key_limits()} == {'api': 3, 'export': 2}
+    # a finished, failed or released job frees its slot
+    db.update_job_after_run('e0', True, 1, 3)
+    db.release_jobs(['e1'])
+    assert sorted(j['id'] for j in db.fetch_and_claim_jobs(5)) == ['e1', 'e2']
+    # the bucket refills at `rate`; idle workers sleep until the next token
+    assert time.time() < db.next_token_at() <= time.time() + 0.5
+    time.sleep(0.55)
+    assert db.fetch_and_claim_job()['id'] == 'a3'
+    assert db.remove_key_limit('api') and sorted(j['id'] for j in db.fetch_and_claim_jobs(5)) == ['a4', 'a5']
+    with pytest.raises(ValueError):
+        db.set_key_limit('x')
+
+def test_bulk_dlq_retry_purge_and_summary():
+    db = DB()
+    db.enqueue_many([{'id': f'k{i}', 'command': f'python etl/load_partitions.py --part {i}', 'queue': 'etl' if i % 2 else 'default', 'max_retries': 1}
+                     for i in range(7)] + [{'id': 'p', 'command': 'parent.sh', 'max_retries': 1},
+                                           {'id': 'c', 'command': 'child.sh', 'depends_on': ['p']}])
+    for job in db.fetch_and_claim_jobs(20):
+        db.update_job_after_run(job['id'], False, 1, 1, 'exit=137' if job['id'].startswith('k') else 'exit=1')
+    assert db.get_status_counts() == {'dead': 9}
+    assert [(g['count'], g['last_error'], g['command']) for g in db.dlq_summary()] == [
+        (7, 'exit=137', 'python etl/load_partitions.py --'), (1, 'dependency p failed', 'child.sh'), (1, 'exit=1', 'parent.sh')]
+    # filtered, limited and batched; requeued jobs fall due across the stagger window
+    before = time.time()
+    assert db.dlq_retry_many(error='exit=137', queue='etl', limit=2, batch_size=1) == 2
+    assert db.dlq_retry_many(error='exit=137', stagger=60, batch_size=2) == 5
+    due = [j['available_at'] for j in db.list_jobs('pending')]
+    assert len(due) == 7 and all(before <= t <= time.time() + 60 for t in due) and max(due) > time.time()
+    # a child of a dead parent waits for it: in the same run it comes back blocked
+    assert db.dlq_retry_many(error='dependency') == 0
+    assert db.dlq_retry_many() == 2
+    assert db.get_job('c')['state'] == 'blocked' and db.get_job('p')['state'] == 'pending'
+    db.enqueue({'id': 'old', 'command': 'x', 'max_retries': 1, 'priority': 9})
+    db.update_job_after_run(db.fetch_and_claim_job()['id'], False, 1, 1, 'exit=2')
+    # --since/--until on dead jobs mean when they died: 'old' was enqueued a day ago but died just now
+    db._conn().execute("UPDATE jobs SET seq = seq - 86400000000 WHERE id = 'old'")
+    db._conn().commit()
+    assert [j['id'] for _, j in db.iter_jobs('dead', since=time.time() - 3600)] == ['old']
+    assert db.dlq_purge(until=time.time() - 3600) == 0
+    assert db.dlq_purge(error='exit=2', since=time.time() - 3600) == 1 and db.get_job('old') is None
+
+def test_resource_requests_fit_node_budget_and_usage_is_recorded():
+    db = DB()
+    db.set_config('node_cpu', 2)
+    db.set_config('node_mem_mb', 1000)
+    db.enqueue_many([{'id': f'b{i}', 'command': 'true', 'cpu': 1, 'mem_mb': 400, 'priority': 5} for i in range(3)] +
+                    [{'id': 'm', 'command': 'true', 'mem_mb': 300}, {'id': 'x', 'command': 'true'}])
+    # b2 would need a third core: it stays pending while smaller jobs go past it
+    assert [j['id'] for j in db.fetch_and_claim_jobs(10)] == ['b0', 'b1', 'x']
+    from queuectl.resources import node_name
+    assert db.node_usage() == {node_name(): (2000, 800)}
+    # another node has a budget of its own
+    other = db.fetch_and_claim_jobs(10, node=('gpu-2', 4, 1000))
+    assert [j['id'] for j in other] == ['b2', 'm'] and other[0]['node'] == 'gpu-2'
+    assert db.node_usage() == {'gpu-2': (1000, 700), node_name(): (2000, 800)}
+    db.release_jobs(['b2', 'm'])
+    db.update_job_after_run('b0', True, 1, 3)
+    db.release_jobs(['b1'])
+    assert [j['id'] for j in db.fetch_and_claim_jobs(10)] == ['b1', 'b2']
+    assert db.fetch_and_claim_job() is None
+    # a job bigger than the whole node runs once nothing else holds that resource
+    db.enqueue({'id': 'huge', 'command': 'true', 'cpu': 8, 'priority': 9})
+    assert db.fetch_and_claim_job() is None
+    for job_id in ('b1', 'b2'):
+        db.update_job_after_run(job_id, True, 1, 3)
+    assert [j['id'] for j in db.fetch_and_claim_jobs(10)] == ['huge', 'm']
+    with pytest.raises(ValueError):
+        db.enqueue({'command': 'true', 'mem_mb': 0})
+    # the worker holds a job to its mem_mb and records what the run used
+    db.enqueue({'id': 'hog', 'args': [sys.executable, '-c', 'x = bytearray(200 << 20)'], 'mem_mb': 100, 'max_retries': 1})
+    db.enqueue({'id': 'ok', 'args': [sys.executable, '-c', 'x = bytearray(50 << 20)'], 'mem_mb': 300})
+    results = [run_job(1, job, 10, 2) for job in db.fetch_and_claim_jobs(10)]
+    assert [(r['job_id'], r['success']) for r in results] == [('hog', False), ('ok', True)]
+    db.update_jobs_after_run(results)
+    ok = db.get_job('ok')
+    assert ok['peak_rss_kb'] > 50 << 10 and ok['cpu_time'] > 0 and ok['duration'] > 0
+
+def test_deleting_a_dead_parent_leaves_no_child_blocked_forever():
+    db = DB()
+    db.enqueue({'id': 'p', 'command': 'p.sh', 'max_retries': 1})
+    db.update_job_after_run(db.fetch_and_claim_job()['id'], False, 1, 1, 'exit=1')
+    db.enqueue({'id': 'pc', 'command': 'child.sh', 'depends_on': ['p']})
+    db.enqueue({'id': 'r', 'command': 'r.sh', 'max_retries': 1})
+    db.enqueue({'id': 'rc', 'command': 'child.sh', 'depends_on': ['r']})
+    with db._tx():
+        # inside a larger transaction the cascade is left to the reaper, so rc stays blocked
+        db.update_job_after_run(db.fetch_and_claim_job()['id'], False, 1, 1, 'exit=1')
+    assert db.get_job('rc')['state'] == 'blocked'
+    # purged and gc'd parents take their edges along; a blocked child is marked dead
+    assert db.dlq_purge(error='exit=1', limit=1) == 1 and db.get_job('p') is None
+    db._conn().execute("UPDATE jobs SET updated_at = '2000-01-01T00:00:00+00:00' WHERE id = 'r'")
+    assert db.gc_jobs('dead', max_age=86400) == 1
+    assert db.get_status_counts() == {'dead': 2} and db.get_job('rc')['last_error'] == 'dependency r was deleted'
+    assert db._conn().execute('SELECT COUNT(*) FROM job_deps').fetchone()[0] == 0
+    # and neither child can ever be requeued: it would wait for a parent that is gone
+    assert db.dlq_retry('pc') == (False, 'a dependency was deleted; it can never run')
+    assert db.dlq_retry_many() == 0 and db.get_job('rc')['state'] == 'dead'